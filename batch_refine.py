@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import logging
+from file_utils import atomic_write_text
+
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class OpenAIBatchBackend:
+    """
+    Submit and poll chat completion batches through the OpenAI Batch API.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, input_path):
+        with open(input_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        return batch.id
+
+    def poll(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def iter_results(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).iter_lines():
+                if line:
+                    yield json.loads(line)
+
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for the Batch API so batch mode can run offline.
+
+    Each batch is a directory under work_dir holding the submitted input.jsonl,
+    a status file and, once polled, an output.jsonl in the Batch API result
+    format. respond maps a request body to the reply text; by default it echoes
+    the last user message.
+    """
+
+    def __init__(self, work_dir, respond=None):
+        self.work_dir = work_dir
+        self.respond = respond or (lambda body: body["messages"][-1]["content"])
+        os.makedirs(work_dir, exist_ok=True)
+
+    def _batch_dir(self, batch_id):
+        return os.path.join(self.work_dir, batch_id)
+
+    def submit(self, input_path):
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        os.makedirs(self._batch_dir(batch_id))
+        shutil.copy(input_path, os.path.join(self._batch_dir(batch_id), "input.jsonl"))
+        atomic_write_text(os.path.join(self._batch_dir(batch_id), "status"), "in_progress")
+        return batch_id
+
+    def poll(self, batch_id):
+        status_path = os.path.join(self._batch_dir(batch_id), "status")
+        with open(status_path, 'r', encoding='utf-8') as f:
+            status = f.read().strip()
+        if status != "in_progress":
+            return status
+
+        output_path = os.path.join(self._batch_dir(batch_id), "output.jsonl")
+        with open(os.path.join(self._batch_dir(batch_id), "input.jsonl"), 'r', encoding='utf-8') as fin, \
+                open(f"{output_path}.tmp", 'w', encoding='utf-8') as fout:
+            for line in fin:
+                request = json.loads(line)
+                result = {
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {"choices": [{"message": {"role": "assistant", "content": self.respond(request["body"])}}]}
+                    },
+                    "error": None
+                }
+                fout.write(json.dumps(result) + "\n")
+        os.replace(f"{output_path}.tmp", output_path)
+        atomic_write_text(status_path, "completed")
+        return "completed"
+
+    def iter_results(self, batch_id):
+        with open(os.path.join(self._batch_dir(batch_id), "output.jsonl"), 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_path, manifest):
+    atomic_write_text(manifest_path, json.dumps(manifest, indent=2))
+
+
+def run_batch_refinement(requests, backend, manifest_path, model, poll_interval=30, cache=None, write_output=atomic_write_text):
+    """
+    Refine captions through a batch backend, resumable from a manifest.
+
+    requests is a list of dicts with custom_id, messages, output_path and
+    cache_key. They are written to a JSONL batch request file next to the
+    manifest, submitted, polled until the batch finishes, and the results are
+    streamed back into their output files. If a manifest from an interrupted
+    run exists, that batch is resumed instead of submitting a new one; requests
+    not covered by it are picked up on the next run. write_output(output_path, text)
+    saves each result, e.g. into a caption_store output instead of a file.
+    """
+    manifest = load_manifest(manifest_path)
+    if manifest and manifest["batch_id"] is None:
+        # Crashed between writing the request file and submitting it
+        manifest["batch_id"] = backend.submit(manifest["input_path"])
+        manifest["status"] = "submitted"
+        save_manifest(manifest_path, manifest)
+        logging.info(f"Submitted batch {manifest['batch_id']} from {manifest['input_path']}.")
+    elif manifest and manifest["status"] not in ("failed", "expired", "cancelled"):
+        logging.info(f"Resuming batch {manifest['batch_id']} from {manifest_path}.")
+    else:
+        if not requests:
+            logging.info("No captions pending batch refinement.")
+            return
+        input_path = os.path.splitext(manifest_path)[0] + "_requests.jsonl"
+        with open(input_path, 'w', encoding='utf-8') as f:
+            for request in requests:
+                f.write(json.dumps({
+                    "custom_id": request["custom_id"],
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {"model": model, "messages": request["messages"]}
+                }) + "\n")
+        manifest = {
+            "batch_id": None,
+            "status": "submitting",
+            "input_path": input_path,
+            "requests": {
+                request["custom_id"]: {"output_path": request["output_path"], "cache_key": request["cache_key"]}
+                for request in requests
+            }
+        }
+        save_manifest(manifest_path, manifest)
+        manifest["batch_id"] = backend.submit(input_path)
+        manifest["status"] = "submitted"
+        save_manifest(manifest_path, manifest)
+        logging.info(f"Submitted batch {manifest['batch_id']} with {len(requests)} caption(s).")
+
+    # Poll until the batch reaches a terminal status
+    while True:
+        status = backend.poll(manifest["batch_id"])
+        if status != manifest["status"]:
+            manifest["status"] = status
+            save_manifest(manifest_path, manifest)
+            logging.info(f"Batch {manifest['batch_id']} is {status}.")
+        if status in TERMINAL_STATUSES:
+            break
+        time.sleep(poll_interval)
+
+    if status in ("failed", "cancelled"):
+        logging.error(f"Batch {manifest['batch_id']} {status}; rerun to resubmit the pending captions.")
+        return
+
+    # Stream the results back into the refined caption files
+    saved = 0
+    for result in backend.iter_results(manifest["batch_id"]):
+        entry = manifest["requests"].get(result.get("custom_id"))
+        if entry is None:
+            continue
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            logging.error(f"Error refining caption {result.get('custom_id')}: {result.get('error') or response}")
+            continue
+        refined_caption = response["body"]["choices"][0]["message"]["content"].strip()
+        write_output(entry["output_path"], refined_caption)
+        if cache is not None and refined_caption:
+            cache.put(entry["cache_key"], refined_caption)
+        saved += 1
+    logging.info(f"Saved {saved} refined caption(s) from batch {manifest['batch_id']}.")
+    os.remove(manifest_path)
+    if os.path.exists(manifest["input_path"]):
+        os.remove(manifest["input_path"])
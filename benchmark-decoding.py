@@ -0,0 +1,121 @@
+import json
+import time
+import random
+import argparse
+import difflib
+import logging
+from PIL import Image
+import florence_engine
+import image_scanner
+from profiling import percentile, PeakRSSSampler
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def caption_similarity(caption, reference):
+    """
+    Word-level similarity ratio between a caption and the reference caption (1.0 is identical).
+    """
+    return difflib.SequenceMatcher(None, caption.lower().split(), reference.lower().split()).ratio()
+
+
+def benchmark_profile(florence, images, task_prompt, profile_name):
+    """
+    Caption every image one at a time with a decoding profile and return the captions and measurements.
+    """
+    profile = florence_engine.DECODING_PROFILES[profile_name]
+    latencies = []
+    tokens = 0
+    captions = []
+    with PeakRSSSampler() as sampler:
+        for image in images:
+            start_time = time.perf_counter()
+            caption = florence_engine.generate_captions(
+                florence.model, florence.processor, [image], task_prompt, florence.device, florence.torch_dtype,
+                profile=profile
+            )[0]
+            latencies.append(time.perf_counter() - start_time)
+            tokens += len(florence.processor.tokenizer(caption)["input_ids"])
+            captions.append(caption)
+    return captions, {
+        "profile": profile_name,
+        "decoding": profile,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "tokens_per_sec": tokens / sum(latencies) if latencies else 0.0,
+        "peak_rss_mb": sampler.peak / (1024 * 1024),
+    }
+
+
+def main(input_folder, task_prompt, profile_names, reference_profile, sample_size, seed, model_name, cpu_fast, output_path):
+    """
+    Run a fixed image sample through each decoding profile and report speed and similarity to the reference profile.
+    """
+    image_paths = sorted(image_scanner.iter_image_files(input_folder))
+    if not image_paths:
+        logging.warning("No image files found in the specified folder.")
+        return
+    image_paths = random.Random(seed).sample(image_paths, min(sample_size, len(image_paths)))
+    images = [Image.open(image_path).convert("RGB") for image_path in image_paths]
+
+    florence = florence_engine.LazyFlorence(florence_engine.FLORENCE_MODELS[model_name], cpu_fast=cpu_fast)
+    florence.load()
+
+    # Warm up so the first profile does not pay one-off allocation costs
+    florence_engine.generate_captions(
+        florence.model, florence.processor, images[:1], task_prompt, florence.device, florence.torch_dtype,
+        profile=florence_engine.DECODING_PROFILES["greedy-short"]
+    )
+
+    if reference_profile not in profile_names:
+        profile_names = [reference_profile] + profile_names
+    results = []
+    captions_by_profile = {}
+    for profile_name in profile_names:
+        logging.info(f"Benchmarking {profile_name} on {len(images)} image(s).")
+        captions_by_profile[profile_name], result = benchmark_profile(florence, images, task_prompt, profile_name)
+        results.append(result)
+
+    reference_captions = captions_by_profile[reference_profile]
+    for result in results:
+        captions = captions_by_profile[result["profile"]]
+        similarities = [caption_similarity(c, r) for c, r in zip(captions, reference_captions)]
+        result["similarity_to_reference"] = sum(similarities) / len(similarities)
+
+    print(f"{'profile':<14} {'p50 (s)':>8} {'p95 (s)':>8} {'tok/s':>8} {'peak RSS (MB)':>14} {'similarity':>10}")
+    for result in results:
+        print(
+            f"{result['profile']:<14} {result['latency_p50']:>8.2f} {result['latency_p95']:>8.2f} "
+            f"{result['tokens_per_sec']:>8.1f} {result['peak_rss_mb']:>14.0f} {result['similarity_to_reference']:>10.3f}"
+        )
+
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "model": florence.cache_id,
+                "task_prompt": task_prompt,
+                "reference_profile": reference_profile,
+                "images": image_paths,
+                "results": results,
+                "captions": captions_by_profile,
+            }, f, indent=2)
+        logging.info(f"Wrote benchmark report to {output_path}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Florence-2 decoding profiles for speed and caption similarity.")
+    parser.add_argument("input_folder", type=str, help="Path to the folder of images to sample from.")
+    parser.add_argument("--task-prompt", type=str, default="<CAPTION>", help="Florence-2 task prompt to benchmark.")
+    parser.add_argument("--profiles", nargs="+", default=list(florence_engine.DECODING_PROFILES), choices=list(florence_engine.DECODING_PROFILES), help="Decoding profiles to compare.")
+    parser.add_argument("--reference", type=str, default=florence_engine.DEFAULT_PROFILE, choices=list(florence_engine.DECODING_PROFILES), help="Profile the others are compared against.")
+    parser.add_argument("--sample-size", type=int, default=20, help="Number of images in the fixed sample.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for choosing the image sample.")
+    parser.add_argument("--model", choices=sorted(florence_engine.FLORENCE_MODELS), default="large", help="Florence-2 checkpoint.")
+    parser.add_argument("--cpu-fast", choices=florence_engine.CPU_FAST_PATHS, default=None, help="CPU fast path: dynamic int8 quantization or bfloat16 weights.")
+    parser.add_argument("--output", type=str, default=None, help="Optional path of a JSON report.")
+    args = parser.parse_args()
+
+    main(
+        args.input_folder, args.task_prompt, args.profiles, args.reference, args.sample_size, args.seed,
+        args.model, args.cpu_fast, args.output
+    )
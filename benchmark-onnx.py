@@ -0,0 +1,177 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import difflib
+import logging
+import tempfile
+import subprocess
+from PIL import Image
+import florence_engine
+import image_scanner
+from profiling import percentile, PeakRSSSampler
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# torch is the reference; onnx runs the exported graphs as configured, onnx-fp32 the unquantized ones
+BENCHMARK_BACKENDS = ("torch", "onnx", "onnx-fp32")
+
+
+def sample_images(input_folder, sample_size, seed):
+    image_paths = sorted(image_scanner.iter_image_files(input_folder))
+    return random.Random(seed).sample(image_paths, min(sample_size, len(image_paths)))
+
+
+def caption_similarity(caption, reference):
+    """
+    Word-level similarity ratio between a caption and the reference caption (1.0 is identical).
+    """
+    return difflib.SequenceMatcher(None, caption.lower().split(), reference.lower().split()).ratio()
+
+
+def run_backend(backend, image_paths, onnx_dir, model_name, task_prompt, profile_name, batch_size):
+    """
+    Caption image_paths with one backend and return its captions and measurements.
+
+    Runs in its own process (see main), so the peak RSS belongs to this backend alone.
+    """
+    with PeakRSSSampler() as sampler:
+        load_start = time.perf_counter()
+        florence = florence_engine.LazyFlorence(
+            florence_engine.FLORENCE_MODELS[model_name], backend="torch" if backend == "torch" else "onnx",
+            onnx_dir=onnx_dir, onnx_fp32=backend == "onnx-fp32"
+        )
+        if backend == "torch":
+            # Compare like with like: the onnx graphs are fp32 on CPU
+            florence.device, florence.torch_dtype = "cpu", florence_engine.torch.float32
+        florence.load()
+        load_seconds = time.perf_counter() - load_start
+        profile = florence_engine.DECODING_PROFILES[profile_name]
+
+        def caption_batch(paths):
+            images = [Image.open(path).convert("RGB") for path in paths]
+            pixel_values = florence_engine.preprocess_images(florence.processor, images)
+            return florence_engine.generate_multi_task_captions(
+                florence.model, florence.processor, pixel_values, [(image.width, image.height) for image in images],
+                [task_prompt], florence.device, florence.torch_dtype, task_profiles={task_prompt: profile}
+            )[task_prompt]
+
+        # Warm up so neither backend pays one-off allocation costs in the timings
+        caption_batch(image_paths[:1])
+        captions = []
+        latencies = []
+        start_time = time.perf_counter()
+        for batch in florence_engine.batched(image_paths, batch_size):
+            batch_start = time.perf_counter()
+            captions += caption_batch(batch)
+            latencies.append((time.perf_counter() - batch_start) / len(batch))
+        elapsed = time.perf_counter() - start_time
+    return {
+        "backend": backend,
+        "model": florence.cache_id,
+        "load_seconds": load_seconds,
+        "images_per_second": len(image_paths) / elapsed if elapsed else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "peak_rss_mb": sampler.peak / (1024 * 1024),
+        "captions": captions,
+    }
+
+
+def main(input_folder, onnx_dir, model_name, task_prompt, profile_name, sample_size, seed, batch_size, backends, min_similarity, output_path):
+    """
+    Caption a fixed sample with each backend in a separate process, compare the captions with the torch backend and report speed and memory.
+
+    Returns False if an onnx backend's mean similarity to the torch captions is below min_similarity.
+    """
+    image_paths = sample_images(input_folder, sample_size, seed)
+    if not image_paths:
+        logging.warning("No image files found in the specified folder.")
+        return True
+    if "torch" not in backends:
+        backends = ["torch"] + backends
+
+    results = []
+    for backend in backends:
+        logging.info(f"Benchmarking the {backend} backend on {len(image_paths)} image(s).")
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+            result_path = f.name
+        try:
+            subprocess.run([
+                sys.executable, os.path.abspath(__file__), input_folder, "--onnx-dir", onnx_dir, "--model", model_name,
+                "--task-prompt", task_prompt, "--decoding-profile", profile_name, "--sample-size", str(sample_size),
+                "--seed", str(seed), "--batch-size", str(batch_size), "--run-backend", backend, "--result-path", result_path
+            ], check=True)
+            with open(result_path, 'r', encoding='utf-8') as f:
+                results.append(json.load(f))
+        finally:
+            os.remove(result_path)
+
+    reference_captions = results[0]["captions"]
+    passed = True
+    for result in results:
+        pairs = list(zip(result["captions"], reference_captions))
+        result["exact_match"] = sum(caption == reference for caption, reference in pairs) / len(pairs)
+        result["similarity_to_torch"] = sum(caption_similarity(caption, reference) for caption, reference in pairs) / len(pairs)
+        if result["backend"] != "torch" and result["similarity_to_torch"] < min_similarity:
+            passed = False
+            for path, caption, reference in zip(image_paths, result["captions"], reference_captions):
+                if caption != reference:
+                    logging.warning(f"{result['backend']} differs on {path}:\n  torch: {reference}\n  {result['backend']}: {caption}")
+
+    print(f"{'backend':<10} {'images/s':>9} {'p50 (s)':>8} {'p95 (s)':>8} {'load (s)':>9} {'peak RSS (MB)':>14} {'exact':>6} {'similarity':>10}")
+    for result in results:
+        print(
+            f"{result['backend']:<10} {result['images_per_second']:>9.2f} {result['latency_p50']:>8.2f} {result['latency_p95']:>8.2f} "
+            f"{result['load_seconds']:>9.1f} {result['peak_rss_mb']:>14.0f} {result['exact_match']:>6.2f} {result['similarity_to_torch']:>10.3f}"
+        )
+    print(f"Parity {'passed' if passed else 'FAILED'} (minimum similarity to torch {min_similarity}).")
+
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "task_prompt": task_prompt,
+                "decoding_profile": profile_name,
+                "images": image_paths,
+                "min_similarity": min_similarity,
+                "passed": passed,
+                "results": results,
+            }, f, indent=2)
+        logging.info(f"Wrote benchmark report to {output_path}.")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check caption parity of the ONNX Runtime backend against PyTorch and compare images/sec and memory.")
+    parser.add_argument("input_folder", type=str, help="Path to the folder of images to sample from.")
+    parser.add_argument("--onnx-dir", type=str, required=True, help="Folder written by export-florence-onnx.py.")
+    parser.add_argument("--model", choices=sorted(florence_engine.FLORENCE_MODELS), default="large", help="Florence-2 checkpoint the graphs were exported from.")
+    parser.add_argument("--task-prompt", type=str, default="<CAPTION>", help="Florence-2 task prompt to caption with.")
+    parser.add_argument("--decoding-profile", choices=list(florence_engine.DECODING_PROFILES), default=florence_engine.DEFAULT_PROFILE, help="Decoding profile used by every backend.")
+    parser.add_argument("--backends", nargs="+", choices=BENCHMARK_BACKENDS, default=list(BENCHMARK_BACKENDS), help="Backends to run; torch is always run as the reference.")
+    parser.add_argument("--sample-size", type=int, default=20, help="Number of images in the fixed sample.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for choosing the image sample.")
+    parser.add_argument("--batch-size", type=int, default=1, help="Images per generate call.")
+    parser.add_argument("--min-similarity", type=float, default=0.9, help="Exit with status 1 if an onnx backend's mean word similarity to the torch captions is lower.")
+    parser.add_argument("--output", type=str, default=None, help="Optional path of a JSON report.")
+    parser.add_argument("--run-backend", choices=BENCHMARK_BACKENDS, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--result-path", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_backend:
+        # Child process of main: one backend, results as JSON
+        result = run_backend(
+            args.run_backend, sample_images(args.input_folder, args.sample_size, args.seed), args.onnx_dir,
+            args.model, args.task_prompt, args.decoding_profile, args.batch_size
+        )
+        with open(args.result_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f)
+        sys.exit(0)
+
+    passed = main(
+        args.input_folder, args.onnx_dir, args.model, args.task_prompt, args.decoding_profile, args.sample_size,
+        args.seed, args.batch_size, args.backends, args.min_similarity, args.output
+    )
+    sys.exit(0 if passed else 1)
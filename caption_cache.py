@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+DEFAULT_CACHE_DIR = ".caption_cache"
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def hash_bytes(data):
+    """
+    Return the sha256 hex digest of a bytes object.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Return the sha256 hex digest of a file's content, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(*parts):
+    """
+    Build a cache key from the stage name and everything its output depends on,
+    e.g. make_key("florence", image_hash, model_id, task_prompt).
+    """
+    return hash_bytes(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+
+
+class CaptionCache:
+    """
+    Persistent content-addressed caption cache stored in a single SQLite file.
+
+    Keys are hashes of the image content and of every setting that affects the
+    output (model id, task prompt, GPT prompt/model), so renamed images still hit
+    and images sharing a base name in different folders never collide. When the
+    stored captions exceed max_bytes the least recently used entries are evicted.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "captions.sqlite3")
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None on a miss.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key, value):
+        """
+        Store value under key and evict least recently used entries past max_bytes.
+        """
+        size = len(key) + len(value.encode('utf-8'))
+        with self.lock:
+            row = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time())
+            )
+            self.total_bytes += size
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM entries ORDER BY last_access LIMIT 256"
+            ).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                return
+            for key, size in rows:
+                self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+            logging.info(f"Evicted caption cache entries; cache now holds {self.total_bytes} bytes.")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+        logging.info(f"Caption cache: {self.hits} hit(s), {self.misses} miss(es).")
@@ -0,0 +1,237 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from file_utils import atomic_write_text, collect_pending
+
+
+class CaptionStore:
+    """
+    Every caption of a dataset in one SQLite file instead of one .txt file per caption.
+
+    Rows are keyed by (image_id, collection, kind): image_id is the image's path
+    relative to the input folder without extension (e.g. "sub/img_001"),
+    collection is the per-prompt output folder ("CAPTION", "captions", or ""
+    for scripts that write straight into the output folder) and kind is
+    "initial" or "final". The primary key index makes lookups by image id a
+    single index probe however many captions the store holds. Safe to use from
+    several threads; commits are grouped every commit_every writes, so callers
+    flush() before recording captions as done elsewhere.
+    """
+
+    def __init__(self, path, commit_every=256):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            "image_id TEXT NOT NULL, collection TEXT NOT NULL, kind TEXT NOT NULL, caption TEXT NOT NULL, "
+            "updated REAL NOT NULL, PRIMARY KEY (image_id, collection, kind))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS captions_collection ON captions (collection, kind)")
+        self.conn.commit()
+
+    def put(self, image_id, collection, kind, caption):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO captions (image_id, collection, kind, caption, updated) VALUES (?, ?, ?, ?, ?)",
+                (image_id, collection, kind, caption, time.time())
+            )
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def flush(self):
+        """
+        Commit the writes still grouped for the next commit.
+        """
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def get(self, image_id, collection=None, kind=None):
+        """
+        Return {(collection, kind): caption} for an image, optionally narrowed to one collection and kind.
+        """
+        query = "SELECT collection, kind, caption FROM captions WHERE image_id = ?"
+        params = [image_id]
+        if collection is not None:
+            query += " AND collection = ?"
+            params.append(collection)
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        with self.lock:
+            return {(row[0], row[1]): row[2] for row in self.conn.execute(query, params)}
+
+    def iter_captions(self, collection=None, kind=None):
+        """
+        Yield (image_id, collection, kind, caption) in image id order.
+        """
+        query = "SELECT image_id, collection, kind, caption FROM captions"
+        conditions, params = [], []
+        if collection is not None:
+            conditions.append("collection = ?")
+            params.append(collection)
+        if kind is not None:
+            conditions.append("kind = ?")
+            params.append(kind)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY image_id, collection, kind"
+        with self.lock:
+            self.conn.commit()
+            cursor = self.conn.cursor()
+            cursor.execute(query, params)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+            yield from rows
+
+    def iter_pending(self, collection):
+        """
+        Yield (image_id, initial_caption) for images with an initial but no final caption.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT i.image_id, i.caption FROM captions i WHERE i.collection = ? AND i.kind = 'initial' "
+                "AND NOT EXISTS (SELECT 1 FROM captions f WHERE f.image_id = i.image_id "
+                "AND f.collection = i.collection AND f.kind = 'final')",
+                (collection,)
+            ).fetchall()
+        yield from rows
+
+    def export(self, output_folder, collection=None, include_initial=True, exclude=None):
+        """
+        Write the store back out as the per-file layout the LoRA trainer expects:
+        <output_folder>/<collection>/<image_id>.txt and <image_id>_initial.txt.
+
+        exclude(image_id, collection) returning True leaves that image's captions out.
+        """
+        exported = 0
+        for image_id, row_collection, kind, caption in self.iter_captions(collection=collection):
+            if kind == "initial" and not include_initial:
+                continue
+            if exclude is not None and exclude(image_id, row_collection):
+                continue
+            path = os.path.join(output_folder, row_collection, image_id + ("_initial.txt" if kind == "initial" else ".txt"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write_text(path, caption)
+            exported += 1
+        logging.info(f"Exported {exported} caption(s) from {self.path} to {output_folder}.")
+        return exported
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+class FileCaptionOutput:
+    """
+    Caption output as one .txt file per caption (the original layout).
+
+    The captioning scripts address captions by the path they would have in this
+    layout; StoreCaptionOutput accepts the same paths, so switching backends
+    does not change the scripts.
+    """
+
+    def __init__(self, base_folder):
+        self.base_folder = base_folder
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def read(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def write(self, path, text):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write_text(path, text)
+
+    def iter_pending(self, caption_folder):
+        """
+        Yield (base_name, initial_caption_path, final_caption_path) like file_utils.collect_pending.
+        """
+        yield from collect_pending(caption_folder)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StoreCaptionOutput:
+    """
+    Caption output into a CaptionStore, addressed by per-file layout paths.
+
+    A path <base_folder>/<collection>/<image_id>[_initial].txt maps to a store
+    row; the first path component is the collection only if it is one of
+    collections, otherwise the collection is "".
+    """
+
+    def __init__(self, store, base_folder, collections=()):
+        self.store = store
+        self.base_folder = base_folder
+        self.collections = set(collections)
+
+    def _key(self, path):
+        relative_path = os.path.relpath(path, self.base_folder).replace(os.sep, "/")
+        collection, _, rest = relative_path.partition("/")
+        if collection not in self.collections or not rest:
+            collection, rest = "", relative_path
+        stem = rest[:-len(".txt")] if rest.endswith(".txt") else rest
+        if stem.endswith("_initial"):
+            return stem[:-len("_initial")], collection, "initial"
+        return stem, collection, "final"
+
+    def _path(self, image_id, collection, kind):
+        return os.path.join(self.base_folder, collection, image_id + ("_initial.txt" if kind == "initial" else ".txt"))
+
+    def exists(self, path):
+        image_id, collection, kind = self._key(path)
+        return bool(self.store.get(image_id, collection, kind))
+
+    def read(self, path):
+        image_id, collection, kind = self._key(path)
+        captions = self.store.get(image_id, collection, kind)
+        if not captions:
+            raise FileNotFoundError(path)
+        return captions[(collection, kind)]
+
+    def write(self, path, text):
+        self.store.put(*self._key(path), text)
+
+    def iter_pending(self, caption_folder):
+        collection = os.path.relpath(caption_folder, self.base_folder)
+        collection = "" if collection == "." else collection.replace(os.sep, "/")
+        for image_id, _ in self.store.iter_pending(collection):
+            yield image_id, self._path(image_id, collection, "initial"), self._path(image_id, collection, "final")
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+
+def open_caption_output(base_folder, store_path=None, collections=(), commit_every=256):
+    """
+    Per-file output under base_folder, or a CaptionStore at store_path when one is given.
+    """
+    if store_path is None:
+        return FileCaptionOutput(base_folder)
+    return StoreCaptionOutput(CaptionStore(store_path, commit_every=commit_every), base_folder, collections=collections)
@@ -0,0 +1,235 @@
+import os
+import re
+import json
+import difflib
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from file_utils import atomic_write_text
+from run_manifest import RunManifest
+
+# Written into the caption folder; records which pipeline produced each file's current content
+MARKER_NAME = ".caption_transforms.jsonl"
+
+
+class AffixRule:
+    """
+    Add a prefix and/or suffix, unless the caption already starts or ends with it.
+    """
+
+    def __init__(self, prefix="", suffix="", separator=" "):
+        self.prefix = prefix.strip()
+        self.suffix = suffix.strip()
+        self.separator = separator
+
+    def spec(self):
+        return {"type": "affix", "prefix": self.prefix, "suffix": self.suffix, "separator": self.separator}
+
+    def apply(self, text):
+        text = text.strip()
+        if self.prefix and not text.startswith(self.prefix):
+            text = f"{self.prefix}{self.separator}{text}" if text else self.prefix
+        if self.suffix and not text.endswith(self.suffix):
+            text = f"{text}{self.separator}{self.suffix}" if text else self.suffix
+        return text
+
+
+class SubstituteRule:
+    """
+    Replace whole-word terms with trigger words, e.g. {"watch": "RYMDWTH"}.
+
+    All terms are matched in one pass of a single compiled alternation, longest
+    term first, so "Cartier watch" wins over "watch" and replacements are never
+    rewritten again.
+    """
+
+    def __init__(self, mapping, ignore_case=True):
+        self.mapping = dict(mapping)
+        self.ignore_case = ignore_case
+        self.lookup = {(term.lower() if ignore_case else term): trigger for term, trigger in self.mapping.items()}
+        terms = sorted(self.mapping, key=len, reverse=True)
+        self.pattern = re.compile(
+            r"(?<!\w)(" + "|".join(re.escape(term) for term in terms) + r")(?!\w)",
+            re.IGNORECASE if ignore_case else 0
+        ) if terms else None
+
+    def spec(self):
+        return {"type": "substitute", "mapping": self.mapping, "ignore_case": self.ignore_case}
+
+    def apply(self, text):
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(
+            lambda match: self.lookup[match.group(1).lower() if self.ignore_case else match.group(1)], text
+        )
+
+
+class RegexRule:
+    """
+    re.sub(pattern, replacement, caption).
+    """
+
+    def __init__(self, pattern, replacement="", ignore_case=False):
+        self.pattern = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        self.replacement = replacement
+        self.ignore_case = ignore_case
+
+    def spec(self):
+        return {"type": "regex", "pattern": self.pattern.pattern, "replacement": self.replacement, "ignore_case": self.ignore_case}
+
+    def apply(self, text):
+        return self.pattern.sub(self.replacement, text)
+
+
+class DedupeRule:
+    """
+    Drop repeated sentences (compared case- and whitespace-insensitively) and collapse runs of whitespace.
+    """
+
+    SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+    def spec(self):
+        return {"type": "dedupe"}
+
+    def apply(self, text):
+        seen = set()
+        sentences = []
+        for sentence in self.SENTENCE_END.split(" ".join(text.split())):
+            key = sentence.lower().rstrip(".!? ")
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            sentences.append(sentence)
+        return " ".join(sentences)
+
+
+RULE_TYPES = {"affix": AffixRule, "substitute": SubstituteRule, "regex": RegexRule, "dedupe": DedupeRule}
+
+
+def rule_from_spec(spec):
+    """
+    Build a rule from a dict such as {"type": "regex", "pattern": "...", "replacement": "..."}.
+    """
+    spec = dict(spec)
+    rule_type = spec.pop("type")
+    if rule_type not in RULE_TYPES:
+        raise ValueError(f"Unknown rule type {rule_type!r}; choose from {', '.join(RULE_TYPES)}.")
+    return RULE_TYPES[rule_type](**spec)
+
+
+def load_rules(path):
+    """
+    Read a JSON list of rule specs.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return [rule_from_spec(spec) for spec in json.load(f)]
+
+
+def apply_rules(rules, text):
+    for rule in rules:
+        text = rule.apply(text)
+    return text
+
+
+def pipeline_fingerprint(rules):
+    return hashlib.sha256(json.dumps([rule.spec() for rule in rules], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def iter_caption_files(root, include_initial=False):
+    """
+    Yield the paths of .txt captions under root, skipping *_initial.txt unless include_initial.
+    """
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.endswith(".txt") and (include_initial or not entry.name.endswith("_initial.txt")):
+                    yield entry.path
+
+
+def transform_file(path, rules, marked_hash, dry_run):
+    """
+    Apply the rules to one caption file. Runs in a worker process.
+
+    Returns (status, new_hash, diff). Files whose content hash matches the marker
+    left by this same pipeline are "skipped" without re-applying the rules.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    if marked_hash is not None and hash_text(text) == marked_hash:
+        return "skipped", marked_hash, None
+    transformed = apply_rules(rules, text)
+    if transformed == text:
+        return "unchanged", hash_text(text), None
+    diff = None
+    if dry_run:
+        diff = "\n".join(difflib.unified_diff(
+            text.splitlines(), transformed.splitlines(), fromfile=path, tofile=path, lineterm=""
+        )) + "\n"
+    else:
+        atomic_write_text(path, transformed)
+    return "changed", hash_text(transformed), diff
+
+
+def _transform_chunk(args):
+    paths, rules, marked_hashes, dry_run = args
+    results = []
+    for path, marked_hash in zip(paths, marked_hashes):
+        try:
+            results.append((path, *transform_file(path, rules, marked_hash, dry_run)))
+        except Exception as e:
+            results.append((path, "failed", None, str(e)))
+    return results
+
+
+def transform_tree(root, rules, workers=None, dry_run=False, include_initial=False, chunk_size=256):
+    """
+    Apply a rule pipeline to every caption under root across worker processes.
+
+    Writes go through a temp file and an atomic rename. After a file is written
+    its new content hash is recorded with the pipeline's fingerprint in
+    <root>/.caption_transforms.jsonl, so rerunning the same pipeline leaves
+    files untouched even when a rule (such as a bare regex) is not idempotent
+    on its own. With dry_run, unified diffs are yielded and nothing is written.
+
+    Yields (relative_path, status, diff_or_error) for every file.
+    """
+    fingerprint = pipeline_fingerprint(rules)
+    marker_path = os.path.join(root, MARKER_NAME)
+    markers = RunManifest(marker_path) if not dry_run or os.path.exists(marker_path) else None
+
+    def marked_hash(relative_path):
+        entry = markers.entries.get(relative_path) if markers is not None else None
+        return entry["sha256"] if entry and entry.get("fingerprint") == fingerprint else None
+
+    def chunks():
+        paths = []
+        for path in iter_caption_files(root, include_initial=include_initial):
+            paths.append(path)
+            if len(paths) == chunk_size:
+                yield paths
+                paths = []
+        if paths:
+            yield paths
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = (
+                (paths, rules, [marked_hash(os.path.relpath(path, root)) for path in paths], dry_run)
+                for paths in chunks()
+            )
+            for results in executor.map(_transform_chunk, jobs):
+                for path, status, new_hash, detail in results:
+                    relative_path = os.path.relpath(path, root)
+                    if not dry_run and status in ("changed", "unchanged"):
+                        markers.mark(relative_path, "done", fingerprint=fingerprint, sha256=new_hash)
+                    yield relative_path, status, detail
+    finally:
+        if markers is not None:
+            markers.close()
@@ -0,0 +1,222 @@
+import os
+import json
+import shutil
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from PIL import Image
+from tqdm import tqdm
+import image_scanner
+import image_manifest
+import caption_store
+from image_hashes import dhash
+from dedupe_index import DuplicateIndex, CAPTION, IMAGE, caption_key, caption_collection
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Folder that --prune moves duplicates into, inside the scanned folder
+QUARANTINE_DIR = ".duplicates"
+
+
+def iter_caption_files(caption_folder, include_initial=False):
+    """
+    Yield (key, path) of the .txt captions under caption_folder in the per-file layout.
+    """
+    for root, directories, files in os.walk(caption_folder):
+        # Skip quarantined duplicates and hidden working folders (.shards, ...)
+        directories[:] = sorted(directory for directory in directories if not directory.startswith("."))
+        for name in sorted(files):
+            if not name.endswith(".txt") or (name.endswith("_initial.txt") and not include_initial):
+                continue
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, caption_folder)[:-len(".txt")].replace(os.sep, "/"), path
+
+
+def index_captions(index, caption_folder=None, store_path=None, include_initial=False):
+    """
+    Add new or changed captions from a caption folder or store and forget deleted ones.
+    """
+    seen = set()
+    added = 0
+    if store_path is not None:
+        store = caption_store.CaptionStore(store_path)
+        try:
+            for image_id, collection, kind, caption in tqdm(store.iter_captions(), unit="caption"):
+                if kind == "initial" and not include_initial:
+                    continue
+                key = caption_key(collection, image_id) + ("_initial" if kind == "initial" else "")
+                seen.add(key)
+                added += index.add_caption(key, caption, collection=collection)
+        finally:
+            store.close()
+    else:
+        for key, path in tqdm(iter_caption_files(caption_folder, include_initial), unit="caption"):
+            with open(path, 'r', encoding='utf-8') as f:
+                caption = f.read()
+            seen.add(key)
+            added += index.add_caption(key, caption, collection=caption_collection(key))
+    removed = index.remove_missing(CAPTION, seen)
+    logging.info(f"Indexed {added} new or changed caption(s) and forgot {removed} deleted one(s); {len(seen)} caption(s) in total.")
+
+
+def image_phash(path):
+    with Image.open(path) as image:
+        return dhash(image)
+
+
+def index_images(index, image_folder, workers=8):
+    """
+    Add new or changed images and forget deleted ones; images are decoded only if their size or mtime changed.
+    """
+    # normalize-images.py already recorded the dHash of its outputs
+    normalized_images = image_manifest.load_image_manifest(image_folder) or {}
+    seen = set()
+    added = 0
+
+    def add(key, path, fingerprint):
+        entry = normalized_images.get(path)
+        phash = (lambda: int(entry["phash"], 16)) if entry is not None and entry.get("phash") else (lambda: image_phash(path))
+        return index.add_image(key, fingerprint, phash)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(unit="image") as progress:
+        in_flight = {}
+
+        def handle(future):
+            nonlocal added
+            key = in_flight.pop(future)
+            try:
+                added += future.result()
+            except Exception as e:
+                logging.warning(f"Cannot hash {key}: {e}")
+            progress.update(1)
+
+        for path in image_scanner.iter_image_files(image_folder):
+            key = os.path.relpath(path, image_folder).replace(os.sep, "/")
+            if key.split("/")[0] == QUARANTINE_DIR:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            seen.add(key)
+            while len(in_flight) >= workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle(future)
+            in_flight[executor.submit(add, key, path, f"{stat.st_size}:{stat.st_mtime_ns}")] = key
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                handle(future)
+    removed = index.remove_missing(IMAGE, seen)
+    logging.info(f"Indexed {added} new or changed image(s) and forgot {removed} deleted one(s); {len(seen)} image(s) in total.")
+
+
+def quarantine(folder, relative_path):
+    """
+    Move folder/relative_path to folder/.duplicates/relative_path, so a prune can be undone by moving it back.
+    """
+    source = os.path.join(folder, relative_path)
+    if not os.path.exists(source):
+        return False
+    destination = os.path.join(folder, QUARANTINE_DIR, relative_path)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    shutil.move(source, destination)
+    return True
+
+
+def main(index_path, caption_folder=None, store_path=None, image_folder=None, include_initial=False, threshold=0.8, image_distance=4,
+         report_path=None, prune=False, query_text=None, query_image=None, collection="CAPTION", workers=8):
+    """
+    Update the duplicate index incrementally, then report, flag or prune near-duplicate captions and images.
+
+    In every cluster the first key is kept and the others are duplicates.
+    Captions only cluster with captions of the same collection (prompt folder),
+    and query_text is only compared with the captions of collection.
+    report_path gets the clusters and the keys to drop; export-captions.py
+    --dedupe-index skips the same keys. prune moves duplicate caption files and
+    images into a .duplicates folder and forgets them.
+    """
+    index = DuplicateIndex(index_path, caption_threshold=threshold, image_distance=image_distance)
+    try:
+        if query_text is not None or query_image is not None:
+            matches = index.query_caption(query_text, collection=collection) if query_text is not None else index.query_image(image_phash(query_image))
+            for key, score in matches:
+                print(f"{score:.3f}\t{key}" if query_text is not None else f"{score}\t{key}")
+            if not matches:
+                print("No near-duplicates indexed.")
+            return
+
+        if caption_folder is not None or store_path is not None:
+            index_captions(index, caption_folder=caption_folder, store_path=store_path, include_initial=include_initial)
+        if image_folder is not None:
+            index_images(index, image_folder, workers=workers)
+
+        caption_clusters = index.clusters(CAPTION)
+        image_clusters = index.clusters(IMAGE)
+        drop_captions = sorted(key for group in caption_clusters for key in group[1:])
+        drop_images = sorted(key for group in image_clusters for key in group[1:])
+        print(f"{len(caption_clusters)} caption cluster(s), {len(drop_captions)} duplicate caption(s); "
+              f"{len(image_clusters)} image cluster(s), {len(drop_images)} duplicate image(s).")
+        for group in caption_clusters[:10]:
+            print(f"  captions: keep {group[0]}, duplicates {', '.join(group[1:6])}{' ...' if len(group) > 6 else ''}")
+        for group in image_clusters[:10]:
+            print(f"  images: keep {group[0]}, duplicates {', '.join(group[1:6])}{' ...' if len(group) > 6 else ''}")
+
+        if report_path:
+            with open(report_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "caption_clusters": caption_clusters,
+                    "image_clusters": image_clusters,
+                    "drop_captions": drop_captions,
+                    "drop_images": drop_images,
+                }, f, indent=2)
+            logging.info(f"Wrote duplicate report to {report_path}.")
+
+        if prune:
+            moved = 0
+            if caption_folder is not None:
+                for key in drop_captions:
+                    if quarantine(caption_folder, key + ".txt"):
+                        quarantine(caption_folder, key + "_initial.txt")
+                        index.remove(CAPTION, key)
+                        moved += 1
+            elif drop_captions:
+                logging.warning("Captions in a caption store are not pruned; export them with export-captions.py --dedupe-index instead.")
+            for key in drop_images if image_folder is not None else ():
+                if quarantine(image_folder, key):
+                    index.remove(IMAGE, key)
+                    moved += 1
+            logging.info(f"Moved {moved} duplicate(s) into {QUARANTINE_DIR} folders.")
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find near-duplicate captions (MinHash/LSH) and images (dHash) and flag or prune them before training export.")
+    parser.add_argument("index", type=str, help="Path of the SQLite duplicate index; created on first use and updated incrementally.")
+    parser.add_argument("--captions", type=str, default=None, help="Caption folder in the per-file layout, e.g. the captioning output base folder.")
+    parser.add_argument("--store", type=str, default=None, help="Caption store to index instead of a caption folder.")
+    parser.add_argument("--images", type=str, default=None, help="Image folder to index.")
+    parser.add_argument("--include-initial", action="store_true", help="Also index *_initial captions.")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Estimated Jaccard similarity of caption shingles at which captions are duplicates.")
+    parser.add_argument("--image-distance", type=int, default=4, help="dHash distance in bits at which images are duplicates (fixed when the index is created).")
+    parser.add_argument("--report", type=str, default=None, help="Write the clusters and the keys to drop to this JSON file.")
+    parser.add_argument("--prune", action="store_true", help="Move all but the first member of each cluster into a .duplicates folder.")
+    parser.add_argument("--query-text", type=str, default=None, help="Only print the indexed captions near this text.")
+    parser.add_argument("--collection", type=str, default="CAPTION", help="Caption collection (prompt folder, or store collection) that --query-text searches.")
+    parser.add_argument("--query-image", type=str, default=None, help="Only print the indexed images near this image.")
+    parser.add_argument("--workers", type=int, default=8, help="Threads decoding images to hash.")
+    args = parser.parse_args()
+
+    if args.captions and args.store:
+        parser.error("Pass --captions or --store, not both.")
+    if args.prune and args.images is None and args.captions is None:
+        parser.error("--prune needs --captions or --images.")
+
+    main(
+        args.index, caption_folder=args.captions, store_path=args.store, image_folder=args.images,
+        include_initial=args.include_initial, threshold=args.threshold, image_distance=args.image_distance,
+        report_path=args.report, prune=args.prune, query_text=args.query_text, query_image=args.query_image,
+        collection=args.collection, workers=args.workers
+    )
@@ -0,0 +1,328 @@
+import os
+import re
+import json
+import time
+import array
+import random
+import sqlite3
+import hashlib
+import logging
+import threading
+from image_hashes import hamming_distance
+
+CAPTION = "caption"
+IMAGE = "image"
+
+# Mersenne prime modulus of the MinHash permutations
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def caption_key(collection, image_id):
+    """
+    Index key of a caption: its path in the per-file layout without .txt, e.g. CAPTION/sub/img_001.
+    """
+    return f"{collection}/{image_id}" if collection else image_id
+
+
+def caption_collection(key):
+    """
+    Collection of a caption key in the per-file layout: its first folder, e.g. CAPTION/sub/img_001 -> CAPTION.
+    """
+    return key.split("/", 1)[0] if "/" in key else ""
+
+
+def normalize_caption(text):
+    return " ".join(re.sub(r"[^\w]+", " ", text.lower()).split())
+
+
+def shingles(text, size=5):
+    """
+    Character size-grams of the normalized caption, so reworded captions still share most shingles.
+    """
+    text = normalize_caption(text)
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def _hash32(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=4).digest(), 'little')
+
+
+def _hash63(data):
+    # Fits an SQLite INTEGER
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little') >> 1
+
+
+class MinHasher:
+    """
+    MinHash signatures of captions; the fraction of equal slots of two
+    signatures estimates the Jaccard similarity of their shingle sets.
+    """
+
+    def __init__(self, num_perm=128, seed=1):
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(MERSENNE_PRIME)) for _ in range(num_perm)]
+
+    def signature(self, text):
+        hashes = [_hash32(shingle.encode('utf-8')) for shingle in shingles(text)]
+        return [min((a * x + b) % MERSENNE_PRIME for x in hashes) & 0xffffffff for a, b in self.permutations]
+
+
+def estimated_similarity(signature_a, signature_b):
+    return sum(a == b for a, b in zip(signature_a, signature_b)) / len(signature_a)
+
+
+class DuplicateIndex:
+    """
+    Persistent near-duplicate index of captions (MinHash/LSH) and images (dHash bands).
+
+    Caption signatures are split into bands of rows; captions of one collection
+    whose signatures agree on a whole band share a bucket, so a query only
+    compares the captions in its bands' buckets, and candidates are kept if
+    their estimated Jaccard similarity is at least caption_threshold. Captions
+    of different collections (e.g. CAPTION and DETAILED_CAPTION of one image)
+    never share a bucket and so are never duplicates of each other. Image dHashes are split into
+    image_distance + 1 bands, so any two hashes within image_distance bits agree
+    on at least one band (as in image_hashes.PerceptualIndex). Buckets live in
+    an indexed SQLite table: lookups are index probes whatever the index size,
+    and add() updates one item without a rebuild. Items are re-hashed only when
+    their fingerprint changes. Safe to use from several threads; commits are
+    grouped every commit_every changes.
+    """
+
+    def __init__(self, path, num_perm=128, bands=16, caption_threshold=0.8, image_distance=4, commit_every=256):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands}).")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.caption_threshold = caption_threshold
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS items (kind TEXT NOT NULL, key TEXT NOT NULL, fingerprint TEXT NOT NULL, "
+            "signature BLOB NOT NULL, updated REAL NOT NULL, PRIMARY KEY (kind, key))"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS buckets (kind TEXT NOT NULL, band INTEGER NOT NULL, value INTEGER NOT NULL, key TEXT NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS buckets_lookup ON buckets (kind, band, value)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS buckets_key ON buckets (kind, key)")
+
+        # The bucket layout depends on these settings, so an existing index keeps its own
+        settings = {"num_perm": num_perm, "bands": bands, "image_distance": image_distance}
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'settings'").fetchone()
+        if row is None:
+            self.conn.execute("INSERT INTO meta (name, value) VALUES ('settings', ?)", (json.dumps(settings),))
+        elif json.loads(row[0]) != settings:
+            stored = json.loads(row[0])
+            logging.warning(f"{path} was built with {stored}; using those settings instead of {settings}.")
+            settings = stored
+        self.conn.commit()
+        self.minhasher = MinHasher(settings["num_perm"])
+        self.caption_bands = settings["bands"]
+        self.rows = settings["num_perm"] // settings["bands"]
+        self.image_distance = settings["image_distance"]
+        self.image_bands = self.image_distance + 1
+        self.image_band_bits = -(-64 // self.image_bands)
+
+    def _caption_band_values(self, signature, collection):
+        # The collection salts the bucket values, so buckets never mix collections
+        salt = collection.encode('utf-8') + b"\0"
+        return [
+            _hash63(salt + array.array('I', signature[band * self.rows:(band + 1) * self.rows]).tobytes())
+            for band in range(self.caption_bands)
+        ]
+
+    def _image_band_values(self, value):
+        mask = (1 << self.image_band_bits) - 1
+        return [(value >> (band * self.image_band_bits)) & mask for band in range(self.image_bands)]
+
+    def _band_values(self, kind, signature, collection=""):
+        return self._caption_band_values(signature, collection) if kind == CAPTION else self._image_band_values(signature)
+
+    @staticmethod
+    def _encode(kind, signature):
+        return array.array('I', signature).tobytes() if kind == CAPTION else signature.to_bytes(8, 'little')
+
+    @staticmethod
+    def _decode(kind, blob):
+        if kind == CAPTION:
+            signature = array.array('I')
+            signature.frombytes(blob)
+            return signature.tolist()
+        return int.from_bytes(blob, 'little')
+
+    def _put(self, kind, key, fingerprint, signature, collection=""):
+        """
+        Store an item and its buckets unless it is already indexed with the same fingerprint; True if stored.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT fingerprint FROM items WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+            if row is not None and row[0] == fingerprint:
+                return False
+        if callable(signature):
+            signature = signature()
+        band_values = self._band_values(kind, signature, collection)
+        with self.lock:
+            self.conn.execute("DELETE FROM buckets WHERE kind = ? AND key = ?", (kind, key))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO items (kind, key, fingerprint, signature, updated) VALUES (?, ?, ?, ?, ?)",
+                (kind, key, fingerprint, self._encode(kind, signature), time.time())
+            )
+            self.conn.executemany(
+                "INSERT INTO buckets (kind, band, value, key) VALUES (?, ?, ?, ?)",
+                [(kind, band, value, key) for band, value in enumerate(band_values)]
+            )
+            self._changed()
+        return True
+
+    def _changed(self):
+        # Called with the lock held
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def add_caption(self, key, text, collection=""):
+        """
+        Index a caption of collection under key; re-hashed only if its text changed. Returns True if it was (re)indexed.
+        """
+        fingerprint = hashlib.sha256(f"{collection}\0{text}".encode('utf-8')).hexdigest()
+        return self._put(CAPTION, key, fingerprint, lambda: self.minhasher.signature(text), collection=collection)
+
+    def add_image(self, key, fingerprint, phash):
+        """
+        Index an image's 64-bit dHash under key. phash may be a callable that is only
+        called (to decode the image) when fingerprint differs from the indexed one.
+        """
+        return self._put(IMAGE, key, fingerprint, phash)
+
+    def remove(self, kind, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM buckets WHERE kind = ? AND key = ?", (kind, key))
+            self.conn.execute("DELETE FROM items WHERE kind = ? AND key = ?", (kind, key))
+            self._changed()
+
+    def keys(self, kind):
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT key FROM items WHERE kind = ?", (kind,))}
+
+    def remove_missing(self, kind, present_keys):
+        """
+        Forget indexed items of kind whose key is not in present_keys; returns how many.
+        """
+        missing = self.keys(kind) - set(present_keys)
+        for key in missing:
+            self.remove(kind, key)
+        return len(missing)
+
+    def _signatures(self, kind, keys):
+        signatures = {}
+        keys = list(keys)
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT key, signature FROM items WHERE kind = ? AND key IN ({', '.join('?' * len(chunk))})", [kind, *chunk]
+                )
+                signatures.update((key, self._decode(kind, blob)) for key, blob in rows)
+        return signatures
+
+    def _is_duplicate(self, kind, signature_a, signature_b):
+        if kind == CAPTION:
+            score = estimated_similarity(signature_a, signature_b)
+            return score >= self.caption_threshold, score
+        distance = hamming_distance(signature_a, signature_b)
+        return distance <= self.image_distance, distance
+
+    def _query(self, kind, signature, exclude=None, collection=""):
+        candidates = set()
+        with self.lock:
+            for band, value in enumerate(self._band_values(kind, signature, collection)):
+                candidates.update(row[0] for row in self.conn.execute(
+                    "SELECT key FROM buckets WHERE kind = ? AND band = ? AND value = ?", (kind, band, value)
+                ))
+        candidates.discard(exclude)
+        matches = []
+        for key, other in self._signatures(kind, candidates).items():
+            duplicate, score = self._is_duplicate(kind, signature, other)
+            if duplicate:
+                matches.append((key, score))
+        return sorted(matches, key=lambda match: -match[1] if kind == CAPTION else match[1])
+
+    def query_caption(self, text, collection="", exclude=None):
+        """
+        Return [(key, estimated similarity)] of the indexed captions of collection near text, most similar first.
+        """
+        return self._query(CAPTION, self.minhasher.signature(text), exclude=exclude, collection=collection)
+
+    def query_image(self, phash, exclude=None):
+        """
+        Return [(key, dHash distance)] of indexed images near phash, nearest first.
+        """
+        return self._query(IMAGE, phash, exclude=exclude)
+
+    def clusters(self, kind):
+        """
+        Return the groups of near-duplicate items of kind as sorted lists of keys, largest groups first.
+
+        Only items sharing a bucket are compared, and each is compared with one
+        member per group already found in that bucket, so the cost follows the
+        number of duplicates rather than the square of the index size.
+        """
+        parent = {}
+
+        def find(key):
+            while parent.get(key, key) != key:
+                parent[key] = parent.get(parent[key], parent[key])
+                key = parent[key]
+            return key
+
+        with self.lock:
+            self.conn.commit()
+            buckets = self.conn.execute(
+                "SELECT group_concat(key, char(0)) FROM buckets WHERE kind = ? GROUP BY band, value HAVING count(*) > 1", (kind,)
+            ).fetchall()
+        signatures = {}
+        for (joined_keys,) in buckets:
+            keys = sorted(joined_keys.split("\0"))
+            signatures.update(self._signatures(kind, [key for key in keys if key not in signatures]))
+            representatives = []
+            for key in keys:
+                for representative in representatives:
+                    if find(key) == find(representative):
+                        break
+                    if self._is_duplicate(kind, signatures[key], signatures[representative])[0]:
+                        parent[find(key)] = find(representative)
+                        break
+                else:
+                    representatives.append(key)
+        groups = {}
+        for key in list(parent):
+            root = find(key)
+            groups.setdefault(root, {root}).add(key)
+        return sorted((sorted(group) for group in groups.values() if len(group) > 1), key=lambda group: (-len(group), group[0]))
+
+    def duplicates(self):
+        """
+        Return (caption keys, image keys) to drop: every member of each cluster but its first key.
+        """
+        return (
+            {key for group in self.clusters(CAPTION) for key in group[1:]},
+            {key for group in self.clusters(IMAGE) for key in group[1:]},
+        )
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT count(*) FROM items").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
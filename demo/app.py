@@ -1,22 +1,52 @@
-from flask import Flask, render_template, request, jsonify, session, send_from_directory
+from flask import Flask, render_template, request, jsonify, session, send_from_directory, Response
 import replicate
 import os
-import requests
+import json
 import uuid
 from pathlib import Path
+from downloads import download_all
+from jobs import JobManager, SessionLimitExceeded, TERMINAL_STATUSES, public_view
+from result_cache import ResultCache, make_key, link_or_copy
+from history import HistoryStore, ImageGC
 
 app = Flask(__name__)
 
 # Set a secret key for session management
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "your_secret_key_here")  # Replace with a secure key in production
 
-# Initialize the Replicate client with your API token
-replicate_client = replicate.Client(api_token=os.getenv("REPLICATE_API_TOKEN"))
+# Size of the generation worker pool and the number of unfinished jobs allowed per session
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "4"))
+SESSION_JOB_LIMIT = int(os.getenv("SESSION_JOB_LIMIT", "2"))
 
 # Ensure the directory for storing generated images exists
 GENERATED_IMAGES_DIR = Path("static/generated_images")
 GENERATED_IMAGES_DIR.mkdir(parents=True, exist_ok=True)
 
+# Finished predictions keyed by model and input, with images stored once by content hash
+RESULT_CACHE_DIR = Path(os.getenv("RESULT_CACHE_DIR", "result_cache"))
+RESULT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+prediction_cache = ResultCache(
+    RESULT_CACHE_DIR / "results.sqlite3",
+    RESULT_CACHE_DIR / "blobs",
+    ttl=float(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600))),
+    max_entries=int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1000"))
+)
+
+# Generation history lives server-side instead of in the session cookie
+HISTORY_PAGE_SIZE = 20
+history_store = HistoryStore(os.getenv("HISTORY_DB", "history.sqlite3"))
+
+# Delete generated images past their age limit or their session's / the global disk quota
+image_gc = ImageGC(
+    GENERATED_IMAGES_DIR,
+    history_store,
+    "/static/generated_images",
+    per_session_bytes=int(os.getenv("GC_SESSION_QUOTA_MB", "200")) * 1024 * 1024,
+    global_bytes=int(os.getenv("GC_GLOBAL_QUOTA_MB", "5120")) * 1024 * 1024,
+    max_age=float(os.getenv("GC_MAX_AGE_DAYS", "30")) * 24 * 3600,
+    interval=float(os.getenv("GC_INTERVAL", "600"))
+).start()
+
 # Define available models
 MODELS = [
     {
@@ -41,9 +71,84 @@ def get_session_id():
 
 @app.route('/')
 def index():
-    # Retrieve the history from the session
-    history = session.get('history', [])
-    return render_template('index.html', history=history, models=MODELS)
+    # Render the newest page of history; older pages are fetched from /history
+    history, next_before_id = history_store.page(get_session_id(), limit=HISTORY_PAGE_SIZE)
+    return render_template('index.html', history=history, next_before_id=next_before_id, models=MODELS)
+
+@app.route('/history')
+def history_page():
+    before_id = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), 100)
+    items, next_before_id = history_store.page(get_session_id(), before_id=before_id, limit=limit)
+    return jsonify({'items': items, 'next_before': next_before_id})
+
+def build_prediction_input(prompt, num_outputs, seed=None):
+    """Input dict sent to the Replicate model for one generation."""
+    prediction_input = {
+        "prompt": prompt,
+        "model": "dev",
+        "lora_scale": 1,
+        "num_outputs": num_outputs,
+        "aspect_ratio": "1:1",
+        "output_format": "webp",
+        "guidance_scale": 3.5,
+        "output_quality": 90,
+        "prompt_strength": 0.8,
+        "extra_lora_scale": 1,
+        "num_inference_steps": 28
+    }
+    if seed is not None:
+        prediction_input["seed"] = seed
+    return prediction_input
+
+def run_generation(payload):
+    """Run the prediction and download its images; executed on a job worker thread."""
+    # Create a directory for this session's images
+    session_id = payload['session_id']
+    session_dir = GENERATED_IMAGES_DIR / session_id
+    session_dir.mkdir(parents=True, exist_ok=True)
+
+    prediction_input = build_prediction_input(payload['prompt'], payload['num_outputs'], payload.get('seed'))
+    cache_key = make_key(payload['model_id'], prediction_input)
+    cached_images = prediction_cache.get(cache_key)
+    if cached_images is not None:
+        # Identical request seen before: link the stored images instead of paying for a new prediction
+        image_filenames = [f"image_{uuid.uuid4().hex[:8]}{os.path.splitext(path)[1]}" for path in cached_images]
+        for path, image_filename in zip(cached_images, image_filenames):
+            link_or_copy(path, session_dir / image_filename)
+    else:
+        output = replicate_client.run(payload['model_id'], input=prediction_input)
+        # Ensure output is a list
+        if not isinstance(output, list):
+            output = [output]
+
+        # Fetch all outputs concurrently over the shared connection pool
+        image_filenames = [f"image_{uuid.uuid4().hex[:8]}.webp" for _ in output]
+        try:
+            download_all([
+                (str(image_url), session_dir / image_filename)
+                for image_url, image_filename in zip(output, image_filenames)
+            ])
+        except Exception as e:
+            raise RuntimeError(f'Failed to download images: {e}') from e
+        prediction_cache.put(cache_key, [session_dir / image_filename for image_filename in image_filenames])
+
+    image_urls = [f"/static/generated_images/{session_id}/{image_filename}" for image_filename in image_filenames]
+    history_id = history_store.add(session_id, payload['prompt'], payload['model_name'], image_urls, job_id=payload['job_id'])
+    return {'id': history_id, 'images': image_urls, 'prompt': payload['prompt'], 'model': payload['model_name']}
+
+def init_jobs(client, max_workers=GENERATION_WORKERS, per_session_limit=SESSION_JOB_LIMIT):
+    """
+    Set the Replicate client and (re)create the job worker pool.
+
+    Tests and local runs can pass any object with a replicate-style run(model, input=...) method.
+    """
+    global replicate_client, job_manager
+    replicate_client = client
+    job_manager = JobManager(run_generation, max_workers=max_workers, per_session_limit=per_session_limit)
+
+# Initialize the Replicate client with your API token
+init_jobs(replicate.Client(api_token=os.getenv("REPLICATE_API_TOKEN")))
 
 @app.route('/generate', methods=['POST'])
 def generate():
@@ -69,64 +174,71 @@ def generate():
     except ValueError:
         return jsonify({'error': 'Invalid number of outputs.'}), 400
 
+    # An optional seed makes the prediction, and so its cached result, deterministic
+    seed = request.form.get('seed', '').strip()
+    if seed:
+        try:
+            seed = int(seed)
+        except ValueError:
+            return jsonify({'error': 'Seed must be an integer.'}), 400
+    else:
+        seed = None
+
+    # Queue the prediction instead of holding this request open while it runs
     try:
-        # Call the Replicate API
-        model = selected_model['id']
-        output = replicate_client.run(
-            model,
-            input={
-                "prompt": prompt,
-                "model": "dev",
-                "lora_scale": 1,
-                "num_outputs": num_outputs,
-                "aspect_ratio": "1:1",
-                "output_format": "webp",
-                "guidance_scale": 3.5,
-                "output_quality": 90,
-                "prompt_strength": 0.8,
-                "extra_lora_scale": 1,
-                "num_inference_steps": 28
-            }
-        )
-        # Ensure output is a list
-        if not isinstance(output, list):
-            output = [output]
-
-        # Get or create session ID
-        session_id = get_session_id()
-
-        # Create a directory for this session's images
-        session_dir = GENERATED_IMAGES_DIR / session_id
-        session_dir.mkdir(parents=True, exist_ok=True)
-
-        image_urls = []
-        for idx, image_url in enumerate(output):
-            # Download the image
-            response = requests.get(image_url)
-            if response.status_code == 200:
-                image_filename = f"image_{uuid.uuid4().hex[:8]}.webp"
-                image_path = session_dir / image_filename
-                with open(image_path, 'wb') as f:
-                    f.write(response.content)
-                # Append the relative path to image_urls
-                relative_path = f"/static/generated_images/{session_id}/{image_filename}"
-                image_urls.append(relative_path)
-            else:
-                return jsonify({'error': f'Failed to download image {idx+1}.'}), 500
-
-        # Update the session history
-        history = session.get('history', [])
-        history.append({
+        job_id = job_manager.submit(get_session_id(), {
+            'session_id': get_session_id(),
+            'model_id': selected_model['id'],
+            'model_name': selected_model['name'],
             'prompt': prompt,
-            'images': image_urls,
-            'model': selected_model['name']
+            'num_outputs': num_outputs,
+            'seed': seed
         })
-        session['history'] = history
-
-        return jsonify({'success': True, 'images': image_urls, 'prompt': prompt, 'model': selected_model['name']})
-
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    except SessionLimitExceeded as e:
+        return jsonify({'error': str(e)}), 429
+
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status_url': f'/jobs/{job_id}',
+        'events_url': f'/jobs/{job_id}/events'
+    }), 202
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify(prediction_cache.stats())
+
+@app.route('/gc/stats')
+def gc_stats():
+    return jsonify(image_gc.stats())
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_manager.get(job_id, session_id=get_session_id())
+    if job is None:
+        return jsonify({'error': 'Unknown job.'}), 404
+
+    return jsonify(public_view(job))
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = job_manager.get(job_id, session_id=get_session_id())
+    if job is None:
+        return jsonify({'error': 'Unknown job.'}), 404
+
+    def stream(job):
+        # Send the current status, then every change until the job finishes
+        while job is not None:
+            yield f"event: status\ndata: {json.dumps(public_view(job))}\n\n"
+            if job['status'] in TERMINAL_STATUSES:
+                return
+            version = job['version']
+            job = job_manager.wait_for_change(job_id, version)
+            while job is not None and job['version'] == version:
+                yield ": keep-alive\n\n"
+                job = job_manager.wait_for_change(job_id, version)
+
+    return Response(stream(job), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_TIMEOUT = (5, 60)  # (connect, read) seconds
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size=16, retries=3):
+    """
+    Shared requests.Session with a pooled adapter that retries connection errors and 5xx/429 responses.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=retries,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=("GET",),
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def download_file(url, path, session=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Stream url to path in chunks through a temporary file and an atomic rename.
+
+    Returns the number of bytes written; raises on a non-200 response or a network error.
+    """
+    session = session or get_session()
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+    start_time = time.perf_counter()
+    try:
+        with session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            size = 0
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    logging.info(f"Downloaded {url} ({size} bytes) in {time.perf_counter() - start_time:.2f}s.")
+    return size
+
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("DOWNLOAD_WORKERS", "8")), thread_name_prefix="download")
+
+
+def download_all(urls_and_paths, session=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Download every (url, path) pair concurrently and return their sizes in order.
+
+    The first failure is raised after the other downloads have finished.
+    """
+    futures = [_executor.submit(download_file, url, path, session, timeout) for url, path in urls_and_paths]
+    errors = []
+    sizes = []
+    for future in futures:
+        try:
+            sizes.append(future.result())
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+    return sizes
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+
+class HistoryStore:
+    """
+    Server-side generation history in SQLite, read newest first in pages.
+
+    Replaces the history list kept in the signed session cookie, which grew with
+    every generation. Each row holds the session id, the prompt, the model name
+    and the list of image URLs. Safe to use from several threads.
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, job_id TEXT UNIQUE, "
+            "prompt TEXT NOT NULL, model TEXT NOT NULL, images TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS history_session ON history (session_id, id)")
+        self.conn.commit()
+
+    def add(self, session_id, prompt, model, images, job_id=None):
+        """
+        Record a finished generation and return its history id.
+        """
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO history (session_id, job_id, prompt, model, images, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, job_id, prompt, model, json.dumps(images), time.time())
+            )
+            self.conn.commit()
+            return cursor.lastrowid
+
+    def page(self, session_id, before_id=None, limit=20):
+        """
+        Return (items, next_before_id) for a session, newest first.
+
+        Pass next_before_id back as before_id to fetch the following page; it is None on the last page.
+        """
+        query = "SELECT id, prompt, model, images, created FROM history WHERE session_id = ?"
+        params = [session_id]
+        if before_id is not None:
+            query += " AND id < ?"
+            params.append(before_id)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit + 1)
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        items = [
+            {'id': row[0], 'prompt': row[1], 'model': row[2], 'images': json.loads(row[3]), 'created': row[4]}
+            for row in rows[:limit]
+        ]
+        next_before_id = items[-1]['id'] if len(rows) > limit else None
+        return items, next_before_id
+
+    def forget_images(self, session_id, image_urls):
+        """
+        Drop deleted image URLs from a session's history; entries left with no images are removed.
+        """
+        image_urls = set(image_urls)
+        with self.lock:
+            rows = self.conn.execute("SELECT id, images FROM history WHERE session_id = ?", (session_id,)).fetchall()
+            for entry_id, images in rows:
+                images = json.loads(images)
+                remaining = [url for url in images if url not in image_urls]
+                if len(remaining) == len(images):
+                    continue
+                if remaining:
+                    self.conn.execute("UPDATE history SET images = ? WHERE id = ?", (json.dumps(remaining), entry_id))
+                else:
+                    self.conn.execute("DELETE FROM history WHERE id = ?", (entry_id,))
+            self.conn.commit()
+
+
+class ImageGC:
+    """
+    Background collector for static/generated_images/<session_id>/.
+
+    Every interval seconds it deletes images older than max_age, then the
+    oldest images of any session over per_session_bytes, then the oldest images
+    overall until the folder is under global_bytes. Deleted images are removed
+    from the history store. Images hard-linked into the result cache only free
+    their bytes once the cache drops them too, so bytes_reclaimed counts files
+    whose last link was removed.
+    """
+
+    def __init__(self, images_dir, history, url_prefix, per_session_bytes=200 * 1024 * 1024,
+                 global_bytes=5 * 1024 * 1024 * 1024, max_age=30 * 24 * 3600, interval=600):
+        self.images_dir = str(images_dir)
+        self.history = history
+        self.url_prefix = url_prefix
+        self.per_session_bytes = per_session_bytes
+        self.global_bytes = global_bytes
+        self.max_age = max_age
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.metrics = {'runs': 0, 'files_removed': 0, 'bytes_reclaimed': 0, 'last_run': None, 'last_run_seconds': None}
+
+    def _scan(self):
+        # [(mtime, size, links, session_id, filename)] for every image file
+        files = []
+        with os.scandir(self.images_dir) as sessions:
+            for session_entry in sessions:
+                if not session_entry.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(session_entry.path) as entries:
+                    for entry in entries:
+                        if not entry.is_file(follow_symlinks=False) or '.tmp-' in entry.name:
+                            continue
+                        stat = entry.stat(follow_symlinks=False)
+                        files.append((stat.st_mtime, stat.st_size, stat.st_nlink, session_entry.name, entry.name))
+        return files
+
+    def collect(self):
+        """
+        Run one collection pass and return the number of bytes reclaimed.
+        """
+        start_time = time.perf_counter()
+        files = sorted(self._scan())
+        doomed = set()
+
+        cutoff = time.time() - self.max_age
+        doomed.update(f for f in files if f[0] < cutoff)
+
+        session_bytes = {}
+        for f in files:
+            if f not in doomed:
+                session_bytes[f[3]] = session_bytes.get(f[3], 0) + f[1]
+        for f in files:
+            if f not in doomed and session_bytes[f[3]] > self.per_session_bytes:
+                doomed.add(f)
+                session_bytes[f[3]] -= f[1]
+
+        total_bytes = sum(session_bytes.values())
+        for f in files:
+            if total_bytes <= self.global_bytes:
+                break
+            if f not in doomed:
+                doomed.add(f)
+                total_bytes -= f[1]
+
+        reclaimed = 0
+        removed = {}
+        for _, size, links, session_id, filename in doomed:
+            try:
+                os.remove(os.path.join(self.images_dir, session_id, filename))
+            except OSError:
+                continue
+            if links == 1:
+                reclaimed += size
+            removed.setdefault(session_id, []).append(f"{self.url_prefix}/{session_id}/{filename}")
+        for session_id, image_urls in removed.items():
+            self.history.forget_images(session_id, image_urls)
+
+        elapsed = time.perf_counter() - start_time
+        with self.lock:
+            self.metrics['runs'] += 1
+            self.metrics['files_removed'] += sum(len(urls) for urls in removed.values())
+            self.metrics['bytes_reclaimed'] += reclaimed
+            self.metrics['last_run'] = time.time()
+            self.metrics['last_run_seconds'] = elapsed
+        if removed:
+            logging.info(f"Image GC removed {sum(len(urls) for urls in removed.values())} file(s), reclaimed {reclaimed} bytes in {elapsed:.2f}s.")
+        return reclaimed
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.collect()
+            except Exception:
+                logging.exception("Image GC pass failed")
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="image-gc", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.metrics)
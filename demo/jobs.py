@@ -0,0 +1,130 @@
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+TERMINAL_STATUSES = ("succeeded", "failed")
+
+
+class SessionLimitExceeded(Exception):
+    """Raised when a session already has its maximum number of unfinished jobs."""
+
+
+class JobManager:
+    """
+    Run generation jobs on a bounded worker pool and track their status.
+
+    run_fn(payload) does the slow work (prediction and downloads) on a worker
+    thread and returns a JSON-serialisable result; the payload it receives also
+    carries the job id as 'job_id'. An exception marks the job failed with its
+    message. Each session may have at most per_session_limit jobs queued or
+    running at once. Waiters (SSE streams) block on a condition that is
+    notified whenever any job changes status.
+    """
+
+    def __init__(self, run_fn, max_workers=4, per_session_limit=2, max_finished_jobs=1000):
+        self.run_fn = run_fn
+        self.per_session_limit = per_session_limit
+        self.max_finished_jobs = max_finished_jobs
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generate")
+        self.jobs = {}
+        self.condition = threading.Condition()
+
+    def _active_jobs(self, session_id):
+        return sum(
+            1 for job in self.jobs.values()
+            if job['session_id'] == session_id and job['status'] not in TERMINAL_STATUSES
+        )
+
+    def _prune(self):
+        # Forget the oldest finished jobs so the table does not grow forever
+        finished = [job for job in self.jobs.values() if job['status'] in TERMINAL_STATUSES]
+        if len(finished) <= self.max_finished_jobs:
+            return
+        finished.sort(key=lambda job: job['updated'])
+        for job in finished[:len(finished) - self.max_finished_jobs]:
+            del self.jobs[job['id']]
+
+    def submit(self, session_id, payload):
+        """
+        Queue a job for session_id and return its id, or raise SessionLimitExceeded.
+        """
+        with self.condition:
+            if self._active_jobs(session_id) >= self.per_session_limit:
+                raise SessionLimitExceeded(
+                    f"At most {self.per_session_limit} generation(s) may run at once; wait for one to finish."
+                )
+            self._prune()
+            job_id = uuid.uuid4().hex
+            now = time.time()
+            self.jobs[job_id] = {
+                'id': job_id,
+                'session_id': session_id,
+                'status': 'queued',
+                'payload': payload,
+                'result': None,
+                'error': None,
+                'created': now,
+                'updated': now,
+                'version': 0,
+            }
+        self.executor.submit(self._run, job_id)
+        return job_id
+
+    def _update(self, job_id, **fields):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job.update(fields, updated=time.time(), version=job['version'] + 1)
+            self.condition.notify_all()
+
+    def _run(self, job_id):
+        with self.condition:
+            payload = self.jobs[job_id]['payload']
+        self._update(job_id, status='running')
+        start_time = time.perf_counter()
+        try:
+            result = self.run_fn(dict(payload, job_id=job_id))
+        except Exception as e:
+            logging.exception(f"Job {job_id} failed")
+            self._update(job_id, status='failed', error=str(e))
+            return
+        logging.info(f"Job {job_id} finished in {time.perf_counter() - start_time:.1f}s.")
+        self._update(job_id, status='succeeded', result=result)
+
+    def get(self, job_id, session_id=None):
+        """
+        Return a snapshot of a job, or None if it is unknown or belongs to another session.
+        """
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or (session_id is not None and job['session_id'] != session_id):
+                return None
+            return dict(job)
+
+    def wait_for_change(self, job_id, version, timeout=15):
+        """
+        Block until the job's version differs from version or timeout passes; return a snapshot.
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: job_id not in self.jobs or self.jobs[job_id]['version'] != version,
+                timeout=timeout
+            )
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def public_view(job):
+    """The fields of a job that are returned to the browser."""
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'result': job['result'],
+        'error': job['error'],
+    }
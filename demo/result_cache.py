@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+
+
+def make_key(model_id, prediction_input):
+    """Hash of the model and the full input dict sent to it."""
+    payload = json.dumps([model_id, prediction_input], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(source, destination):
+    """Hard-link source to destination, copying when the filesystem cannot link."""
+    tmp_path = f"{destination}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+class ResultCache:
+    """
+    Cache of finished predictions, keyed by make_key(model_id, prediction_input).
+
+    Each entry lists the content hashes of its images; the images themselves
+    live once in blob_dir as <sha256><ext> and are hard-linked into session
+    folders, so repeated prompts cost no Replicate call and no extra disk.
+    Entries older than ttl seconds are treated as misses, and past max_entries
+    the least recently used entries are evicted; blobs no entry references any
+    more are deleted. Safe to use from several threads.
+    """
+
+    def __init__(self, db_path, blob_dir, ttl=7 * 24 * 3600, max_entries=1000):
+        self.blob_dir = str(blob_dir)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, blobs TEXT NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self.conn.commit()
+
+    def _blob_path(self, blob):
+        return os.path.join(self.blob_dir, blob)
+
+    def get(self, key):
+        """
+        Return the blob paths of a fresh cached result, or None on a miss.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT blobs, created FROM results WHERE key = ?", (key,)).fetchone()
+            blobs = json.loads(row[0]) if row else None
+            if row is None or time.time() - row[1] > self.ttl or \
+                    not all(os.path.exists(self._blob_path(blob)) for blob in blobs):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return [self._blob_path(blob) for blob in blobs]
+
+    def put(self, key, image_paths):
+        """
+        Store the images of a finished prediction under key, deduplicating them by content.
+        """
+        blobs = []
+        for image_path in image_paths:
+            blob = hash_file(image_path) + os.path.splitext(image_path)[1]
+            if not os.path.exists(self._blob_path(blob)):
+                link_or_copy(image_path, self._blob_path(blob))
+            blobs.append(blob)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results (key, blobs, created, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(blobs), now, now)
+            )
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        expired = self.conn.execute(
+            "SELECT key, blobs FROM results WHERE created < ?", (time.time() - self.ttl,)
+        ).fetchall()
+        overflow = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0] - len(expired) - self.max_entries
+        if overflow > 0:
+            expired += self.conn.execute(
+                "SELECT key, blobs FROM results WHERE created >= ? ORDER BY last_access LIMIT ?",
+                (time.time() - self.ttl, overflow)
+            ).fetchall()
+        if not expired:
+            return
+        candidates = set()
+        for key, blobs in expired:
+            self.conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            candidates.update(json.loads(blobs))
+        referenced = set()
+        for (blobs,) in self.conn.execute("SELECT blobs FROM results"):
+            referenced.update(json.loads(blobs))
+        for blob in candidates - referenced:
+            try:
+                os.remove(self._blob_path(blob))
+            except OSError:
+                pass
+        logging.info(f"Evicted {len(expired)} cached prediction(s).")
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': entries,
+                'blobs': len(os.listdir(self.blob_dir)),
+            }
@@ -0,0 +1,51 @@
+import argparse
+import os
+import logging
+import caption_store
+from dedupe_index import DuplicateIndex, caption_key
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def main(store_path, output_folder, collection=None, include_initial=True, dedupe_index_path=None):
+    """
+    Write every caption in a caption store out as one .txt file per caption.
+
+    With dedupe_index_path, captions flagged as near-duplicates by dedupe-index.py,
+    and the captions of images flagged as near-duplicates, are left out.
+    """
+    exclude = None
+    if dedupe_index_path is not None:
+        index = DuplicateIndex(dedupe_index_path)
+        try:
+            drop_captions, drop_images = index.duplicates()
+        finally:
+            index.close()
+        drop_image_ids = {os.path.splitext(key)[0] for key in drop_images}
+        logging.info(f"Leaving out {len(drop_captions)} duplicate caption(s) and the captions of {len(drop_image_ids)} duplicate image(s).")
+
+        def exclude(image_id, row_collection):
+            return image_id in drop_image_ids or caption_key(row_collection, image_id) in drop_captions
+
+    store = caption_store.CaptionStore(store_path)
+    try:
+        return store.export(output_folder, collection=collection, include_initial=include_initial, exclude=exclude)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a caption store to the per-file .txt caption layout.")
+    parser.add_argument("store", type=str, help="Path to the SQLite caption store written with --store.")
+    parser.add_argument("output_folder", type=str, help="Folder to write <collection>/<image_id>.txt captions into.")
+    parser.add_argument("--collection", type=str, default=None, help="Only export one collection, e.g. CAPTION or captions.")
+    parser.add_argument("--no-initial", action="store_true", help="Skip *_initial.txt captions.")
+    parser.add_argument("--dedupe-index", type=str, default=None, help="Leave out near-duplicates flagged in this index built by dedupe-index.py.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.store):
+        parser.error(f"Caption store {args.store} does not exist.")
+    if args.dedupe_index and not os.path.exists(args.dedupe_index):
+        parser.error(f"Duplicate index {args.dedupe_index} does not exist.")
+
+    main(args.store, args.output_folder, collection=args.collection, include_initial=not args.no_initial, dedupe_index_path=args.dedupe_index)
@@ -0,0 +1,17 @@
+import argparse
+import logging
+import florence_engine
+import florence_onnx
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export Florence-2 to ONNX graphs for the onnx captioning backend.")
+    parser.add_argument("output_dir", type=str, help="Folder to write the graphs and config.json into; pass it as --onnx-dir.")
+    parser.add_argument("--model", choices=sorted(florence_engine.FLORENCE_MODELS), default="large", help="Florence-2 checkpoint to export.")
+    parser.add_argument("--quantize", choices=florence_onnx.QUANTIZE_MODES, default="decoder", help="Store int8 weights for the text encoder and decoder, for every graph, or for none.")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version.")
+    args = parser.parse_args()
+
+    florence_onnx.export_florence(florence_engine.FLORENCE_MODELS[args.model], args.output_dir, quantize=args.quantize, opset=args.opset)
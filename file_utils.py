@@ -0,0 +1,37 @@
+import os
+import threading
+
+
+def atomic_write_text(path, text):
+    """
+    Write text to path through a temporary file and an atomic rename.
+
+    The temporary name includes the process and thread id, so concurrent
+    writers of one path never share a temporary file.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def collect_pending(caption_folder):
+    """
+    Yield (base_name, initial_caption_path, refined_caption_path) for every
+    <base>_initial.txt under the folder that has no refined <base>.txt yet.
+    base_name is relative to caption_folder, so nested outputs keep their subfolder.
+    """
+    directories = [caption_folder]
+    while directories:
+        directory = directories.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                    continue
+                if not entry.name.endswith("_initial.txt"):
+                    continue
+                base_name = os.path.relpath(entry.path, caption_folder)[:-len("_initial.txt")]
+                refined_caption_path = os.path.join(caption_folder, f"{base_name}.txt")
+                if not os.path.exists(refined_caption_path):
+                    yield base_name, entry.path, refined_caption_path
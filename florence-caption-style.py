@@ -1,123 +1,265 @@
+import io
 import os
-import glob
+import time
 import requests
 import torch
+import concurrent.futures
 import openai
 from PIL import Image
-from transformers import AutoProcessor, AutoModelForCausalLM
 import argparse
+import florence_engine
+import prefetch
+import refine_stage
+import caption_cache
+import batch_refine
+import image_scanner
+import image_manifest
+import caption_store
+import profiling
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# openai.api_key = 
-device = "cuda:0" if torch.cuda.is_available() else "cpu"
-torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+# GPT model used by the refinement stage
+GPT_MODEL = "gpt-4o"
 
-# Load the Florence-2 model and processor
-model = AutoModelForCausalLM.from_pretrained(
-    "microsoft/Florence-2-large",
-    torch_dtype=torch_dtype,
-    trust_remote_code=True
-).to(device)
-processor = AutoProcessor.from_pretrained(
-    "microsoft/Florence-2-large",
-    trust_remote_code=True
-)
+# Async GPT refinement stage and content-addressed caption cache, created in __main__
+refiner = None
+cache = None
 
-def generate_caption(image, task_prompt="<CAPTION>"):
+# Florence-2 model and processor, loaded lazily on the first cache miss; created in __main__
+florence = None
+
+# Decoding profile name per task prompt, set in __main__
+decoding_profiles = {}
+
+# Caption output (per-file .txt layout or a caption store), set in __main__
+output = None
+
+# Per-stage timers, token counts and peak memory, created in __main__
+profiler = None
+
+def generate_captions(pixel_values, image_sizes, task_prompt="<CAPTION>"):
     """
-    Generate a caption for the given image using the Florence-2 model.
+    Generate captions for a batch of preprocessed images using the Florence-2 model.
     """
     try:
-        inputs = processor(text=task_prompt, images=image, return_tensors="pt").to(device, torch_dtype)
-        generated_ids = model.generate(
-            input_ids=inputs["input_ids"],
-            pixel_values=inputs["pixel_values"],
-            max_new_tokens=1024,
-            num_beams=3
-        )
-        generated_text = processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
-        parsed_answer = processor.post_process_generation(
-            generated_text,
-            task=task_prompt,
-            image_size=(image.width, image.height)
-        )
-        return parsed_answer.get(task_prompt, generated_text)  # Safeguard in case key is missing
+        captions = florence_engine.generate_multi_task_captions(
+            florence.model, florence.processor, pixel_values, image_sizes, [task_prompt], florence.device, florence.torch_dtype,
+            task_profiles={task_prompt: florence_engine.DECODING_PROFILES[decoding_profiles.get(task_prompt, florence_engine.DEFAULT_PROFILE)]},
+            generate_kwargs=florence.generate_kwargs(), profiler=profiler
+        )[task_prompt]
     except Exception as e:
-        logging.error(f"Error generating caption: {e}")
-        return ""
+        logging.error(f"Error generating captions: {e}")
+        return [""] * len(image_sizes)
+    florence.report_first_token()
+    return captions
+
+def florence_cache_key(image_hash, prompt_type):
+    """
+    Cache key of an initial caption: image content, checkpoint, task prompt and decoding profile.
+    """
+    parts = ["florence", image_hash, florence.cache_id, prompt_type]
+    profile_name = decoding_profiles.get(prompt_type, florence_engine.DEFAULT_PROFILE)
+    if profile_name != florence_engine.DEFAULT_PROFILE:
+        parts.append(florence_engine.DECODING_PROFILES[profile_name])
+    return caption_cache.make_key(*parts)
+
+def build_refinement_messages(caption, gpt_prompt):
+    """
+    Build the chat messages asking GPT to refine the given caption.
+    """
+    refinement_prompt = (
+        f"{gpt_prompt}\n\n"
+        f"Caption:\n{caption}"
+    )
+    messages = [
+        {
+            "role": "system",
+            "content": "You are an assistant helping revise captions for images for fine-tuning a text-to-image model."
+        },
+        {
+            "role": "user",
+            "content": refinement_prompt
+        }
+    ]
+    return messages
 
 def refine_caption_with_openai(caption, gpt_prompt):
     """
-    Refine the given caption to focus on the watch and replace background/style descriptions with 'STRSTY'.
+    Queue the given caption for refinement to focus on the watch and replace background/style descriptions with 'STRSTY'.
+
+    Returns a future resolving to the refined caption. Refinements already in the
+    caption cache resolve immediately; the others run on the async refinement
+    stage while captioning continues and are cached when they succeed.
+    """
+    messages = build_refinement_messages(caption, gpt_prompt)
+    key = caption_cache.make_key("refine", GPT_MODEL, messages)
+    cached_caption = cache.get(key)
+    if cached_caption is not None:
+        if profiler is not None:
+            profiler.count("refine_cache_hits")
+        future = concurrent.futures.Future()
+        future.set_result(cached_caption)
+        return future
+
+    def store(future):
+        if profiler is not None:
+            # Submit to result, including time queued behind the rate limits
+            profiler.record("gpt", time.perf_counter() - submitted)
+        if future.result():
+            cache.put(key, future.result())
+
+    submitted = time.perf_counter()
+    future = refiner.submit(messages)
+    future.add_done_callback(store)
+    return future
+
+def save_refined_caption(refined_caption, refined_caption_path, base_name):
+    """
+    Save a refined caption next to the initial caption; returns True if it was saved.
+
+    An empty caption means the refinement failed and is not saved, so the
+    initial caption stays pending and a rerun refines it again.
     """
+    if not refined_caption:
+        logging.error(f"Refinement of {base_name} failed; its caption is left pending.")
+        return False
     try:
-        refinement_prompt = (
-            f"{gpt_prompt}\n\n"
-            f"Caption:\n{caption}"
-        )
-
-        completion = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are an assistant helping revise captions for images for fine-tuning a text-to-image model."
-                },
-                {
-                    "role": "user",
-                    "content": refinement_prompt
-                }
-            ]
-        )
-        refined_caption = completion.choices[0].message.content.strip()
-        return refined_caption
+        with profiling.timed(profiler, "write"):
+            output.write(refined_caption_path, refined_caption)
+        logging.info(f"Saved caption for {base_name}.")
     except Exception as e:
-        logging.error(f"Error refining caption: {e}")
-        return ""
+        logging.error(f"Error refining caption for {base_name}: {e}")
+        return False
+
+    # Print the refined caption
+    print(refined_caption)
+    print("###########################")
+    return True
 
-def run_inference_on_image(image_path, output_folder, base_name, task_prompt="<CAPTION>", gpt_prompt=""):
+def refine_and_save(initial_caption, refined_caption_path, base_name, gpt_prompt):
     """
-    Generate and refine captions for a single image, with caching.
+    Queue an initial caption for refinement and save the refined caption once it arrives.
     """
-    # Define paths for initial and refined captions
-    initial_caption_path = os.path.join(output_folder, f"{base_name}_initial.txt")
-    refined_caption_path = os.path.join(output_folder, f"{base_name}.txt")
+    future = refine_caption_with_openai(initial_caption, gpt_prompt)
+    future.add_done_callback(lambda f: save_refined_caption(f.result(), refined_caption_path, base_name))
 
-    # Check if initial caption exists
-    if os.path.exists(initial_caption_path):
-        with open(initial_caption_path, 'r', encoding='utf-8') as f:
-            initial_caption = f.read()
-        logging.info(f"Loaded existing initial caption for {base_name}.")
+def prepare_image(image_path, input_folder, output_folder, task_prompt="<CAPTION>", image_info=None):
+    """
+    Look up the cached initial caption for an image by content hash or, if there is
+    none, decode and preprocess the image. Runs on the decode worker pool.
+    """
+    # Mirror the input tree so same-named images in different subfolders do not collide
+    base_name = os.path.splitext(os.path.relpath(image_path, input_folder))[0]
+    item = {
+        "image_path": image_path,
+        "base_name": base_name,
+        "image_hash": None,
+        "initial_caption": None,
+        "image_size": None,
+        "pixel_values": None,
+    }
+    image_bytes = None
+    if image_info is not None:
+        # Normalized images come with their hash, so cached ones are never read
+        item["image_hash"] = image_info["sha256"]
     else:
         try:
-            # Generate initial caption and save it
-            image = Image.open(image_path).convert("RGB")
-            initial_caption = generate_caption(image, task_prompt)
-            with open(initial_caption_path, 'w', encoding='utf-8') as f:
-                f.write(initial_caption)
-            logging.info(f"Generated and saved initial caption for {base_name}.")
+            with profiling.timed(profiler, "read"), open(image_path, 'rb') as f:
+                image_bytes = f.read()
         except Exception as e:
             logging.error(f"Error processing image {image_path}: {e}")
-            return
+            return item
+        with profiling.timed(profiler, "hash"):
+            item["image_hash"] = caption_cache.hash_bytes(image_bytes)
+
+    # Check if an initial caption for this image content, model and task is cached
+    with profiling.timed(profiler, "cache_lookup"):
+        initial_caption = cache.get(florence_cache_key(item["image_hash"], task_prompt))
+    if initial_caption is not None:
+        item["initial_caption"] = initial_caption
+        initial_caption_path = os.path.join(output_folder, f"{base_name}_initial.txt")
+        if not output.exists(initial_caption_path):
+            output.write(initial_caption_path, initial_caption)
+        logging.info(f"Loaded cached initial caption for {base_name}.")
+        return item
 
     try:
-        refined_caption = refine_caption_with_openai(initial_caption, gpt_prompt)
-        with open(refined_caption_path, 'w', encoding='utf-8') as f:
-            f.write(refined_caption)
-        logging.info(f"Saved caption for {base_name}.")
+        with profiling.timed(profiler, "decode"):
+            image = Image.open(io.BytesIO(image_bytes) if image_bytes is not None else image_path).convert("RGB")
+        item["image_size"] = (image.width, image.height)
+        with profiling.timed(profiler, "preprocess"):
+            item["pixel_values"] = florence_engine.preprocess_images(florence.processor, [image])
     except Exception as e:
-        logging.error(f"Error refining caption for {base_name}: {e}")
+        logging.error(f"Error processing image {image_path}: {e}")
+    return item
+
+def run_inference_on_batch(items, output_folder, task_prompt="<CAPTION>", gpt_prompt="", refine=True):
+    """
+    Generate and refine captions for a batch of prepared images.
+    """
+    items_to_caption = [item for item in items if item["pixel_values"] is not None]
+
+    # Generate initial captions for the whole batch and save them
+    if items_to_caption:
+        pixel_values = torch.cat([item["pixel_values"] for item in items_to_caption])
+        image_sizes = [item["image_size"] for item in items_to_caption]
+        captions = generate_captions(pixel_values, image_sizes, task_prompt)
+        for item, initial_caption in zip(items_to_caption, captions):
+            initial_caption_path = os.path.join(output_folder, f"{item['base_name']}_initial.txt")
+            try:
+                with profiling.timed(profiler, "write"):
+                    output.write(initial_caption_path, initial_caption)
+                logging.info(f"Generated and saved initial caption for {item['base_name']}.")
+            except Exception as e:
+                logging.error(f"Error processing image {item['image_path']}: {e}")
+                continue
+            item["initial_caption"] = initial_caption
+            if initial_caption:
+                cache.put(florence_cache_key(item["image_hash"], task_prompt), initial_caption)
+
+    if not refine:
         return
+    for item in items:
+        if item["initial_caption"] is None:
+            continue
+        refined_caption_path = os.path.join(output_folder, f"{item['base_name']}.txt")
+        refine_and_save(item["initial_caption"], refined_caption_path, item["base_name"], gpt_prompt)
 
-    # Print the refined caption
-    print(refined_caption)
-    print("###########################")
+def refine_pending_in_batch(output_folder, gpt_prompt, batch_backend, poll_interval=30):
+    """
+    Refine every pending initial caption in the output folder through one Batch API job.
+    """
+    requests = []
+    for base_name, initial_caption_path, refined_caption_path in output.iter_pending(output_folder):
+        initial_caption = output.read(initial_caption_path)
+        if not initial_caption:
+            continue
+        messages = build_refinement_messages(initial_caption, gpt_prompt)
+        key = caption_cache.make_key("refine", GPT_MODEL, messages)
+        cached_caption = cache.get(key)
+        if cached_caption is not None:
+            save_refined_caption(cached_caption, refined_caption_path, base_name)
+            continue
+        requests.append({
+            "custom_id": base_name,
+            "messages": messages,
+            "output_path": refined_caption_path,
+            "cache_key": key,
+        })
 
-def main(input_folder, output_base_folder):
+    batch_refine.run_batch_refinement(
+        requests, batch_backend, os.path.join(output_folder, "batch_manifest.json"), GPT_MODEL,
+        poll_interval=poll_interval, cache=cache, write_output=output.write
+    )
+
+def main(input_folder, output_base_folder, batch_size=1, decode_workers=4, batch_backend=None, batch_poll_interval=30, recursive=True, sniff=False):
     """
     Main function to process all images in the input folder.
+
+    With a batch_backend, captions are refined through one Batch API job after captioning
+    instead of one chat completion per caption.
     """
     # Define the GPT prompt
     gpt_prompt = (
@@ -133,20 +275,32 @@ def main(input_folder, output_base_folder):
     output_folder = os.path.join(output_base_folder, "captions")
     os.makedirs(output_folder, exist_ok=True)
 
-    # Define supported image extensions
-    image_extensions = ('*.png', '*.jpg', '*.jpeg', '*.bmp', '*.gif', '*.tiff')
-    image_files = []
-    for ext in image_extensions:
-        image_files.extend(glob.glob(os.path.join(input_folder, ext)))
+    # Stream image paths from the input tree so inference starts on the first image
+    image_files = image_scanner.iter_image_files(input_folder, recursive=recursive, sniff=sniff)
 
-    if not image_files:
+    # Hashes of images written by normalize-images.py, so cached images need not be read
+    normalized_images = image_manifest.load_image_manifest(input_folder) or {}
+
+    # Decode and preprocess upcoming batches on a worker pool while the model runs on the current one
+    batches = prefetch.prefetch_batches(
+        florence_engine.batched(image_files, batch_size),
+        lambda image_path: prepare_image(image_path, input_folder, output_folder, task_prompt, normalized_images.get(image_path)),
+        num_workers=decode_workers
+    )
+    processed = 0
+    for items in batches:
+        processed += len(items)
+        if profiler is not None:
+            profiler.count("images", len(items))
+        run_inference_on_batch(items, output_folder, task_prompt=task_prompt, gpt_prompt=gpt_prompt, refine=batch_backend is None)
+        output.flush()
+
+    if not processed:
         logging.warning("No image files found in the specified folder.")
         return
 
-    # Process each image
-    for image_path in image_files:
-        base_name = os.path.splitext(os.path.basename(image_path))[0]
-        run_inference_on_image(image_path, output_folder, base_name, task_prompt=task_prompt, gpt_prompt=gpt_prompt)
+    if batch_backend is not None:
+        refine_pending_in_batch(output_folder, gpt_prompt, batch_backend, poll_interval=batch_poll_interval)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process captions to focus on the watch and use 'STRSTY' for style.")
@@ -155,10 +309,98 @@ if __name__ == "__main__":
     parser.add_argument("input_folder", type=str, help="Path to the input folder containing images.")
     parser.add_argument("output_base_folder", type=str, help="Path to the folder for saving output captions.")
 
+    # Optional arguments
+    parser.add_argument("--model", choices=sorted(florence_engine.FLORENCE_MODELS), default="large", help="Florence-2 checkpoint to caption with.")
+    parser.add_argument("--cpu-fast", choices=florence_engine.CPU_FAST_PATHS, default=None, help="CPU fast path: dynamic int8 quantization or bfloat16 weights.")
+    parser.add_argument("--backend", choices=florence_engine.BACKENDS, default="torch", help="Run Florence-2 with PyTorch or with ONNX Runtime on graphs from export-florence-onnx.py.")
+    parser.add_argument("--onnx-dir", type=str, default=None, help="Folder written by export-florence-onnx.py (required with --backend onnx).")
+    parser.add_argument(
+        "--decoding-profile", action="append", default=[], metavar="[TASK=]PROFILE",
+        help=f"Decoding profile for every task or for one task, e.g. '<CAPTION>=greedy-short'. Profiles: {', '.join(florence_engine.DECODING_PROFILES)}."
+    )
+    parser.add_argument("--batch-size", type=int, default=1, help="Number of images to caption per model.generate call.")
+    parser.add_argument("--decode-workers", type=int, default=4, help="Number of threads decoding and preprocessing images ahead of the model.")
+    parser.add_argument("--no-recursive", action="store_true", help="Only caption images directly inside the input folder.")
+    parser.add_argument("--sniff", action="store_true", help="Skip files whose magic bytes are not a supported image format.")
+    parser.add_argument("--gpt-concurrency", type=int, default=8, help="Maximum number of GPT refinement requests in flight.")
+    parser.add_argument("--gpt-rpm", type=int, default=500, help="GPT requests per minute limit.")
+    parser.add_argument("--gpt-tpm", type=int, default=30000, help="GPT tokens per minute limit.")
+    parser.add_argument("--refine-mode", choices=["async", "batch"], default="async", help="Refine captions one request at a time (async) or through the Batch API (batch).")
+    parser.add_argument("--batch-backend", choices=["openai", "local"], default="openai", help="Batch backend; 'local' is a file-based stand-in for offline runs.")
+    parser.add_argument("--batch-dir", type=str, default=None, help="Working directory of the local batch backend (default: <output_base_folder>/local_batches).")
+    parser.add_argument("--batch-poll-interval", type=float, default=30, help="Seconds between batch status polls.")
+    parser.add_argument("--cache-dir", type=str, default=caption_cache.DEFAULT_CACHE_DIR, help="Directory of the content-addressed caption cache.")
+    parser.add_argument("--cache-max-mb", type=int, default=1024, help="Evict least recently used cache entries beyond this size.")
+    parser.add_argument("--profile-report", type=str, default=None, help="Write per-stage timings, token counts and peak memory to this .json or .csv file at the end of the run.")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve the live per-stage metrics in Prometheus text format at http://0.0.0.0:PORT/metrics.")
+    parser.add_argument("--store", type=str, default=None, help="Write captions into this SQLite caption store instead of .txt files; export them with export-captions.py.")
+    parser.add_argument("--openai-base-url", type=str, default=None, help="OpenAI-compatible API base URL, e.g. a local stub server.")
+
     # Parse arguments
     args = parser.parse_args()
 
     input_folder = args.input_folder
     output_base_folder = args.output_base_folder
 
-    main(input_folder, output_base_folder)
+    # Defer loading Florence-2 until the first image that is not in the cache
+    if args.backend == "onnx" and not args.onnx_dir:
+        parser.error("--backend onnx needs --onnx-dir.")
+    florence = florence_engine.LazyFlorence(
+        florence_engine.FLORENCE_MODELS[args.model], cpu_fast=args.cpu_fast, backend=args.backend, onnx_dir=args.onnx_dir
+    )
+    try:
+        decoding_profiles = florence_engine.parse_decoding_profiles(args.decoding_profile, ["<CAPTION>"])
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Open the caption cache shared by the Florence and refinement stages
+    cache = caption_cache.CaptionCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024)
+
+    # Captions go to one .txt file each, or into the "captions" collection of a caption store
+    output = caption_store.open_caption_output(output_base_folder, args.store, collections=["captions"])
+
+    # Pick the batch backend for --refine-mode batch
+    batch_backend = None
+    if args.refine_mode == "batch":
+        if args.batch_backend == "local":
+            batch_backend = batch_refine.LocalBatchBackend(args.batch_dir or os.path.join(output_base_folder, "local_batches"))
+        else:
+            batch_backend = batch_refine.OpenAIBatchBackend(openai.OpenAI(base_url=args.openai_base_url))
+
+
+    # Time every stage; the report is written and summarized when the run ends
+    profiler = profiling.StageProfiler()
+    profile_report = args.profile_report
+    metrics_port = args.metrics_port
+    if metrics_port is not None:
+        profiling.serve_metrics(profiler, metrics_port)
+    profiler.start()
+    try:
+        if batch_backend is not None:
+            main(
+                input_folder, output_base_folder, batch_size=args.batch_size, decode_workers=args.decode_workers,
+                batch_backend=batch_backend, batch_poll_interval=args.batch_poll_interval,
+                recursive=not args.no_recursive, sniff=args.sniff
+            )
+        else:
+            # Start the async GPT refinement stage; it runs while captioning continues
+            refiner = refine_stage.AsyncRefiner(
+                openai.AsyncOpenAI(base_url=args.openai_base_url, max_retries=0),
+                GPT_MODEL,
+                concurrency=args.gpt_concurrency,
+                requests_per_minute=args.gpt_rpm,
+                tokens_per_minute=args.gpt_tpm,
+                profiler=profiler
+            )
+            with refiner:
+                main(
+                    input_folder, output_base_folder, batch_size=args.batch_size, decode_workers=args.decode_workers,
+                    recursive=not args.no_recursive, sniff=args.sniff
+                )
+    finally:
+        profiler.stop()
+        logging.info("Stage profile:\n" + profiler.summary())
+        if profile_report:
+            profiler.write_report(profile_report)
+        output.close()
+        cache.close()
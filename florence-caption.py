@@ -1,142 +1,598 @@
+import io
 import os
-import glob
+import sys
+import time
+import signal
+import functools
+import threading
+import subprocess
 import requests
 import torch
+import concurrent.futures
 import openai
 from PIL import Image
-from transformers import AutoProcessor, AutoModelForCausalLM
-from openai import OpenAI
 import argparse
+import florence_engine
+import prefetch
+import refine_stage
+import caption_cache
+import batch_refine
+import image_scanner
+import image_manifest
+import trigger_rewriter
+import caption_store
+import profiling
+import shard_queue
+import folder_watcher
+import dedupe_index
 
 import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-client = OpenAI() # api_key=
 
-# Set device and torch dtype
-device = "cuda:0" if torch.cuda.is_available() else "cpu"
-torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+# GPT model used by the refinement stage
+GPT_MODEL = "gpt-4"  # Ensure the model name is correct. It was "gpt-4o" previously, which might be a typo.
 
-# Load the Florence-2 model and processor
-model = AutoModelForCausalLM.from_pretrained(
-    "microsoft/Florence-2-large", 
-    torch_dtype=torch_dtype, 
-    trust_remote_code=True
-).to(device)
-processor = AutoProcessor.from_pretrained(
-    "microsoft/Florence-2-large", 
-    trust_remote_code=True
-)
+# Async GPT refinement stage and content-addressed caption cache, created in __main__
+refiner = None
+cache = None
 
-def generate_caption(image, task_prompt="<CAPTION>"):
+# Florence-2 model and processor, loaded lazily on the first cache miss; created in __main__
+florence = None
+
+# Decoding profile name per task prompt, set in __main__
+decoding_profiles = {}
+
+# Caption output (per-file .txt layout or a caption store), set in __main__
+output = None
+
+# Per-stage timers, token counts and peak memory, created in __main__
+profiler = None
+
+# Near-duplicate index that refined captions are added to as they are saved, opened in __main__
+dedupe = None
+
+# Local trigger-word rewriter and --local-rewrite mode ("off", "before-gpt" or "only"), set in __main__
+rewriter = None
+local_rewrite_mode = "off"
+
+def generate_multi_task_captions(pixel_values, image_sizes, task_prompts, task_indices=None):
     """
-    Generate a caption for the given image using the Florence-2 model.
+    Generate captions for a batch of images for several task prompts from a single vision encoding.
     """
     try:
-        inputs = processor(text=task_prompt, images=image, return_tensors="pt").to(device, torch_dtype)
-        generated_ids = model.generate(
-            input_ids=inputs["input_ids"],
-            pixel_values=inputs["pixel_values"],
-            max_new_tokens=1024,
-            num_beams=3
+        captions = florence_engine.generate_multi_task_captions(
+            florence.model, florence.processor, pixel_values, image_sizes, task_prompts, florence.device, florence.torch_dtype,
+            task_profiles={
+                task_prompt: florence_engine.DECODING_PROFILES[decoding_profiles.get(task_prompt, florence_engine.DEFAULT_PROFILE)]
+                for task_prompt in task_prompts
+            },
+            task_indices=task_indices, generate_kwargs=florence.generate_kwargs(), profiler=profiler
         )
-        generated_text = processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
-        parsed_answer = processor.post_process_generation(
-            generated_text, 
-            task=task_prompt, 
-            image_size=(image.width, image.height)
-        )
-        return parsed_answer.get(task_prompt, generated_text)  # Safeguard in case key is missing
     except Exception as e:
-        logging.error(f"Error generating caption: {e}")
-        return ""
+        logging.error(f"Error generating captions: {e}")
+        task_indices = task_indices or {}
+        return {
+            task_prompt: [""] * len(task_indices.get(task_prompt, image_sizes))
+            for task_prompt in task_prompts
+        }
+    florence.report_first_token()
+    return captions
 
-def refine_caption_with_openai(caption, gpt_prompt):
+def florence_cache_key(image_hash, prompt_type):
     """
-    Refine the given caption using OpenAI's GPT model.
+    Cache key of an initial caption: image content, checkpoint, task prompt and decoding profile.
     """
-    try:
-        refinement_prompt = (
-            f"{gpt_prompt}:\n\n"
-            f"{caption}"
-        )
+    parts = ["florence", image_hash, florence.cache_id, prompt_type]
+    profile_name = decoding_profiles.get(prompt_type, florence_engine.DEFAULT_PROFILE)
+    if profile_name != florence_engine.DEFAULT_PROFILE:
+        parts.append(florence_engine.DECODING_PROFILES[profile_name])
+    return caption_cache.make_key(*parts)
 
-        completion = client.chat.completions.create(
-            model="gpt-4",  # Ensure the model name is correct. It was "gpt-4o" previously, which might be a typo.
-            messages=[
-                {"role": "system", "content": "You are an assistant helping revise caption for an image for finetuning a visual-language model."},
-                {
-                    "role": "user",
-                    "content": refinement_prompt
-                }
-            ]
-        )
-        refined_caption = completion.choices[0].message.content.strip()
-        return refined_caption
-    except Exception as e:
-        logging.error(f"Error refining caption: {e}")
-        return ""
+def build_refinement_messages(caption, gpt_prompt):
+    """
+    Build the chat messages asking GPT to refine the given caption.
+    """
+    refinement_prompt = (
+        f"{gpt_prompt}:\n\n"
+        f"{caption}"
+    )
+    messages = [
+        {"role": "system", "content": "You are an assistant helping revise caption for an image for finetuning a visual-language model."},
+        {
+            "role": "user",
+            "content": refinement_prompt
+        }
+    ]
+    return messages
 
-def run_inference_on_image(image_path, output_folder, base_name, task_prompt="<CAPTION>", gpt_prompt=""):
+def refine_caption_with_openai(caption, gpt_prompt):
     """
-    Generate and refine captions for a single image, with caching.
+    Queue the given caption for refinement with OpenAI's GPT model.
+
+    Returns a future resolving to the refined caption. Refinements already in the
+    caption cache resolve immediately; the others run on the async refinement
+    stage while captioning continues and are cached when they succeed.
     """
-    # Define paths for initial and refined captions
-    initial_caption_path = os.path.join(output_folder, f"{base_name}_initial.txt")
-    refined_caption_path = os.path.join(output_folder, f"{base_name}.txt")
+    messages = build_refinement_messages(caption, gpt_prompt)
+    key = caption_cache.make_key("refine", GPT_MODEL, messages)
+    cached_caption = cache.get(key)
+    if cached_caption is not None:
+        if profiler is not None:
+            profiler.count("refine_cache_hits")
+        future = concurrent.futures.Future()
+        future.set_result(cached_caption)
+        return future
 
-    # Check if initial caption exists
-    if os.path.exists(initial_caption_path):
-        with open(initial_caption_path, 'r', encoding='utf-8') as f:
-            initial_caption = f.read()
-        logging.info(f"Loaded existing initial caption for {base_name}.")
-    else:
-        try:
-            # Generate initial caption and save it
-            image = Image.open(image_path).convert("RGB")
-            initial_caption = generate_caption(image, task_prompt)
-            with open(initial_caption_path, 'w', encoding='utf-8') as f:
-                f.write(initial_caption)
-            logging.info(f"Generated and saved initial caption for {base_name}.")
-        except Exception as e:
-            logging.error(f"Error processing image {image_path}: {e}")
-            return
+    def store(future):
+        if profiler is not None:
+            # Submit to result, including time queued behind the rate limits
+            profiler.record("gpt", time.perf_counter() - submitted)
+        if future.result():
+            cache.put(key, future.result())
+
+    submitted = time.perf_counter()
+    future = refiner.submit(messages)
+    future.add_done_callback(store)
+    return future
+
+def save_refined_caption(refined_caption, refined_caption_path, base_name):
+    """
+    Save a refined caption next to the initial caption; returns True if it was saved.
 
+    An empty caption means the refinement failed and is not saved, so the
+    initial caption stays pending and a rerun refines it again.
+    """
+    if not refined_caption:
+        logging.error(f"Refinement of {base_name} failed; its caption is left pending.")
+        return False
     try:
-        refined_caption = refine_caption_with_openai(initial_caption, gpt_prompt)
-        with open(refined_caption_path, 'w', encoding='utf-8') as f:
-            f.write(refined_caption)
+        with profiling.timed(profiler, "write"):
+            output.write(refined_caption_path, refined_caption)
         logging.info(f"Saved caption for {base_name}.")
     except Exception as e:
         logging.error(f"Error refining caption for {base_name}: {e}")
-        return
+        return False
+
+    if dedupe is not None:
+        # Same key as dedupe-index.py gives the file, e.g. CAPTION/sub/img_001
+        key = os.path.relpath(refined_caption_path, output.base_folder)[:-len(".txt")].replace(os.sep, "/")
+        with profiling.timed(profiler, "dedupe"):
+            collection = dedupe_index.caption_collection(key)
+            matches = dedupe.query_caption(refined_caption, collection=collection, exclude=key)
+            dedupe.add_caption(key, refined_caption, collection=collection)
+        if matches:
+            logging.warning(f"Caption of {base_name} is a near-duplicate of {matches[0][0]} (similarity {matches[0][1]:.2f}).")
 
     # Print the refined caption
     print(refined_caption)
     print("###########################")
+    return True
+
+def rewrite_locally(initial_caption, refined_caption_path, base_name):
+    """
+    Run the rule-based trigger-word rewriter on an initial caption.
+
+    Returns the caption GPT should refine, or None when the rewrite was saved and
+    no GPT call is needed: always in "only" mode, and in "before-gpt" mode when
+    the rules changed the caption and raised no flags.
+    """
+    if rewriter is None:
+        return initial_caption
+    with profiling.timed(profiler, "local_rewrite"):
+        rewritten_caption, flags = rewriter.rewrite(initial_caption)
+    if local_rewrite_mode == "only" or (rewritten_caption != initial_caption.strip() and not flags):
+        if flags:
+            logging.warning(f"Local rewrite of {base_name} flagged {', '.join(flags)}.")
+        save_refined_caption(rewritten_caption, refined_caption_path, base_name)
+        return None
+    logging.info(f"Local rewrite of {base_name} {'flagged ' + ', '.join(flags) if flags else 'left it unchanged'}; refining with GPT.")
+    return rewritten_caption
 
-def main(input_folder, output_base_folder, prompt_type, gpt_prompt):
+def refine_and_save(initial_caption, refined_caption_path, base_name, gpt_prompt):
     """
-    Main function to process all images in the input folder with the specified prompt type.
+    Queue an initial caption for refinement and save the refined caption once it arrives.
+
+    Returns a future that resolves once the refinement finished, to True if the refined caption was saved.
+    """
+    saved = concurrent.futures.Future()
+
+    def save(future):
+        success = False
+        try:
+            success = save_refined_caption(future.result(), refined_caption_path, base_name)
+        except Exception as e:
+            logging.error(f"Error refining caption for {base_name}: {e}")
+        finally:
+            saved.set_result(success)
+
+    refine_caption_with_openai(initial_caption, gpt_prompt).add_done_callback(save)
+    return saved
+
+def get_prompt_folder_name(prompt_type):
+    """
+    Return the output subfolder name of a prompt type, e.g. <CAPTION> -> CAPTION.
+    """
+    return prompt_type.strip('<>').replace('>', '').replace('<', '')
+
+def get_prompt_folder(output_base_folder, prompt_type):
+    """
+    Return the output subfolder for a prompt type, e.g. <CAPTION> -> CAPTION.
+    """
+    return os.path.join(output_base_folder, get_prompt_folder_name(prompt_type))
+
+def prepare_image(image_path, input_folder, output_base_folder, prompt_configs, image_info=None):
+    """
+    Look up cached initial captions for an image by content hash and, if any prompt
+    type still needs one, decode and preprocess the image. Runs on the decode worker pool.
+    """
+    # Mirror the input tree so same-named images in different subfolders do not collide
+    base_name = os.path.splitext(os.path.relpath(image_path, input_folder))[0]
+    item = {
+        "image_path": image_path,
+        "base_name": base_name,
+        "image_hash": None,
+        "initial_captions": {},
+        "pending": [],
+        "image_size": None,
+        "pixel_values": None,
+        # Futures resolving to whether each refined caption was saved
+        "saved": [],
+    }
+    image_bytes = None
+    if image_info is not None:
+        # Normalized images come with their hash, so cached ones are never read
+        item["image_hash"] = image_info["sha256"]
+    else:
+        try:
+            with profiling.timed(profiler, "read"), open(image_path, 'rb') as f:
+                image_bytes = f.read()
+        except Exception as e:
+            logging.error(f"Error processing image {image_path}: {e}")
+            return item
+        with profiling.timed(profiler, "hash"):
+            item["image_hash"] = caption_cache.hash_bytes(image_bytes)
+
+    for prompt_type in prompt_configs:
+        # Check if an initial caption for this image content, model and task is cached
+        with profiling.timed(profiler, "cache_lookup"):
+            initial_caption = cache.get(florence_cache_key(item["image_hash"], prompt_type))
+        if initial_caption is None:
+            item["pending"].append(prompt_type)
+            continue
+        item["initial_captions"][prompt_type] = initial_caption
+        initial_caption_path = os.path.join(get_prompt_folder(output_base_folder, prompt_type), f"{base_name}_initial.txt")
+        if not output.exists(initial_caption_path):
+            output.write(initial_caption_path, initial_caption)
+        logging.info(f"Loaded cached initial caption for {base_name} ({prompt_type}).")
+
+    if item["pending"]:
+        try:
+            with profiling.timed(profiler, "decode"):
+                image = Image.open(io.BytesIO(image_bytes) if image_bytes is not None else image_path).convert("RGB")
+            item["image_size"] = (image.width, image.height)
+            with profiling.timed(profiler, "preprocess"):
+                item["pixel_values"] = florence_engine.preprocess_images(florence.processor, [image])
+        except Exception as e:
+            logging.error(f"Error processing image {image_path}: {e}")
+            item["pending"] = []
+    return item
+
+def run_inference_on_batch(items, output_base_folder, prompt_configs, refine=True):
+    """
+    Generate and refine captions for a batch of prepared images for every prompt type.
+
+    Each image is decoded and encoded once; the image features are shared by the
+    text decode of every prompt type that does not have a cached initial caption.
+    Returns the futures of the refinements still in flight.
+    """
+    items_to_caption = [item for item in items if item["pending"]]
+    task_indices = {
+        prompt_type: [i for i, item in enumerate(items_to_caption) if prompt_type in item["pending"]]
+        for prompt_type in prompt_configs
+    }
+
+    # Generate initial captions for every prompt type from a shared vision encoding
+    captions = {}
+    if items_to_caption:
+        pixel_values = torch.cat([item["pixel_values"] for item in items_to_caption])
+        image_sizes = [item["image_size"] for item in items_to_caption]
+        captions = generate_multi_task_captions(pixel_values, image_sizes, list(prompt_configs), task_indices)
+
+    for prompt_type, indices in task_indices.items():
+        output_folder = get_prompt_folder(output_base_folder, prompt_type)
+        for i, initial_caption in zip(indices, captions.get(prompt_type, [])):
+            item = items_to_caption[i]
+            initial_caption_path = os.path.join(output_folder, f"{item['base_name']}_initial.txt")
+            try:
+                with profiling.timed(profiler, "write"):
+                    output.write(initial_caption_path, initial_caption)
+                logging.info(f"Generated and saved initial caption for {item['base_name']} ({prompt_type}).")
+            except Exception as e:
+                logging.error(f"Error processing image {item['image_path']}: {e}")
+                continue
+            item["initial_captions"][prompt_type] = initial_caption
+            if initial_caption:
+                cache.put(florence_cache_key(item["image_hash"], prompt_type), initial_caption)
+
+    refinements = []
+    if not refine:
+        return refinements
+    for prompt_type, gpt_prompt in prompt_configs.items():
+        output_folder = get_prompt_folder(output_base_folder, prompt_type)
+        for item in items:
+            if prompt_type not in item["initial_captions"]:
+                continue
+            refined_caption_path = os.path.join(output_folder, f"{item['base_name']}.txt")
+            caption = rewrite_locally(item["initial_captions"][prompt_type], refined_caption_path, item["base_name"])
+            if caption is None:
+                saved = concurrent.futures.Future()
+                saved.set_result(True)
+            else:
+                saved = refine_and_save(caption, refined_caption_path, item["base_name"], gpt_prompt)
+                refinements.append(saved)
+            item["saved"].append(saved)
+    return refinements
+
+def refine_pending_in_batch(output_base_folder, prompt_configs, batch_backend, poll_interval=30):
+    """
+    Refine every pending initial caption of every prompt type through one Batch API job.
+    """
+    requests = []
+    for prompt_type, gpt_prompt in prompt_configs.items():
+        output_folder = get_prompt_folder(output_base_folder, prompt_type)
+        for base_name, initial_caption_path, refined_caption_path in output.iter_pending(output_folder):
+            initial_caption = output.read(initial_caption_path)
+            if not initial_caption:
+                continue
+            initial_caption = rewrite_locally(initial_caption, refined_caption_path, base_name)
+            if initial_caption is None:
+                continue
+            messages = build_refinement_messages(initial_caption, gpt_prompt)
+            key = caption_cache.make_key("refine", GPT_MODEL, messages)
+            cached_caption = cache.get(key)
+            if cached_caption is not None:
+                save_refined_caption(cached_caption, refined_caption_path, base_name)
+                continue
+            requests.append({
+                "custom_id": f"{os.path.basename(output_folder)}/{base_name}",
+                "messages": messages,
+                "output_path": refined_caption_path,
+                "cache_key": key,
+            })
+
+    batch_refine.run_batch_refinement(
+        requests, batch_backend, os.path.join(output_base_folder, "batch_manifest.json"), GPT_MODEL,
+        poll_interval=poll_interval, cache=cache, write_output=output.write
+    )
+
+def main(input_folder, output_base_folder, prompt_configs, batch_size=1, decode_workers=4, batch_backend=None, batch_poll_interval=30, recursive=True, sniff=False):
+    """
+    Main function to process all images in the input folder with every prompt type in a single pass.
+
+    With a batch_backend, captions are refined through one Batch API job after captioning
+    instead of one chat completion per caption.
     """
     # Create a separate subfolder for each prompt type
-    prompt_folder_name = prompt_type.strip('<>').replace('>', '').replace('<', '')
-    output_folder = os.path.join(output_base_folder, prompt_folder_name)
-    os.makedirs(output_folder, exist_ok=True)
-    
-    # Define supported image extensions
-    image_extensions = ('*.png', '*.jpg', '*.jpeg', '*.bmp', '*.gif', '*.tiff')
-    image_files = []
-    for ext in image_extensions:
-        image_files.extend(glob.glob(os.path.join(input_folder, ext)))
-    
-    if not image_files:
+    for prompt_type in prompt_configs:
+        os.makedirs(get_prompt_folder(output_base_folder, prompt_type), exist_ok=True)
+
+    # Stream image paths from the input tree so inference starts on the first image
+    image_files = image_scanner.iter_image_files(input_folder, recursive=recursive, sniff=sniff)
+
+    # Hashes of images written by normalize-images.py, so cached images need not be read
+    normalized_images = image_manifest.load_image_manifest(input_folder) or {}
+
+    processed, _ = caption_images(
+        image_files, input_folder, output_base_folder, prompt_configs, normalized_images,
+        batch_size=batch_size, decode_workers=decode_workers, refine=batch_backend is None
+    )
+
+    if not processed:
         logging.warning("No image files found in the specified folder.")
         return
-    
-    # Process each image
-    for image_path in image_files:
-        base_name = os.path.splitext(os.path.basename(image_path))[0]
-        run_inference_on_image(image_path, output_folder, base_name, task_prompt=prompt_type, gpt_prompt=gpt_prompt)
+
+    if batch_backend is not None:
+        refine_pending_in_batch(output_base_folder, prompt_configs, batch_backend, poll_interval=batch_poll_interval)
+
+def caption_images(image_files, input_folder, output_base_folder, prompt_configs, normalized_images, batch_size=1, decode_workers=4, refine=True, on_batch=None):
+    """
+    Caption an iterable of image paths; returns (number of images, futures of refinements in flight).
+
+    on_batch, if given, is called with each batch of prepared items once their refinements are queued.
+    """
+    # Decode and preprocess upcoming batches on a worker pool while the model runs on the current one
+    batches = prefetch.prefetch_batches(
+        florence_engine.batched(image_files, batch_size),
+        lambda image_path: prepare_image(image_path, input_folder, output_base_folder, prompt_configs, normalized_images.get(image_path)),
+        num_workers=decode_workers
+    )
+    processed = 0
+    refinements = []
+    for items in batches:
+        processed += len(items)
+        if profiler is not None:
+            profiler.count("images", len(items))
+        # Keep only the refinements still in flight so long runs do not hold every future
+        refinements = [future for future in refinements if not future.done()]
+        refinements += run_inference_on_batch(items, output_base_folder, prompt_configs, refine=refine)
+        output.flush()
+        if on_batch is not None:
+            on_batch(items)
+    return processed, refinements
+
+def run_shard_worker(input_folder, output_base_folder, prompt_configs, shards, batch_size=1, decode_workers=4, batch_backend=None, batch_poll_interval=30, recursive=True, sniff=False, shard_size=64):
+    """
+    Caption shards leased from a shard_queue.ShardQueue until none are left.
+
+    Any number of these workers, in processes on this machine or on machines
+    sharing the input, output and shard folders, split one run between them;
+    the model is loaded once per worker. A shard is marked done only after its
+    refined captions are saved, so a crashed worker's shard is redone in full by
+    whichever worker reclaims its lease. Rerunning after images were added
+    captions just the new ones. With a batch_backend, the worker that finds
+    every shard finished submits the one Batch API job for the run.
+    """
+    for prompt_type in prompt_configs:
+        os.makedirs(get_prompt_folder(output_base_folder, prompt_type), exist_ok=True)
+    normalized_images = image_manifest.load_image_manifest(input_folder) or {}
+
+    # Shard paths are relative, so machines may mount the input folder at different paths
+    shards.plan(
+        (os.path.relpath(image_path, input_folder) for image_path in image_scanner.iter_image_files(input_folder, recursive=recursive, sniff=sniff)),
+        shard_size=shard_size
+    )
+    processed = 0
+    with shards:
+        while True:
+            claimed = shards.claim()
+            if claimed is None:
+                break
+            shard_id, relative_paths = claimed
+            started = time.time()
+            try:
+                count, refinements = caption_images(
+                    [os.path.join(input_folder, relative_path) for relative_path in relative_paths],
+                    input_folder, output_base_folder, prompt_configs, normalized_images,
+                    batch_size=batch_size, decode_workers=decode_workers, refine=batch_backend is None
+                )
+                concurrent.futures.wait(refinements)
+                # The shard is never leased again once complete, so its captions must be committed first
+                output.flush()
+            except Exception as e:
+                logging.error(f"Shard {shard_id} failed: {e}")
+                shards.fail(shard_id, str(e))
+                continue
+            shards.complete(shard_id, images=count, seconds=time.time() - started)
+            processed += count
+            done, failed, total = shards.progress()
+            logging.info(f"Finished shard {shard_id} ({count} image(s)); {done + failed}/{total} shard(s) finished overall.")
+
+        done, failed, total = shards.progress()
+        logging.info(f"Worker {shards.owner} captioned {processed} image(s); {done}/{total} shard(s) done, {failed} failed.")
+        if failed:
+            logging.warning(f"{failed} shard(s) failed; delete {os.path.join(shards.shard_dir, 'failed')} and rerun to retry them.")
+        # Named after the plan size, so a rerun that appended shards refines their captions too
+        batch_step = f"batch_refine-{total}"
+        if batch_backend is not None and shards.claim_once(batch_step):
+            try:
+                refine_pending_in_batch(output_base_folder, prompt_configs, batch_backend, poll_interval=batch_poll_interval)
+            except BaseException:
+                shards.release_once(batch_step)
+                raise
+            shards.finish_once(batch_step)
+
+def launch_shard_workers(num_workers, extra_args=()):
+    """
+    Start num_workers copies of this script as single shard workers and wait for them.
+
+    Each copy gets an equal share of the CPU threads and, on multi-GPU machines,
+    its own GPU. extra_args are appended to every copy's command line.
+    """
+    environment = os.environ.copy()
+    gpu_count = torch.cuda.device_count() if torch.cuda.is_available() else 0
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+    processes = []
+    for index in range(num_workers):
+        worker_environment = dict(environment)
+        worker_environment.setdefault("OMP_NUM_THREADS", str(threads))
+        worker_environment["SHARD_WORKER_INDEX"] = str(index)
+        if gpu_count > 1 and "CUDA_VISIBLE_DEVICES" not in environment:
+            worker_environment["CUDA_VISIBLE_DEVICES"] = str(index % gpu_count)
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), *sys.argv[1:], *extra_args, "--workers", "1"], env=worker_environment))
+    failures = 0
+    try:
+        for process in processes:
+            failures += process.wait() != 0
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        raise
+    if failures:
+        logging.error(f"{failures} worker process(es) exited with an error; shards they held are redone by the others or on the next run.")
+    return failures
+
+def watch_folder(input_folder, output_base_folder, prompt_configs, batch_size=1, decode_workers=4, recursive=True, sniff=False, debounce=2.0, poll_interval=5.0, use_inotify=True):
+    """
+    Keep the model loaded and caption images as they land in the input folder, until SIGINT or SIGTERM.
+
+    Only images that are new or changed since <output_base_folder>/watch_checkpoint.jsonl
+    are captioned, including after a restart. An image is checkpointed once all
+    of its refined captions are saved, or as failed (and retried on restart) if
+    decoding, captioning or a refinement failed; the seconds from it landing to that point
+    are logged and recorded as the landed_to_caption stage of the profile.
+    """
+    for prompt_type in prompt_configs:
+        os.makedirs(get_prompt_folder(output_base_folder, prompt_type), exist_ok=True)
+    watcher = folder_watcher.FolderWatcher(
+        input_folder, os.path.join(output_base_folder, "watch_checkpoint.jsonl"), recursive=recursive, sniff=sniff,
+        debounce=debounce, poll_interval=poll_interval, use_inotify=use_inotify, profiler=profiler
+    )
+    # Stop after the current batch and drain its refinements instead of dying mid-write
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: watcher.stop())
+
+    def checkpoint_when_saved(watched_file, item):
+        """
+        Checkpoint a file once its refined captions are saved, as failed if it was not captioned for every prompt type.
+
+        Returns a future that resolves once the file is checkpointed. Futures
+        wake their waiters before running done callbacks, so waiting on the
+        refinements alone could close the checkpoint while this is still writing it.
+        """
+        captioned = item is not None and all(item["initial_captions"].get(prompt_type) for prompt_type in prompt_configs)
+        saved = item["saved"] if captioned else []
+        remaining = [len(saved)]
+        lock = threading.Lock()
+        checkpointed = concurrent.futures.Future()
+
+        def finished(_=None):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                if captioned and all(future.result() for future in saved):
+                    output.flush()
+                    latency = watcher.mark(watched_file)
+                    if latency is not None:
+                        logging.info(f"Captioned {watched_file.relative_path} {latency:.1f}s after it landed.")
+                else:
+                    # Not checkpointed as done, so it is captioned again after a restart or when it changes
+                    watcher.mark(watched_file, status="failed")
+                    logging.warning(f"Captioning {watched_file.relative_path} failed.")
+            finally:
+                checkpointed.set_result(None)
+
+        if not saved:
+            remaining[0] = 1
+            finished()
+        for future in saved:
+            future.add_done_callback(finished)
+        return checkpointed
+
+    normalized_images, manifest_signature = {}, None
+    in_flight = []
+    with watcher:
+        try:
+            for watched_files in watcher.batches():
+                # Reread the normalize-images.py manifest only when it changed
+                signature = folder_watcher.file_signature(os.path.join(input_folder, image_manifest.MANIFEST_NAME))
+                if signature != manifest_signature:
+                    normalized_images, manifest_signature = image_manifest.load_image_manifest(input_folder) or {}, signature
+                logging.info(f"Captioning {len(watched_files)} new or changed image(s).")
+                items = []
+                _, refinements = caption_images(
+                    [watched_file.path for watched_file in watched_files], input_folder, output_base_folder, prompt_configs,
+                    normalized_images, batch_size=batch_size, decode_workers=decode_workers, on_batch=items.extend
+                )
+                items_by_path = {item["image_path"]: item for item in items}
+                in_flight = [future for future in in_flight if not future.done()] + [
+                    checkpoint_when_saved(watched_file, items_by_path.get(watched_file.path)) for watched_file in watched_files
+                ]
+        finally:
+            # Checkpoint what is still being refined before the checkpoint file closes
+            concurrent.futures.wait(in_flight)
+    logging.info("Stopped watching.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process captions with specific prompt types.")
@@ -145,11 +601,65 @@ if __name__ == "__main__":
     parser.add_argument("input_folder", type=str, help="Path to the input folder containing images or captions.")
     parser.add_argument("output_base_folder", type=str, help="Path to the base folder for saving output captions.")
 
+    # Optional arguments
+    parser.add_argument("--model", choices=sorted(florence_engine.FLORENCE_MODELS), default="large", help="Florence-2 checkpoint to caption with.")
+    parser.add_argument("--cpu-fast", choices=florence_engine.CPU_FAST_PATHS, default=None, help="CPU fast path: dynamic int8 quantization or bfloat16 weights.")
+    parser.add_argument("--backend", choices=florence_engine.BACKENDS, default="torch", help="Run Florence-2 with PyTorch or with ONNX Runtime on graphs from export-florence-onnx.py.")
+    parser.add_argument("--onnx-dir", type=str, default=None, help="Folder written by export-florence-onnx.py (required with --backend onnx).")
+    parser.add_argument(
+        "--decoding-profile", action="append", default=[], metavar="[TASK=]PROFILE",
+        help=f"Decoding profile for every task or for one task, e.g. '<CAPTION>=greedy-short'. Profiles: {', '.join(florence_engine.DECODING_PROFILES)}."
+    )
+    parser.add_argument("--batch-size", type=int, default=1, help="Number of images to caption per model.generate call.")
+    parser.add_argument("--decode-workers", type=int, default=4, help="Number of threads decoding and preprocessing images ahead of the model.")
+    parser.add_argument("--no-recursive", action="store_true", help="Only caption images directly inside the input folder.")
+    parser.add_argument("--sniff", action="store_true", help="Skip files whose magic bytes are not a supported image format.")
+    parser.add_argument("--gpt-concurrency", type=int, default=8, help="Maximum number of GPT refinement requests in flight.")
+    parser.add_argument("--gpt-rpm", type=int, default=500, help="GPT requests per minute limit.")
+    parser.add_argument("--gpt-tpm", type=int, default=30000, help="GPT tokens per minute limit.")
+    parser.add_argument("--refine-mode", choices=["async", "batch"], default="async", help="Refine captions one request at a time (async) or through the Batch API (batch).")
+    parser.add_argument("--batch-backend", choices=["openai", "local"], default="openai", help="Batch backend; 'local' is a file-based stand-in for offline runs.")
+    parser.add_argument("--batch-dir", type=str, default=None, help="Working directory of the local batch backend (default: <output_base_folder>/local_batches).")
+    parser.add_argument("--batch-poll-interval", type=float, default=30, help="Seconds between batch status polls.")
+    parser.add_argument("--cache-dir", type=str, default=caption_cache.DEFAULT_CACHE_DIR, help="Directory of the content-addressed caption cache.")
+    parser.add_argument("--cache-max-mb", type=int, default=1024, help="Evict least recently used cache entries beyond this size.")
+    parser.add_argument("--local-rewrite", choices=["off", "before-gpt", "only"], default="off", help="Rule-based trigger-word rewrite after captioning: 'before-gpt' only calls GPT for captions the rules leave unchanged or flag, 'only' never calls GPT.")
+    parser.add_argument("--trigger-word", type=str, default=trigger_rewriter.DEFAULT_TRIGGER, help="Trigger word the local rewriter substitutes for the watch and its model names.")
+    parser.add_argument("--trigger-names", type=str, default=None, help="Text file of extra model names (one per line) for the local rewriter; like the built-in ones, they are only replaced when capitalized as listed and next to a brand name or 'watch'.")
+    parser.add_argument("--profile-report", type=str, default=None, help="Write per-stage timings, token counts and peak memory to this .json or .csv file at the end of the run.")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve the live per-stage metrics in Prometheus text format at http://0.0.0.0:PORT/metrics.")
+    parser.add_argument("--store", type=str, default=None, help="Write captions into this SQLite caption store instead of .txt files; export them with export-captions.py.")
+    parser.add_argument("--workers", type=int, default=1, help="Caption with this many worker processes pulling shards of images; each loads the model once.")
+    parser.add_argument("--shard-dir", type=str, default=None, help="Shard queue folder; workers on other machines join the run by pointing at the same folder on a shared filesystem (default with --workers > 1: <output_base_folder>/.shards).")
+    parser.add_argument("--shard-size", type=int, default=64, help="Images per shard.")
+    parser.add_argument("--lease-timeout", type=float, default=300, help="Seconds without a heartbeat after which a worker's shard is reclaimed.")
+    parser.add_argument("--watch", action="store_true", help="Keep running and caption images as they land in the input folder; a checkpoint skips captioned, unchanged images across restarts.")
+    parser.add_argument("--debounce", type=float, default=2.0, help="With --watch, seconds a file must stay unchanged before it is captioned.")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="With --watch, seconds between scans when inotify is unavailable.")
+    parser.add_argument("--no-inotify", action="store_true", help="With --watch, poll the input folder instead of using inotify, e.g. on network filesystems.")
+    parser.add_argument("--dedupe-index", type=str, default=None, help="Add refined captions to this near-duplicate index (see dedupe-index.py) as they are saved and warn about near-duplicates.")
+    parser.add_argument("--openai-base-url", type=str, default=None, help="OpenAI-compatible API base URL, e.g. a local stub server.")
+    parser.add_argument(
+        "--prompt-types", nargs="+", default=["<CAPTION>", "<DETAILED_CAPTION>", "<MORE_DETAILED_CAPTION>"],
+        help="Florence-2 task prompts to run; the vision encoding of each image is shared by all of them."
+    )
+
     # Parse arguments
     args = parser.parse_args()
 
     input_folder = args.input_folder
     output_base_folder = args.output_base_folder
+
+    if args.watch and (args.workers > 1 or args.shard_dir or args.refine_mode == "batch"):
+        parser.error("--watch runs a single worker with --refine-mode async.")
+
+    if args.workers > 1:
+        # Split the GPT rate limits between the workers; each one runs its own refinement stage
+        sys.exit(1 if launch_shard_workers(args.workers, [
+            "--gpt-rpm", str(max(1, args.gpt_rpm // args.workers)),
+            "--gpt-tpm", str(max(1, args.gpt_tpm // args.workers)),
+            "--shard-dir", args.shard_dir or os.path.join(output_base_folder, ".shards"),
+        ]) else 0)
     
     # Define prompt types and their corresponding GPT prompts
     prompt_configs = {
@@ -170,10 +680,111 @@ if __name__ == "__main__":
         )
     }
     
-    # List of prompt types to process
-    prompt_types = ["<CAPTION>", "<DETAILED_CAPTION>", "<MORE_DETAILED_CAPTION>"]
-    # prompt_types = ["<MORE_DETAILED_CAPTION>"]
-    
-    for prompt_type in prompt_types:
-        gpt_prompt = prompt_configs.get(prompt_type, "Refine the following caption to make it more natural and human-like.")
-        main(input_folder, output_base_folder, prompt_type, gpt_prompt)
+    # List of prompt types to process, all in one pass through the images
+    prompt_types = args.prompt_types
+
+    selected_configs = {
+        prompt_type: prompt_configs.get(prompt_type, "Refine the following caption to make it more natural and human-like.")
+        for prompt_type in prompt_types
+    }
+
+    # Defer loading Florence-2 until the first image that is not in the cache
+    if args.backend == "onnx" and not args.onnx_dir:
+        parser.error("--backend onnx needs --onnx-dir.")
+    florence = florence_engine.LazyFlorence(
+        florence_engine.FLORENCE_MODELS[args.model], cpu_fast=args.cpu_fast, backend=args.backend, onnx_dir=args.onnx_dir
+    )
+    try:
+        decoding_profiles = florence_engine.parse_decoding_profiles(args.decoding_profile, prompt_types)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Rule-based rewriter that replaces the GPT trigger-word pass where it can
+    local_rewrite_mode = args.local_rewrite
+    if local_rewrite_mode != "off":
+        model_names = list(trigger_rewriter.DEFAULT_MODEL_NAMES)
+        if args.trigger_names:
+            model_names += trigger_rewriter.load_model_names(args.trigger_names)
+        rewriter = trigger_rewriter.CaptionRewriter(trigger=args.trigger_word, model_names=model_names)
+
+    # Open the caption cache shared by the Florence and refinement stages
+    cache = caption_cache.CaptionCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024)
+
+    # Captions go to one .txt file each, or into a caption store with one collection per prompt type
+    # Shard workers share one store, so each commits every write instead of holding the write lock for a group
+    output = caption_store.open_caption_output(
+        output_base_folder, args.store, collections=[get_prompt_folder_name(prompt_type) for prompt_type in prompt_types],
+        commit_every=1 if args.shard_dir else 256
+    )
+
+    if args.dedupe_index:
+        dedupe = dedupe_index.DuplicateIndex(args.dedupe_index)
+
+    # Pick the batch backend for --refine-mode batch
+    batch_backend = None
+    if args.refine_mode == "batch" and local_rewrite_mode != "only":
+        if args.batch_backend == "local":
+            batch_backend = batch_refine.LocalBatchBackend(args.batch_dir or os.path.join(output_base_folder, "local_batches"))
+        else:
+            batch_backend = batch_refine.OpenAIBatchBackend(openai.OpenAI(base_url=args.openai_base_url))
+
+    # Run as one worker of a sharded run, or caption the whole input in this process
+    run = main
+    if args.shard_dir:
+        shards = shard_queue.ShardQueue(args.shard_dir, lease_timeout=args.lease_timeout)
+        run = functools.partial(run_shard_worker, shards=shards, shard_size=args.shard_size)
+    elif args.watch:
+        run = functools.partial(watch_folder, debounce=args.debounce, poll_interval=args.poll_interval, use_inotify=not args.no_inotify)
+
+    # Time every stage; the report is written and summarized when the run ends
+    profiler = profiling.StageProfiler()
+    profile_report = args.profile_report
+    metrics_port = args.metrics_port
+    if args.shard_dir:
+        # Workers of a sharded run each report and serve their own metrics
+        worker_index = int(os.environ.get("SHARD_WORKER_INDEX", 0))
+        if profile_report:
+            stem, extension = os.path.splitext(profile_report)
+            profile_report = f"{stem}.{shard_queue.worker_name().replace(':', '-')}{extension}"
+        if metrics_port is not None:
+            metrics_port += worker_index
+    if metrics_port is not None:
+        profiling.serve_metrics(profiler, metrics_port)
+    profiler.start()
+    try:
+        if batch_backend is not None:
+            run(
+                input_folder, output_base_folder, selected_configs, batch_size=args.batch_size, decode_workers=args.decode_workers,
+                batch_backend=batch_backend, batch_poll_interval=args.batch_poll_interval,
+                recursive=not args.no_recursive, sniff=args.sniff
+            )
+        elif local_rewrite_mode == "only":
+            # Every caption is finished locally, so no GPT client is needed
+            run(
+                input_folder, output_base_folder, selected_configs, batch_size=args.batch_size, decode_workers=args.decode_workers,
+                recursive=not args.no_recursive, sniff=args.sniff
+            )
+        else:
+            # Start the async GPT refinement stage; it runs while captioning continues
+            refiner = refine_stage.AsyncRefiner(
+                openai.AsyncOpenAI(base_url=args.openai_base_url, max_retries=0),
+                GPT_MODEL,
+                concurrency=args.gpt_concurrency,
+                requests_per_minute=args.gpt_rpm,
+                tokens_per_minute=args.gpt_tpm,
+                profiler=profiler
+            )
+            with refiner:
+                run(
+                    input_folder, output_base_folder, selected_configs, batch_size=args.batch_size, decode_workers=args.decode_workers,
+                    recursive=not args.no_recursive, sniff=args.sniff
+                )
+    finally:
+        profiler.stop()
+        logging.info("Stage profile:\n" + profiler.summary())
+        if profile_report:
+            profiler.write_report(profile_report)
+        output.close()
+        cache.close()
+        if dedupe is not None:
+            dedupe.close()
@@ -0,0 +1,332 @@
+import os
+import time
+import logging
+import threading
+import torch
+import profiling
+from itertools import islice
+
+# Florence-2 checkpoints selectable with --model
+FLORENCE_MODELS = {
+    "base": "microsoft/Florence-2-base",
+    "large": "microsoft/Florence-2-large",
+}
+
+# CPU fast paths selectable with --cpu-fast
+CPU_FAST_PATHS = ("int8", "bf16")
+
+# Inference backends selectable with --backend; "onnx" runs graphs from export-florence-onnx.py
+BACKENDS = ("torch", "onnx")
+
+# Decoding profiles selectable per task with --decoding-profile; "default" is the original beam search
+DECODING_PROFILES = {
+    "default": {"num_beams": 3, "max_new_tokens": 1024, "early_stopping": False},
+    "beam3-short": {"num_beams": 3, "max_new_tokens": 256, "early_stopping": True},
+    "beam2-short": {"num_beams": 2, "max_new_tokens": 256, "early_stopping": True},
+    "greedy": {"num_beams": 1, "max_new_tokens": 1024, "early_stopping": False},
+    "greedy-short": {"num_beams": 1, "max_new_tokens": 128, "early_stopping": False},
+}
+DEFAULT_PROFILE = "default"
+
+
+def parse_decoding_profiles(specs, task_prompts):
+    """
+    Map each task prompt to a decoding profile name from --decoding-profile specs.
+
+    A spec is either a profile name applied to every task ("greedy") or
+    TASK=PROFILE for one task ("<CAPTION>=greedy-short"); later specs win.
+    """
+    task_profiles = {task_prompt: DEFAULT_PROFILE for task_prompt in task_prompts}
+    for spec in specs or []:
+        task_prompt, _, profile_name = spec.rpartition("=")
+        if profile_name not in DECODING_PROFILES:
+            raise ValueError(f"Unknown decoding profile {profile_name!r}; choose from {', '.join(DECODING_PROFILES)}.")
+        if task_prompt:
+            task_profiles[task_prompt] = profile_name
+        else:
+            task_profiles = {task: profile_name for task in task_profiles}
+    return task_profiles
+
+
+def decoding_arguments(profile):
+    """
+    Turn a decoding profile into model.generate arguments.
+    """
+    decoding = dict(DECODING_PROFILES[DEFAULT_PROFILE], **(profile or {}))
+    if decoding["num_beams"] == 1:
+        # Greedy search; early_stopping only applies to beam search
+        decoding.pop("early_stopping")
+        decoding["do_sample"] = False
+    return decoding
+
+
+def batched(iterable, batch_size):
+    """
+    Yield successive lists of at most batch_size items from the iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class FirstTokenTimer:
+    """
+    Logits processor that records when generate() scores its first token.
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+        self.reported = False
+
+    def __call__(self, input_ids, scores):
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        return scores
+
+
+class LazyFlorence:
+    """
+    Florence-2 model and processor that are only loaded on first use.
+
+    Nothing is loaded for --help or when every caption is served from the cache.
+    On CPU, cpu_fast selects dynamic int8 quantization of the Linear layers or
+    bfloat16 weights. backend="onnx" runs the graphs exported to onnx_dir by
+    export-florence-onnx.py with ONNX Runtime instead of PyTorch, using the fp32
+    graphs rather than the int8 ones if onnx_fp32. The load time
+    and the latency of the first generated token are logged once. Safe to access
+    from several threads.
+    """
+
+    def __init__(self, model_id, cpu_fast=None, backend="torch", onnx_dir=None, onnx_fp32=False):
+        self.model_id = model_id
+        self.backend = backend
+        self.onnx_dir = onnx_dir
+        self.onnx_fp32 = onnx_fp32
+        self.onnx_quantize = None
+        if backend == "onnx":
+            import florence_onnx
+
+            export_config = florence_onnx.read_export_config(onnx_dir)
+            self.onnx_quantize = "none" if onnx_fp32 else export_config["quantize"]
+            if export_config["model_id"] != model_id:
+                logging.warning(f"{onnx_dir} was exported from {export_config['model_id']}, not {model_id}.")
+            if cpu_fast:
+                logging.warning(f"Ignoring --cpu-fast {cpu_fast} with the onnx backend.")
+                cpu_fast = None
+        self.device = "cuda:0" if torch.cuda.is_available() and backend == "torch" else "cpu"
+        self.cpu_fast = cpu_fast if self.device == "cpu" else None
+        if cpu_fast and self.device != "cpu":
+            logging.warning(f"Ignoring --cpu-fast {cpu_fast} on {self.device}.")
+        if self.device != "cpu":
+            self.torch_dtype = torch.float16
+        elif self.cpu_fast == "bf16":
+            self.torch_dtype = torch.bfloat16
+        else:
+            self.torch_dtype = torch.float32
+        self.lock = threading.Lock()
+        self._model = None
+        self._processor = None
+        self.first_token_timer = None
+
+    @property
+    def cache_id(self):
+        """
+        Identify the checkpoint and numeric variant in caption cache keys.
+        """
+        if self.backend == "onnx":
+            return f"{self.model_id}:onnx-{self.onnx_quantize}"
+        return f"{self.model_id}:{self.cpu_fast}" if self.cpu_fast else self.model_id
+
+    @property
+    def model(self):
+        if self._model is None:
+            self.load()
+        return self._model
+
+    @property
+    def processor(self):
+        if self._processor is None:
+            self.load()
+        return self._processor
+
+    def load(self):
+        with self.lock:
+            if self._model is not None:
+                return
+            from transformers import AutoProcessor, AutoModelForCausalLM
+
+            start_time = time.perf_counter()
+            if self.backend == "onnx":
+                import florence_onnx
+
+                # ONNX Runtime sizes its own thread pool; honour the share a sharded run gives each worker
+                threads = int(os.environ["OMP_NUM_THREADS"]) if os.environ.get("OMP_NUM_THREADS") else None
+                model = florence_onnx.OnnxFlorenceModel(self.onnx_dir, threads=threads, fp32=self.onnx_fp32)
+            else:
+                model = AutoModelForCausalLM.from_pretrained(
+                    self.model_id,
+                    torch_dtype=self.torch_dtype,
+                    trust_remote_code=True
+                ).to(self.device)
+                if self.cpu_fast == "int8":
+                    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                model.eval()
+            self._processor = AutoProcessor.from_pretrained(
+                self.model_id,
+                trust_remote_code=True
+            )
+            self._model = model
+            logging.info(
+                f"Loaded {self.model_id} on {self.device} ({self.cache_id if self.backend == 'onnx' else self.cpu_fast or self.torch_dtype}) "
+                f"in {time.perf_counter() - start_time:.2f}s."
+            )
+
+    def generate_kwargs(self):
+        """
+        Extra model.generate arguments; the first call gets a timer for the first-token latency.
+        """
+        if self.first_token_timer is not None:
+            return {}
+        from transformers import LogitsProcessorList
+
+        self.first_token_timer = FirstTokenTimer()
+        return {"logits_processor": LogitsProcessorList([self.first_token_timer])}
+
+    def report_first_token(self):
+        timer = self.first_token_timer
+        if timer is not None and timer.first_token_time is not None and not timer.reported:
+            timer.reported = True
+            logging.info(f"First-token latency {timer.first_token_time - timer.start_time:.2f}s.")
+
+
+def preprocess_images(processor, images):
+    """
+    Resize and normalize PIL images into a pixel_values tensor with the Florence-2 image processor.
+    """
+    return processor.image_processor(images, return_tensors="pt")["pixel_values"]
+
+
+def encode_images(model, pixel_values, device, torch_dtype):
+    """
+    Run the vision tower once over a batch of pixel_values and return the image features.
+
+    The features can be reused by decode_captions for any number of task prompts,
+    so multi-task runs only pay for PIL decode and the DaViT encoder once per image.
+    """
+    if getattr(model, "is_onnx", False):
+        return model.encode_images(pixel_values)
+    with torch.inference_mode():
+        return model._encode_image(pixel_values.to(device, torch_dtype))
+
+
+def decode_captions(model, processor, image_features, image_sizes, task_prompt, device, profile=None, generate_kwargs=None, profiler=None):
+    """
+    Decode captions for a task prompt from image features produced by encode_images.
+
+    The prompts are tokenized and padded together, the generated ids are decoded
+    with a single processor.batch_decode, and post_process_generation runs per item
+    with that item's own (width, height) image size. profile is a decoding profile
+    dict (see DECODING_PROFILES); the default is beam search with 3 beams. With a
+    profiling.StageProfiler, generate and post-processing are timed and the
+    prompt and generated token counts are recorded.
+    """
+    if getattr(model, "is_onnx", False):
+        return model.decode_captions(processor, image_features, image_sizes, task_prompt, profile=profile, profiler=profiler)
+    prompts = processor._construct_prompts([task_prompt] * len(image_sizes))
+    input_ids = processor.tokenizer(prompts, return_tensors="pt", padding=True)["input_ids"].to(device)
+    with profiling.timed(profiler, "generate", len(image_sizes)), torch.inference_mode():
+        inputs_embeds = model.get_input_embeddings()(input_ids)
+        inputs_embeds, attention_mask = model._merge_input_ids_with_image_features(image_features, inputs_embeds)
+        generated_ids = model.generate(
+            input_ids=None,
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            **decoding_arguments(profile),
+            **(generate_kwargs or {})
+        )
+    if profiler is not None:
+        pad_token_id = processor.tokenizer.pad_token_id
+        profiler.add_tokens(
+            "generate",
+            prompt=int(attention_mask.sum()),
+            completion=int((generated_ids != pad_token_id).sum()) if pad_token_id is not None else generated_ids.numel()
+        )
+
+    with profiling.timed(profiler, "post_process", len(image_sizes)):
+        generated_texts = processor.batch_decode(generated_ids, skip_special_tokens=False)
+        captions = []
+        for image_size, generated_text in zip(image_sizes, generated_texts):
+            parsed_answer = processor.post_process_generation(
+                generated_text,
+                task=task_prompt,
+                image_size=image_size
+            )
+            captions.append(parsed_answer.get(task_prompt, generated_text))  # Safeguard in case key is missing
+    return captions
+
+
+def generate_captions(model, processor, images, task_prompt, device, torch_dtype, profile=None):
+    """
+    Generate captions for a batch of PIL images with a single task prompt.
+    """
+    if not images:
+        return []
+    pixel_values = preprocess_images(processor, images)
+    image_sizes = [(image.width, image.height) for image in images]
+    return generate_multi_task_captions(
+        model, processor, pixel_values, image_sizes, [task_prompt], device, torch_dtype,
+        task_profiles={task_prompt: profile}
+    )[task_prompt]
+
+
+def generate_multi_task_captions(model, processor, pixel_values, image_sizes, task_prompts, device, torch_dtype, task_profiles=None, task_indices=None, generate_kwargs=None, profiler=None):
+    """
+    Generate captions for a batch of preprocessed images for several task prompts.
+
+    The images are encoded once and the cached image features are shared by the
+    text decode of every task prompt. image_sizes holds the original (width, height)
+    of each image for post-processing. Returns a dict mapping each task prompt to
+    the list of captions, in the same order as the images. If task_indices maps a
+    task prompt to a list of image indices, only those images are decoded for that
+    task and its captions follow the order of the indices. task_profiles maps a
+    task prompt to its decoding profile dict. profiler, a profiling.StageProfiler,
+    times the encode, generate and post_process stages.
+    """
+    if not image_sizes:
+        return {task_prompt: [] for task_prompt in task_prompts}
+    task_indices = task_indices or {}
+    task_profiles = task_profiles or {}
+
+    start_time = time.perf_counter()
+    with profiling.timed(profiler, "encode", len(image_sizes)):
+        image_features = encode_images(model, pixel_values, device, torch_dtype)
+    logging.info(f"Encoded batch of {len(image_sizes)} image(s) in {time.perf_counter() - start_time:.2f}s.")
+
+    captions = {}
+    for task_prompt in task_prompts:
+        task_start_time = time.perf_counter()
+        indices = task_indices.get(task_prompt)
+        if indices is None:
+            task_features, task_sizes = image_features, image_sizes
+        elif not indices:
+            captions[task_prompt] = []
+            continue
+        else:
+            task_features = image_features[indices]
+            task_sizes = [image_sizes[i] for i in indices]
+        captions[task_prompt] = decode_captions(
+            model, processor, task_features, task_sizes, task_prompt, device,
+            profile=task_profiles.get(task_prompt), generate_kwargs=generate_kwargs, profiler=profiler
+        )
+        logging.info(f"Decoded {task_prompt} for {len(task_sizes)} image(s) in {time.perf_counter() - task_start_time:.2f}s.")
+
+    elapsed = time.perf_counter() - start_time
+    logging.info(
+        f"Captioned batch of {len(image_sizes)} image(s) for {len(task_prompts)} task(s) in {elapsed:.2f}s "
+        f"({len(image_sizes) / elapsed:.2f} images/sec)."
+    )
+    return captions
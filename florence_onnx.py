@@ -0,0 +1,422 @@
+import os
+import json
+import time
+import logging
+import numpy as np
+import florence_engine
+import profiling
+
+# Written next to the exported graphs; lists the graph files and the generation settings
+EXPORT_CONFIG = "config.json"
+
+# Which graphs get dynamic int8 weights with --quantize
+QUANTIZE_MODES = ("decoder", "all", "none")
+
+GRAPH_NAMES = ("vision_encoder", "text_encoder", "decoder_init", "decoder_with_past")
+
+
+def _require_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError("The onnx backend needs ONNX Runtime: pip install onnxruntime") from e
+    return onnxruntime
+
+
+def read_export_config(export_dir):
+    with open(os.path.join(export_dir, EXPORT_CONFIG), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def export_florence(model_id, output_dir, quantize="decoder", opset=17):
+    """
+    Export Florence-2 to four ONNX graphs in output_dir.
+
+    vision_encoder      pixel_values -> image_features (the DaViT tower and projection)
+    text_encoder        image_features, input_ids -> encoder_hidden_states, encoder_attention_mask
+                        (prompt embedding, the image/prompt merge and the BART encoder)
+    decoder_init        first decoder step; returns logits and the self- and cross-attention KV cache
+    decoder_with_past   one decoder step that reads and extends the KV cache
+
+    Splitting the decoder into a first step and a cached step means every later
+    token costs one position of self-attention instead of re-running the whole
+    prefix. With quantize="decoder" the text encoder and decoder MatMul weights
+    are stored as int8 (dynamic quantization); "all" also quantizes the vision
+    encoder. The fp32 graphs are kept so parity can be checked against them.
+    """
+    import torch
+    from transformers import AutoProcessor, AutoModelForCausalLM
+
+    if quantize not in QUANTIZE_MODES:
+        raise ValueError(f"Unknown quantize mode {quantize!r}; choose from {', '.join(QUANTIZE_MODES)}.")
+    os.makedirs(output_dir, exist_ok=True)
+    start_time = time.perf_counter()
+    model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.float32, trust_remote_code=True).eval()
+    processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
+    language_model = model.language_model
+    decoder = language_model.get_decoder()
+    num_layers = len(decoder.layers)
+
+    class VisionEncoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, pixel_values):
+            return self.model._encode_image(pixel_values)
+
+    class TextEncoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+            self.encoder = language_model.get_encoder()
+
+        def forward(self, image_features, input_ids):
+            inputs_embeds = self.model.get_input_embeddings()(input_ids)
+            inputs_embeds, attention_mask = self.model._merge_input_ids_with_image_features(image_features, inputs_embeds)
+            hidden_states = self.encoder(inputs_embeds=inputs_embeds, attention_mask=attention_mask, return_dict=True).last_hidden_state
+            return hidden_states, attention_mask
+
+    class DecoderStep(torch.nn.Module):
+        def __init__(self, with_past):
+            super().__init__()
+            self.decoder = decoder
+            self.lm_head = language_model.lm_head
+            self.final_logits_bias = language_model.final_logits_bias
+            self.with_past = with_past
+
+        def forward(self, input_ids, encoder_hidden_states, encoder_attention_mask, *past):
+            past_key_values = tuple(tuple(past[4 * i:4 * i + 4]) for i in range(num_layers)) if self.with_past else None
+            outputs = self.decoder(
+                input_ids=input_ids,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=encoder_attention_mask,
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True
+            )
+            logits = self.lm_head(outputs.last_hidden_state) + self.final_logits_bias
+            # The cross-attention cache never changes after the first step, so only the first step returns it
+            layer_outputs = [layer if not self.with_past else layer[:2] for layer in outputs.past_key_values]
+            return (logits, *[tensor for layer in layer_outputs for tensor in layer])
+
+    past_names = [f"past.{i}.{kind}.{part}" for i in range(num_layers) for kind in ("self", "cross") for part in ("key", "value")]
+    present_names = [name.replace("past.", "present.", 1) for name in past_names]
+    self_present_names = [name for name in present_names if ".self." in name]
+
+    # Trace with real shapes: one image and the <CAPTION> prompt
+    image_size = processor.image_processor.crop_size if hasattr(processor.image_processor, "crop_size") else None
+    height = (image_size or {}).get("height", 768)
+    width = (image_size or {}).get("width", 768)
+    pixel_values = torch.zeros(1, 3, height, width)
+    prompts = processor._construct_prompts(["<CAPTION>"])
+    input_ids = processor.tokenizer(prompts, return_tensors="pt", padding=True)["input_ids"]
+    decoder_input_ids = torch.tensor([[language_model.config.decoder_start_token_id]])
+
+    paths = {name: os.path.join(output_dir, f"{name}.onnx") for name in GRAPH_NAMES}
+    with torch.inference_mode():
+        image_features = VisionEncoder()(pixel_values)
+        encoder_hidden_states, encoder_attention_mask = TextEncoder()(image_features, input_ids)
+        first_step = DecoderStep(with_past=False)(decoder_input_ids, encoder_hidden_states, encoder_attention_mask)
+    past = first_step[1:]
+
+    exports = (
+        ("vision_encoder", VisionEncoder(), (pixel_values,), ["pixel_values"], ["image_features"],
+         {"pixel_values": {0: "batch"}, "image_features": {0: "batch"}}),
+        ("text_encoder", TextEncoder(), (image_features, input_ids), ["image_features", "input_ids"],
+         ["encoder_hidden_states", "encoder_attention_mask"],
+         {"image_features": {0: "batch"}, "input_ids": {0: "batch", 1: "prompt_length"},
+          "encoder_hidden_states": {0: "batch", 1: "encoder_length"}, "encoder_attention_mask": {0: "batch", 1: "encoder_length"}}),
+        ("decoder_init", DecoderStep(with_past=False), (decoder_input_ids, encoder_hidden_states, encoder_attention_mask),
+         ["input_ids", "encoder_hidden_states", "encoder_attention_mask"], ["logits"] + present_names,
+         dict({"input_ids": {0: "batch", 1: "decoder_length"}, "encoder_hidden_states": {0: "batch", 1: "encoder_length"},
+               "encoder_attention_mask": {0: "batch", 1: "encoder_length"}, "logits": {0: "batch", 1: "decoder_length"}},
+              **{name: {0: "batch", 2: "decoder_length" if ".self." in name else "encoder_length"} for name in present_names})),
+        ("decoder_with_past", DecoderStep(with_past=True), (decoder_input_ids, encoder_hidden_states, encoder_attention_mask, *past),
+         ["input_ids", "encoder_hidden_states", "encoder_attention_mask"] + past_names, ["logits"] + self_present_names,
+         dict({"input_ids": {0: "batch"}, "encoder_hidden_states": {0: "batch", 1: "encoder_length"},
+               "encoder_attention_mask": {0: "batch", 1: "encoder_length"}, "logits": {0: "batch"}},
+              **{name: {0: "batch", 2: "past_length" if ".self." in name else "encoder_length"} for name in past_names},
+              **{name: {0: "batch", 2: "total_length"} for name in self_present_names})),
+    )
+    for name, module, args, input_names, output_names, dynamic_axes in exports:
+        graph_start_time = time.perf_counter()
+        with torch.inference_mode():
+            torch.onnx.export(
+                module, args, paths[name], input_names=input_names, output_names=output_names,
+                dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True
+            )
+        logging.info(f"Exported {name} to {paths[name]} in {time.perf_counter() - graph_start_time:.1f}s.")
+
+    files = {name: os.path.basename(path) for name, path in paths.items()}
+    quantized = {"decoder": ("text_encoder", "decoder_init", "decoder_with_past"), "all": GRAPH_NAMES, "none": ()}[quantize]
+    if quantized:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        for name in quantized:
+            quantized_path = os.path.join(output_dir, f"{name}.int8.onnx")
+            # MatMul weights only; the embedding Gather stays fp32, which keeps captions close to the fp32 model
+            quantize_dynamic(paths[name], quantized_path, weight_type=QuantType.QInt8, op_types_to_quantize=["MatMul"])
+            files[name] = os.path.basename(quantized_path)
+            logging.info(f"Quantized {name} to int8 at {quantized_path}.")
+
+    generation_config = language_model.generation_config
+    config = {
+        "model_id": model_id,
+        "quantize": quantize,
+        "opset": opset,
+        "num_layers": num_layers,
+        "files": files,
+        "fp32_files": {name: os.path.basename(path) for name, path in paths.items()},
+        "generation": {
+            "decoder_start_token_id": language_model.config.decoder_start_token_id,
+            "bos_token_id": generation_config.bos_token_id,
+            "eos_token_id": generation_config.eos_token_id,
+            "pad_token_id": generation_config.pad_token_id,
+            "forced_bos_token_id": generation_config.forced_bos_token_id,
+            "forced_eos_token_id": generation_config.forced_eos_token_id,
+            "no_repeat_ngram_size": generation_config.no_repeat_ngram_size or 0,
+            "length_penalty": generation_config.length_penalty,
+        },
+    }
+    with open(os.path.join(output_dir, EXPORT_CONFIG), 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2)
+    logging.info(f"Exported {model_id} to {output_dir} in {time.perf_counter() - start_time:.1f}s.")
+    return config
+
+
+def _to_numpy(tensor, dtype):
+    if hasattr(tensor, "detach"):
+        tensor = tensor.detach().cpu().numpy()
+    return np.ascontiguousarray(tensor, dtype=dtype)
+
+
+def _log_softmax(logits):
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+
+class OnnxFlorenceModel:
+    """
+    Florence-2 exported by export_florence, run with ONNX Runtime on CPU.
+
+    Stands in for the PyTorch model in florence_engine.encode_images and
+    decode_captions (they check is_onnx), so the captioning scripts switch
+    backends without other changes. Decoding reproduces the generate() settings
+    used with the PyTorch model: greedy or beam search over the KV-cached
+    decoder, with the forced BOS/EOS tokens, no-repeat n-gram blocking and
+    length penalty from the checkpoint's generation config.
+    """
+
+    is_onnx = True
+
+    def __init__(self, export_dir, threads=None, fp32=False):
+        ort = _require_onnxruntime()
+        self.config = read_export_config(export_dir)
+        self.num_layers = self.config["num_layers"]
+        self.generation = self.config["generation"]
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        files = self.config["fp32_files"] if fp32 else self.config["files"]
+        self.sessions = {
+            name: ort.InferenceSession(os.path.join(export_dir, files[name]), options, providers=["CPUExecutionProvider"])
+            for name in GRAPH_NAMES
+        }
+        # Inputs a graph does not use may be pruned at export; only feed the ones it declares
+        self.input_names = {name: {i.name for i in session.get_inputs()} for name, session in self.sessions.items()}
+
+    def _run(self, name, feeds):
+        return self.sessions[name].run(None, {key: value for key, value in feeds.items() if key in self.input_names[name]})
+
+    def encode_images(self, pixel_values):
+        return self._run("vision_encoder", {"pixel_values": _to_numpy(pixel_values, np.float32)})[0]
+
+    def _decode_step(self, input_ids, encoder_hidden_states, encoder_attention_mask, past):
+        """
+        Run one decoder step; returns (logits of the last position, updated KV cache).
+        """
+        feeds = {"input_ids": input_ids, "encoder_hidden_states": encoder_hidden_states, "encoder_attention_mask": encoder_attention_mask}
+        if past is None:
+            outputs = self._run("decoder_init", feeds)
+            return outputs[0][:, -1], list(outputs[1:])
+        for i in range(self.num_layers):
+            feeds[f"past.{i}.self.key"], feeds[f"past.{i}.self.value"] = past[4 * i], past[4 * i + 1]
+            feeds[f"past.{i}.cross.key"], feeds[f"past.{i}.cross.value"] = past[4 * i + 2], past[4 * i + 3]
+        outputs = self._run("decoder_with_past", feeds)
+        past = list(past)
+        for i in range(self.num_layers):
+            past[4 * i], past[4 * i + 1] = outputs[1 + 2 * i], outputs[2 + 2 * i]
+        return outputs[0][:, -1], past
+
+    def _process_scores(self, input_ids, scores, cur_len, max_length):
+        """
+        Apply the no-repeat n-gram, forced BOS and forced EOS rules of the generation config in place.
+        """
+        n = self.generation["no_repeat_ngram_size"]
+        if n and cur_len + 1 >= n:
+            for row, tokens in enumerate(input_ids):
+                if n == 1:
+                    scores[row, tokens] = -np.inf
+                    continue
+                windows = np.lib.stride_tricks.sliding_window_view(tokens, n - 1)[:cur_len - n + 1]
+                matches = (windows == tokens[cur_len - n + 1:]).all(axis=1)
+                scores[row, tokens[n - 1:][matches]] = -np.inf
+        forced = None
+        if cur_len == 1 and self.generation["forced_bos_token_id"] is not None:
+            forced = self.generation["forced_bos_token_id"]
+        if cur_len == max_length - 1 and self.generation["forced_eos_token_id"] is not None:
+            forced = self.generation["forced_eos_token_id"]
+        if forced is not None:
+            scores[:] = -np.inf
+            scores[:, forced] = 0
+        return scores
+
+    def _greedy_search(self, encoder_hidden_states, encoder_attention_mask, max_length):
+        batch_size = encoder_hidden_states.shape[0]
+        eos, pad = self.generation["eos_token_id"], self.generation["pad_token_id"]
+        input_ids = np.full((batch_size, 1), self.generation["decoder_start_token_id"], dtype=np.int64)
+        finished = np.zeros(batch_size, dtype=bool)
+        past = None
+        cur_len = 1
+        while cur_len < max_length:
+            logits, past = self._decode_step(input_ids[:, -1:], encoder_hidden_states, encoder_attention_mask, past)
+            scores = self._process_scores(input_ids, logits.astype(np.float32), cur_len, max_length)
+            next_tokens = np.where(finished, pad, scores.argmax(axis=-1))
+            input_ids = np.concatenate([input_ids, next_tokens[:, None]], axis=1)
+            finished |= next_tokens == eos
+            cur_len += 1
+            if finished.all():
+                break
+        return [list(row) for row in input_ids]
+
+    def _beam_search(self, encoder_hidden_states, encoder_attention_mask, max_length, num_beams, early_stopping):
+        batch_size = encoder_hidden_states.shape[0]
+        eos, pad = self.generation["eos_token_id"], self.generation["pad_token_id"]
+        length_penalty = self.generation["length_penalty"]
+        encoder_hidden_states = np.repeat(encoder_hidden_states, num_beams, axis=0)
+        encoder_attention_mask = np.repeat(encoder_attention_mask, num_beams, axis=0)
+        input_ids = np.full((batch_size * num_beams, 1), self.generation["decoder_start_token_id"], dtype=np.int64)
+        beam_scores = np.zeros((batch_size, num_beams), dtype=np.float32)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.reshape(-1)
+        hypotheses = [[] for _ in range(batch_size)]
+        done = [False] * batch_size
+
+        def add_hypothesis(batch_index, tokens, sum_logprobs, length):
+            hypotheses[batch_index].append((sum_logprobs / length ** length_penalty, list(tokens)))
+            if len(hypotheses[batch_index]) > num_beams:
+                hypotheses[batch_index].remove(min(hypotheses[batch_index], key=lambda hypothesis: hypothesis[0]))
+
+        def is_done(batch_index, best_sum_logprobs, length):
+            if len(hypotheses[batch_index]) < num_beams:
+                return False
+            if early_stopping is True:
+                return True
+            worst_score = min(score for score, _ in hypotheses[batch_index])
+            return worst_score >= best_sum_logprobs / length ** length_penalty
+
+        past = None
+        cur_len = 1
+        while cur_len < max_length:
+            logits, past = self._decode_step(input_ids[:, -1:], encoder_hidden_states, encoder_attention_mask, past)
+            scores = self._process_scores(input_ids, _log_softmax(logits.astype(np.float32)), cur_len, max_length)
+            vocab_size = scores.shape[-1]
+            next_scores = (scores + beam_scores[:, None]).reshape(batch_size, num_beams * vocab_size)
+            candidates = np.argpartition(-next_scores, 2 * num_beams, axis=1)[:, :2 * num_beams]
+            candidates = np.take_along_axis(candidates, np.argsort(-np.take_along_axis(next_scores, candidates, axis=1), axis=1), axis=1)
+
+            new_scores = np.zeros((batch_size, num_beams), dtype=np.float32)
+            new_tokens = np.full((batch_size, num_beams), pad, dtype=np.int64)
+            new_rows = np.arange(batch_size * num_beams).reshape(batch_size, num_beams)
+            for batch_index in range(batch_size):
+                if done[batch_index]:
+                    continue
+                filled = 0
+                for rank, candidate in enumerate(candidates[batch_index]):
+                    token, beam = candidate % vocab_size, candidate // vocab_size
+                    row = batch_index * num_beams + beam
+                    score = next_scores[batch_index, candidate]
+                    if token == eos:
+                        # An EOS outside the top num_beams candidates does not end a hypothesis
+                        if rank < num_beams:
+                            add_hypothesis(batch_index, input_ids[row], score, cur_len)
+                    else:
+                        new_scores[batch_index, filled] = score
+                        new_tokens[batch_index, filled] = token
+                        new_rows[batch_index, filled] = row
+                        filled += 1
+                    if filled == num_beams:
+                        break
+                done[batch_index] = is_done(batch_index, next_scores[batch_index].max(), cur_len)
+            if all(done):
+                break
+            rows = new_rows.reshape(-1)
+            input_ids = np.concatenate([input_ids[rows], new_tokens.reshape(-1, 1)], axis=1)
+            beam_scores = new_scores.reshape(-1)
+            past = [tensor[rows] for tensor in past]
+            cur_len += 1
+
+        sequences = []
+        for batch_index in range(batch_size):
+            if not done[batch_index]:
+                for beam in range(num_beams):
+                    row = batch_index * num_beams + beam
+                    add_hypothesis(batch_index, input_ids[row], beam_scores[row], cur_len)
+            _, tokens = max(hypotheses[batch_index], key=lambda hypothesis: hypothesis[0])
+            sequences.append(tokens + [eos] if len(tokens) < max_length else tokens)
+        return sequences
+
+    def generate(self, image_features, input_ids, profile=None):
+        """
+        Generate token ids for a batch of image features and tokenized prompts with a decoding profile.
+        """
+        return self._generate_from_encoder(*self._encode_text(image_features, input_ids), profile)
+
+    def _encode_text(self, image_features, input_ids):
+        """
+        Return the encoder hidden states and attention mask of the image features merged with the prompt tokens.
+        """
+        return self._run(
+            "text_encoder", {"image_features": _to_numpy(image_features, np.float32), "input_ids": _to_numpy(input_ids, np.int64)}
+        )
+
+    def _generate_from_encoder(self, encoder_hidden_states, encoder_attention_mask, profile=None):
+        decoding = florence_engine.decoding_arguments(profile)
+        max_length = decoding["max_new_tokens"] + 1
+        if decoding["num_beams"] == 1:
+            sequences = self._greedy_search(encoder_hidden_states, encoder_attention_mask, max_length)
+        else:
+            sequences = self._beam_search(
+                encoder_hidden_states, encoder_attention_mask, max_length, decoding["num_beams"], decoding.get("early_stopping", False)
+            )
+        longest = max(len(sequence) for sequence in sequences)
+        return [sequence + [self.generation["pad_token_id"]] * (longest - len(sequence)) for sequence in sequences]
+
+    def decode_captions(self, processor, image_features, image_sizes, task_prompt, profile=None, profiler=None):
+        """
+        Same contract as florence_engine.decode_captions for the PyTorch model.
+        """
+        prompts = processor._construct_prompts([task_prompt] * len(image_sizes))
+        input_ids = processor.tokenizer(prompts, return_tensors="np", padding=True)["input_ids"]
+        with profiling.timed(profiler, "generate", len(image_sizes)):
+            encoder_hidden_states, encoder_attention_mask = self._encode_text(image_features, input_ids)
+            generated_ids = self._generate_from_encoder(encoder_hidden_states, encoder_attention_mask, profile)
+        if profiler is not None:
+            # Counted like the PyTorch path: image and prompt tokens of the merged mask, non-pad generated ids
+            pad_token_id = processor.tokenizer.pad_token_id
+            generated = np.asarray(generated_ids)
+            profiler.add_tokens(
+                "generate",
+                prompt=int(np.asarray(encoder_attention_mask).sum()),
+                completion=int((generated != pad_token_id).sum()) if pad_token_id is not None else generated.size
+            )
+
+        with profiling.timed(profiler, "post_process", len(image_sizes)):
+            generated_texts = processor.batch_decode(generated_ids, skip_special_tokens=False)
+            captions = []
+            for image_size, generated_text in zip(image_sizes, generated_texts):
+                parsed_answer = processor.post_process_generation(generated_text, task=task_prompt, image_size=image_size)
+                captions.append(parsed_answer.get(task_prompt, generated_text))
+        return captions
@@ -0,0 +1,320 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+import collections
+import image_scanner
+from run_manifest import RunManifest
+
+# inotify(7) event bits
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# struct inotify_event: wd, mask, cookie, len, then len bytes of NUL-padded name
+EVENT_HEADER = struct.Struct("iIII")
+
+# An image that finished landing: its size and mtime when it was handed out, and
+# the time it landed (None for images found by the startup scan)
+WatchedFile = collections.namedtuple("WatchedFile", ["path", "relative_path", "size", "mtime_ns", "landed"])
+
+
+def file_signature(path):
+    """
+    Return (size, mtime_ns) of path, or None if it is gone.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class Inotify:
+    """
+    Minimal inotify binding through ctypes, so watching needs no extra package.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.directories = {}
+
+    def add_watch(self, directory):
+        wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), directory)
+        self.directories[wd] = directory
+
+    def read_events(self, timeout):
+        """
+        Wait up to timeout seconds and return a list of (mask, path) events.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_IGNORED:
+                # The directory was removed or unmounted
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            events.append((mask, os.path.join(directory, os.fsdecode(name)) if directory is not None and name else directory))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher:
+    """
+    Watch a folder tree and hand out image files once they have finished landing.
+
+    batches() first yields the images that are new or changed since the
+    checkpoint, then blocks and yields further images as they are written,
+    copied or moved in. A file is handed out once it has been quiet (unchanged
+    size and mtime) for debounce seconds, so bursts of writes and half-copied
+    files are coalesced into one batch. Changes arrive through inotify on Linux;
+    elsewhere, or when the inotify watch limit is reached, the tree is polled
+    every poll_interval seconds.
+
+    Callers record each file with mark() once its caption is written. The
+    checkpoint keeps the size and mtime of every marked file, so a restarted
+    watcher skips files that were captioned and have not changed since, and
+    mark() returns the seconds from the file landing to that point.
+    """
+
+    def __init__(self, root, checkpoint_path, recursive=True, sniff=False, extensions=image_scanner.IMAGE_EXTENSIONS,
+                 debounce=2.0, poll_interval=5.0, use_inotify=True, profiler=None):
+        self.root = root
+        self.recursive = recursive
+        self.sniff = sniff
+        self.extensions = tuple(extension.lower() for extension in extensions)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.profiler = profiler
+        self.checkpoint = RunManifest(checkpoint_path)
+        # path -> [landed, last change, signature] of files not yet quiet for debounce seconds
+        self.pending = {}
+        # path -> signature when last seen, so rescans only pick up new or changed files
+        self.known = {}
+        self.inotify = None
+        self.last_poll = None
+        self.stop_event = threading.Event()
+
+    def _is_image(self, path):
+        return path.lower().endswith(self.extensions)
+
+    def _up_to_date(self, relative_path, signature):
+        entry = self.checkpoint.entries.get(relative_path)
+        return entry is not None and entry["status"] == "done" and (entry.get("size"), entry.get("mtime_ns")) == signature
+
+    def _note(self, path, landed, signature=None):
+        """
+        Record a change to path; it is handed out once quiet for debounce seconds.
+        """
+        signature = signature or file_signature(path)
+        if signature is None:
+            return
+        now = time.time()
+        entry = self.pending.get(path)
+        if entry is None:
+            self.pending[path] = [landed, now, signature]
+        else:
+            entry[1], entry[2] = now, signature
+
+    def _scan(self, directory, since=None):
+        """
+        Note the images under directory that are new or changed since they were last seen.
+
+        Images found at startup (since=None) have no landing time. Otherwise an
+        image landed after since, and its mtime narrows that down unless it was
+        preserved by the copy.
+        """
+        now = time.time()
+        for path in image_scanner.iter_image_files(directory, recursive=self.recursive, extensions=self.extensions):
+            signature = file_signature(path)
+            if signature is None or self.known.get(path) == signature:
+                continue
+            self.known[path] = signature
+            if path not in self.pending and self._up_to_date(os.path.relpath(path, self.root), signature):
+                continue
+            landed = None if since is None else min(now, max(since, signature[1] / 1e9))
+            if path in self.pending:
+                self._note(path, self.pending[path][0], signature)
+            else:
+                # Files already quiet for debounce seconds are handed out on the next check
+                self.pending[path] = [landed, min(now, signature[1] / 1e9), signature]
+
+    def _watch_tree(self, directory):
+        """
+        Add inotify watches on directory and, when recursive, every folder below it.
+        """
+        directories = [directory]
+        while directories:
+            directory = directories.pop()
+            try:
+                self.inotify.add_watch(directory)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise
+                logging.warning(f"Cannot watch {directory}: {e}")
+                continue
+            if not self.recursive:
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    directories.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+            except OSError as e:
+                logging.warning(f"Cannot scan {directory}: {e}")
+
+    def _start(self):
+        if self.use_inotify and sys.platform.startswith("linux"):
+            try:
+                self.inotify = Inotify()
+                # Watch before the startup scan so nothing landing during the scan is missed
+                self._watch_tree(self.root)
+                logging.info(f"Watching {self.root} with inotify ({len(self.inotify.directories)} folder(s)).")
+            except (OSError, AttributeError) as e:
+                logging.warning(f"inotify unavailable ({e}); polling {self.root} every {self.poll_interval}s instead.")
+                if self.inotify is not None:
+                    self.inotify.close()
+                self.inotify = None
+        if self.inotify is None:
+            logging.info(f"Polling {self.root} every {self.poll_interval}s.")
+        self.last_poll = time.time()
+        self._scan(self.root)
+        logging.info(f"{len(self.pending)} image(s) new or changed since the last checkpoint.")
+
+    def _handle_events(self, events):
+        now = time.time()
+        for mask, path in events:
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflowed; rescanning the tree.")
+                self._scan(self.root, since=now)
+                continue
+            if path is None:
+                continue
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._watch_tree(path)
+                    except OSError as e:
+                        logging.warning(f"Cannot watch {path}: {e}; rescans on overflow only.")
+                    # Files may have landed in the folder before its watch was added
+                    self._scan(path, since=now)
+                continue
+            if self._is_image(path):
+                self._note(path, now)
+
+    def _take_ready(self):
+        """
+        Remove and return the pending files that have been quiet for debounce seconds.
+        """
+        now = time.time()
+        ready = []
+        for path, entry in list(self.pending.items()):
+            landed, last_change, signature = entry
+            if now - last_change < self.debounce:
+                continue
+            current = file_signature(path)
+            if current is None:
+                del self.pending[path]
+                self.known.pop(path, None)
+                continue
+            if current != signature:
+                # Still being written
+                entry[1], entry[2] = now, current
+                continue
+            del self.pending[path]
+            self.known[path] = current
+            relative_path = os.path.relpath(path, self.root)
+            if self._up_to_date(relative_path, current):
+                continue
+            if self.sniff and image_scanner.sniff_file(path) is None:
+                logging.warning(f"Skipping {path}: not a supported image format.")
+                continue
+            ready.append(WatchedFile(path, relative_path, current[0], current[1], landed))
+        return ready
+
+    def _wait(self):
+        """
+        Block until a pending file may be quiet, an event arrives or it is time to poll.
+        """
+        now = time.time()
+        timeout = min((entry[1] + self.debounce - now for entry in self.pending.values()), default=self.poll_interval)
+        # Wake at least once a second so stop() takes effect promptly
+        timeout = max(0.05, min(timeout, 1.0))
+        if self.inotify is not None:
+            self._handle_events(self.inotify.read_events(timeout))
+            return
+        if now - self.last_poll >= self.poll_interval:
+            since, self.last_poll = self.last_poll, now
+            self._scan(self.root, since=since)
+            return
+        self.stop_event.wait(min(timeout, self.last_poll + self.poll_interval - now))
+
+    def batches(self):
+        """
+        Yield lists of WatchedFile until stop() is called.
+        """
+        self._start()
+        while not self.stop_event.is_set():
+            ready = self._take_ready()
+            if ready:
+                yield ready
+            else:
+                self._wait()
+
+    def mark(self, watched_file, status="done", **extra):
+        """
+        Checkpoint a file handed out by batches(); returns seconds since it landed, or None.
+        """
+        self.checkpoint.mark(watched_file.relative_path, status, size=watched_file.size, mtime_ns=watched_file.mtime_ns, **extra)
+        if watched_file.landed is None:
+            return None
+        latency = time.time() - watched_file.landed
+        if self.profiler is not None and status == "done":
+            self.profiler.record("landed_to_caption", latency)
+        return latency
+
+    def stop(self):
+        self.stop_event.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        self.checkpoint.close()
@@ -0,0 +1,66 @@
+from PIL import Image
+
+
+def dhash(image, hash_size=8):
+    """
+    Difference hash of a PIL image as an int of hash_size * hash_size bits.
+
+    Each bit says whether a pixel is brighter than its right neighbour in a
+    grayscale thumbnail, so resized, recompressed or re-encoded copies of an
+    image hash to the same or nearly the same value.
+    """
+    thumbnail = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(thumbnail.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class PerceptualIndex:
+    """
+    Find stored hashes within max_distance bits of a query without scanning them all.
+
+    Hashes are split into max_distance + 1 bands; by the pigeonhole principle two
+    hashes that differ in at most max_distance bits agree exactly on at least one
+    band, so only hashes sharing a band value are compared.
+    """
+
+    def __init__(self, max_distance=4, bits=64):
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self.band_bits = -(-bits // self.bands)
+        self.tables = [{} for _ in range(self.bands)]
+        self.items = {}
+
+    def _band_values(self, value):
+        mask = (1 << self.band_bits) - 1
+        return [(value >> (band * self.band_bits)) & mask for band in range(self.bands)]
+
+    def add(self, key, value):
+        self.items[key] = value
+        for table, band_value in zip(self.tables, self._band_values(value)):
+            table.setdefault(band_value, []).append(key)
+
+    def query(self, value):
+        """
+        Return [(key, distance)] of stored hashes within max_distance of value, nearest first.
+        """
+        candidates = set()
+        for table, band_value in zip(self.tables, self._band_values(value)):
+            candidates.update(table.get(band_value, ()))
+        matches = []
+        for key in candidates:
+            distance = hamming_distance(value, self.items[key])
+            if distance <= self.max_distance:
+                matches.append((key, distance))
+        return sorted(matches, key=lambda match: match[1])
+
+    def __len__(self):
+        return len(self.items)
@@ -0,0 +1,40 @@
+import os
+import json
+
+# Written by normalize-images.py into its output folder
+MANIFEST_NAME = "normalize_manifest.jsonl"
+
+
+def load_image_manifest(folder):
+    """
+    Return {image path: entry} for the normalized images in folder, or None if it has no manifest.
+
+    Entries carry the output's width, height, sha256 and dHash, so captioning
+    scripts can key their caches without re-reading or re-decoding the image.
+    Images whose size or mtime no longer match the manifest are left out, so
+    callers fall back to reading them.
+    """
+    path = os.path.join(folder, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    entries = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Torn last line from a crash
+            entries[entry["key"]] = entry
+
+    images = {}
+    for entry in entries.values():
+        if entry["status"] != "done":
+            continue
+        image_path = os.path.join(folder, entry["output"])
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            continue
+        if stat.st_size == entry["bytes"] and stat.st_mtime_ns == entry["mtime_ns"]:
+            images[image_path] = entry
+    return images
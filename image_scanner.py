@@ -0,0 +1,76 @@
+import os
+import logging
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff', '.tif', '.webp')
+
+# Leading bytes of each supported format, as (offset, signature, format)
+MAGIC_SIGNATURES = (
+    (0, b"\xff\xd8\xff", "jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "png"),
+    (0, b"GIF87a", "gif"),
+    (0, b"GIF89a", "gif"),
+    (0, b"BM", "bmp"),
+    (0, b"II*\x00", "tiff"),
+    (0, b"MM\x00*", "tiff"),
+    (8, b"WEBP", "webp"),
+)
+
+
+def sniff_image_format(header):
+    """
+    Return the image format named by the magic bytes at the start of header, or None.
+    """
+    for offset, signature, image_format in MAGIC_SIGNATURES:
+        if header[offset:offset + len(signature)] == signature:
+            if image_format == "webp" and header[:4] != b"RIFF":
+                continue
+            return image_format
+    return None
+
+
+def sniff_file(path):
+    """
+    Return the image format of a file from its magic bytes, or None if it is not a supported image.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return sniff_image_format(f.read(16))
+    except OSError:
+        return None
+
+
+def iter_image_files(root, recursive=True, extensions=IMAGE_EXTENSIONS, sniff=False):
+    """
+    Lazily yield the paths of image files under root.
+
+    Directories are walked with os.scandir one at a time, so the first path is
+    yielded as soon as it is seen and memory stays flat however many files a
+    directory holds. Extensions match case-insensitively (.JPG, .webp, ...).
+    With sniff=True, files whose magic bytes are not a supported image format
+    are skipped even if their extension matches.
+    """
+    extensions = tuple(extension.lower() for extension in extensions)
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive:
+                                subdirectories.append(entry.path)
+                            continue
+                        if not entry.is_file() or not entry.name.lower().endswith(extensions):
+                            continue
+                    except OSError:
+                        continue
+                    if sniff and sniff_file(entry.path) is None:
+                        logging.warning(f"Skipping {entry.path}: not a supported image format.")
+                        continue
+                    yield entry.path
+        except OSError as e:
+            logging.warning(f"Cannot scan {directory}: {e}")
+        # Visit subdirectories in listing order
+        directories.extend(reversed(subdirectories))
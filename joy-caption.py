@@ -1,55 +1,221 @@
 import argparse
 import os
+import time
+import random
+import signal
+import threading
 import replicate
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from tqdm import tqdm
+import caption_cache
+import image_scanner
+import image_manifest
+import caption_store
+from run_manifest import RunManifest
+from folder_watcher import FolderWatcher
 
-def generate_caption(image_path, model_version):
+MODEL_VERSION = "lucataco/joy-caption-pre-alpha:31665fdccd897d20cbda1fa305e64f1b94a181e0350409ed2a40df7a243830a5"
+
+# Seconds between status checks of a running prediction
+PREDICTION_POLL_INTERVAL = 1.0
+
+def generate_caption(image_path, model_version, client, timeout):
+    """
+    Run one prediction and return its output; after timeout seconds it is cancelled and TimeoutError is raised.
+
+    Every HTTP call of the client is bounded by its own timeout, so the
+    prediction is polled on the calling thread instead of being abandoned on a
+    thread that keeps running.
+    """
+    deadline = time.monotonic() + timeout
     with open(image_path, "rb") as image_file:
-        output = replicate.run(
-            model_version,
-            input={"image": image_file}
-        )
-    return output
+        prediction = client.predictions.create(version=model_version.split(":")[-1], input={"image": image_file})
+    while prediction.status not in ("succeeded", "failed", "canceled"):
+        if time.monotonic() >= deadline:
+            prediction.cancel()
+            raise TimeoutError(f"timed out after {timeout}s")
+        time.sleep(PREDICTION_POLL_INTERVAL)
+        prediction.reload()
+    if prediction.status != "succeeded":
+        raise RuntimeError(prediction.error or f"prediction {prediction.status}")
+    return prediction.output
 
-def process_image(image_path, input_folder, output_base_folder, model_version):
+def generate_caption_with_retry(image_path, model_version, client, timeout, retries):
+    """
+    Call generate_caption with a per-request timeout, retrying failures with jittered backoff; the last error is raised.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return generate_caption(image_path, model_version, client, timeout)
+        except Exception as e:
+            error = e
+        if attempt < retries:
+            time.sleep(random.uniform(0, min(30, 2 ** attempt)))
+    raise error
+
+def process_image(image_path, input_folder, output_base_folder, model_version, cache, client, timeout=300, retries=3, image_info=None, output=None, overwrite=False):
     relative_path = os.path.relpath(image_path, input_folder)
     output_path = os.path.splitext(os.path.join(output_base_folder, relative_path))[0] + ".txt"
-    
-    if os.path.exists(output_path):
+    output = output or caption_store.FileCaptionOutput(output_base_folder)
+
+    if not overwrite and output.exists(output_path):
         print(f"Skipping: {relative_path} already captioned.")
-        return
-    
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    
-    caption = generate_caption(image_path, model_version)
+        return "done", None
+
+    # Reuse the caption of identical image content, even if it was renamed or moved;
+    # normalized images come with their hash, so they are not read just to key the cache
+    image_hash = image_info["sha256"] if image_info is not None else caption_cache.hash_file(image_path)
+    cache_key = caption_cache.make_key("joy", image_hash, model_version)
+    caption = cache.get(cache_key)
+    if caption is None:
+        try:
+            caption = generate_caption_with_retry(image_path, model_version, client, timeout, retries)
+        except Exception as e:
+            print(f"Failed to caption: {relative_path} ({e})")
+            return "failed", str(e)
+        if caption:
+            cache.put(cache_key, caption)
     if caption:
-        with open(output_path, "w") as f:
-            f.write(caption)
+        output.write(output_path, caption)
         print(f"Captioned: {relative_path}")
+        return "done", None
     else:
         print(f"Failed to caption: {relative_path}")
+        return "failed", "empty caption"
+
+def main(input_folder, output_base_folder, cache, client, concurrency=8, timeout=300, retries=3, sniff=False, output=None):
+    """
+    Caption every image under input_folder with up to concurrency Replicate requests in flight.
+
+    Completed and failed images are recorded in <output_base_folder>/joy_manifest.jsonl;
+    on restart completed images are skipped from the manifest alone and failed ones are retried.
+    Captions are written as .txt files unless output is a caption_store output.
+    """
+    model_version = MODEL_VERSION
+    manifest = RunManifest(os.path.join(output_base_folder, "joy_manifest.jsonl"))
+    completed = manifest.keys_with_status("done")
+
+    # Stream the tree so the first request goes out before the whole tree is scanned
+    pending_files = (
+        image_path for image_path in image_scanner.iter_image_files(input_folder, sniff=sniff)
+        if os.path.relpath(image_path, input_folder) not in completed
+    )
+
+    print(f"{len(completed)} image(s) already captioned according to the manifest.")
+
+    # Hashes of images written by normalize-images.py
+    normalized_images = image_manifest.load_image_manifest(input_folder) or {}
+
+    def handle(future, relative_path):
+        try:
+            status, error = future.result()
+        except Exception as e:
+            status, error = "failed", str(e)
+        # Commit grouped store writes before the manifest skips the image on restart
+        if status == "done" and output is not None:
+            output.flush()
+        manifest.mark(relative_path, status, error=error)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, tqdm() as progress:
+        in_flight = {}
+        for image_path in pending_files:
+            # Keep the number of queued images bounded so huge trees do not build huge future lists
+            while len(in_flight) >= concurrency * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle(future, in_flight.pop(future))
+                    progress.update(1)
+            future = executor.submit(
+                process_image, image_path, input_folder, output_base_folder, model_version, cache,
+                client, timeout, retries, normalized_images.get(image_path), output
+            )
+            in_flight[future] = os.path.relpath(image_path, input_folder)
+        for future in list(in_flight):
+            handle(future, in_flight.pop(future))
+            progress.update(1)
+
+    failed = manifest.keys_with_status("failed")
+    manifest.close()
+    if failed:
+        print(f"{len(failed)} image(s) failed; rerun to retry them.")
+
+def watch(input_folder, output_base_folder, cache, client, concurrency=8, timeout=300, retries=3, sniff=False, output=None, debounce=2.0, poll_interval=5.0, use_inotify=True):
+    """
+    Caption images as they land in input_folder until interrupted, with up to concurrency Replicate requests in flight.
+
+    Images are checkpointed in <output_base_folder>/joy_watch_checkpoint.jsonl with their
+    size and mtime, so after a restart only new or changed images are captioned.
+    A changed image overwrites its caption; an image already captioned by a
+    normal run before the first watch keeps it.
+    """
+    watcher = FolderWatcher(
+        input_folder, os.path.join(output_base_folder, "joy_watch_checkpoint.jsonl"), sniff=sniff,
+        debounce=debounce, poll_interval=poll_interval, use_inotify=use_inotify
+    )
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: watcher.stop())
+    normalized_images = image_manifest.load_image_manifest(input_folder) or {}
+
+    def handle(future, watched_file):
+        slots.release()
+        try:
+            status, error = future.result()
+        except Exception as e:
+            status, error = "failed", str(e)
+        if status == "done" and output is not None:
+            output.flush()
+        latency = watcher.mark(watched_file, status, error=error)
+        if latency is not None and status == "done":
+            print(f"Captioned {watched_file.relative_path} {latency:.1f}s after it landed.")
 
-def is_image_file(filename):
-    IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.webp'}
-    return Path(filename).suffix.lower() in IMAGE_EXTENSIONS
-
-def main(input_folder, output_base_folder):
-    model_version = "lucataco/joy-caption-pre-alpha:31665fdccd897d20cbda1fa305e64f1b94a181e0350409ed2a40df7a243830a5"
-    image_files = [
-        os.path.join(root, file)
-        for root, dirs, files in os.walk(input_folder)
-        for file in files if is_image_file(file)
-    ]
-    
-    print(f"Found {len(image_files)} image(s) to process.")
-    
-    for image_path in tqdm(image_files):
-        process_image(image_path, input_folder, output_base_folder, model_version)
+    # Bound the queued images so a large backlog does not build a huge future list
+    slots = threading.Semaphore(concurrency * 2)
+    with watcher, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for watched_files in watcher.batches():
+            print(f"Captioning {len(watched_files)} new or changed image(s).")
+            for watched_file in watched_files:
+                slots.acquire()
+                # Seen before by the watcher means the image changed, so its old caption is stale
+                overwrite = watched_file.landed is not None or watched_file.relative_path in watcher.checkpoint.entries
+                future = executor.submit(
+                    process_image, watched_file.path, input_folder, output_base_folder, MODEL_VERSION, cache, client,
+                    timeout, retries, normalized_images.get(watched_file.path), output, overwrite
+                )
+                future.add_done_callback(lambda future, watched_file=watched_file: handle(future, watched_file))
+        # Leaving the executor waits for the images in flight, so they are checkpointed before it closes
+    print("Stopped watching.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate captions for all images in a nested directory structure.")
     parser.add_argument("input_folder", type=str, help="Path to the input folder containing images.")
     parser.add_argument("output_base_folder", type=str, help="Path to the base folder for saving output captions.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of Replicate requests in flight.")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds after which a prediction is cancelled and retried; also bounds each HTTP request.")
+    parser.add_argument("--retries", type=int, default=3, help="Retries per image after a failed or timed-out request.")
+    parser.add_argument("--sniff", action="store_true", help="Skip files whose magic bytes are not a supported image format.")
+    parser.add_argument("--cache-dir", type=str, default=caption_cache.DEFAULT_CACHE_DIR, help="Directory of the content-addressed caption cache.")
+    parser.add_argument("--cache-max-mb", type=int, default=1024, help="Evict least recently used cache entries beyond this size.")
+    parser.add_argument("--store", type=str, default=None, help="Write captions into this SQLite caption store instead of .txt files; export them with export-captions.py.")
+    parser.add_argument("--watch", action="store_true", help="Keep running and caption images as they land in the input folder; a checkpoint skips captioned, unchanged images across restarts.")
+    parser.add_argument("--debounce", type=float, default=2.0, help="With --watch, seconds a file must stay unchanged before it is captioned.")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="With --watch, seconds between scans when inotify is unavailable.")
+    parser.add_argument("--no-inotify", action="store_true", help="With --watch, poll the input folder instead of using inotify, e.g. on network filesystems.")
     args = parser.parse_args()
-    main(args.input_folder, args.output_base_folder)
+    cache = caption_cache.CaptionCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024)
+    output = caption_store.open_caption_output(args.output_base_folder, args.store)
+    try:
+        if args.watch:
+            watch(
+                args.input_folder, args.output_base_folder, cache, replicate.Client(timeout=args.timeout),
+                concurrency=args.concurrency, timeout=args.timeout, retries=args.retries, sniff=args.sniff,
+                output=output, debounce=args.debounce, poll_interval=args.poll_interval, use_inotify=not args.no_inotify
+            )
+        else:
+            main(
+                args.input_folder, args.output_base_folder, cache, replicate.Client(timeout=args.timeout),
+                concurrency=args.concurrency, timeout=args.timeout, retries=args.retries, sniff=args.sniff,
+                output=output
+            )
+    finally:
+        output.close()
+        cache.close()
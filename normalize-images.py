@@ -0,0 +1,166 @@
+import io
+import os
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from PIL import Image, ImageOps
+from tqdm import tqdm
+import image_scanner
+from image_hashes import dhash
+from image_manifest import MANIFEST_NAME
+from run_manifest import RunManifest
+
+OUTPUT_FORMATS = {"jpeg": ".jpg", "png": ".png", "webp": ".webp"}
+
+
+def to_rgb(image):
+    """
+    Convert to RGB, compositing transparent images onto white instead of black.
+    """
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def normalize_image(source_path, output_path, resolution, min_size, image_format, quality, crop):
+    """
+    Validate one image, resize and center-crop it to resolution and save it in image_format.
+
+    Runs in a worker process. Returns (status, extra) for the manifest; corrupt,
+    unsupported or too-small images are "rejected".
+    """
+    if image_scanner.sniff_file(source_path) is None:
+        return "rejected", {"error": "not a supported image format"}
+    try:
+        with Image.open(source_path) as image:
+            if min(image.size) < min_size:
+                return "rejected", {"error": f"too small ({image.width}x{image.height})"}
+            # Let the JPEG decoder downscale by a power of two while decoding large originals
+            image.draft("RGB", (resolution, resolution))
+            image.load()
+            image = to_rgb(ImageOps.exif_transpose(image))
+    except Exception as e:
+        return "rejected", {"error": f"cannot decode image: {e}"}
+
+    if crop:
+        image = ImageOps.fit(image, (resolution, resolution), Image.LANCZOS, centering=(0.5, 0.5))
+    elif max(image.size) > resolution:
+        image.thumbnail((resolution, resolution), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    save_options = {"quality": quality} if image_format in ("jpeg", "webp") else {"optimize": True}
+    image.save(buffer, format=image_format.upper(), **save_options)
+    data = buffer.getvalue()
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = f"{output_path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, output_path)
+    return "done", {
+        "width": image.width,
+        "height": image.height,
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "phash": f"{dhash(image):016x}",
+        "bytes": len(data),
+        "mtime_ns": os.stat(output_path).st_mtime_ns,
+    }
+
+
+def source_fingerprint(path):
+    stat = os.stat(path)
+    return {"source_bytes": stat.st_size, "source_mtime_ns": stat.st_mtime_ns}
+
+
+def main(input_folder, output_folder, resolution=1024, min_size=512, image_format="jpeg", quality=95, crop=True, workers=None):
+    """
+    Normalize every image under input_folder into output_folder with a process pool.
+
+    The output mirrors the input tree with the extension of image_format. Each
+    source is recorded in <output_folder>/normalize_manifest.jsonl with the
+    output's dimensions and hashes; on rerun, sources that are unchanged since
+    they were normalized or rejected are skipped.
+    """
+    manifest = RunManifest(os.path.join(output_folder, MANIFEST_NAME))
+    settings = {"resolution": resolution, "min_size": min_size, "format": image_format, "quality": quality, "crop": crop}
+    workers = workers or os.cpu_count()
+
+    # Output names already taken, so a.png and a.jpg do not both become a.jpg
+    claimed = {entry["output"]: key for key, entry in manifest.entries.items() if entry["status"] == "done"}
+
+    def output_for(relative_path):
+        stem, extension = os.path.splitext(relative_path)
+        output = stem + OUTPUT_FORMATS[image_format]
+        if claimed.get(output, relative_path) != relative_path:
+            output = f"{stem}_{extension.lstrip('.').lower()}{OUTPUT_FORMATS[image_format]}"
+        claimed[output] = relative_path
+        return output
+
+    counts = {"done": 0, "rejected": 0, "skipped": 0, "failed": 0}
+
+    def handle(future, relative_path, output, fingerprint):
+        try:
+            status, extra = future.result()
+        except Exception as e:
+            status, extra = "failed", {"error": str(e)}
+        if status == "done":
+            extra["output"] = output
+        else:
+            tqdm.write(f"{status.capitalize()} {relative_path}: {extra['error']}")
+        manifest.mark(relative_path, status, settings=settings, **fingerprint, **extra)
+        counts[status] += 1
+
+    with ProcessPoolExecutor(max_workers=workers) as executor, tqdm() as progress:
+        in_flight = {}
+        for source_path in image_scanner.iter_image_files(input_folder):
+            relative_path = os.path.relpath(source_path, input_folder)
+            fingerprint = source_fingerprint(source_path)
+            entry = manifest.entries.get(relative_path)
+            if entry and entry["status"] in ("done", "rejected") and entry.get("settings") == settings and \
+                    all(entry.get(name) == value for name, value in fingerprint.items()) and \
+                    (entry["status"] == "rejected" or os.path.exists(os.path.join(output_folder, entry["output"]))):
+                counts["skipped"] += 1
+                progress.update(1)
+                continue
+            # Keep the number of queued images bounded so huge trees do not build huge future lists
+            while len(in_flight) >= workers * 4:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle(future, *in_flight.pop(future))
+                    progress.update(1)
+            output = output_for(relative_path)
+            future = executor.submit(
+                normalize_image, source_path, os.path.join(output_folder, output), resolution, min_size,
+                image_format, quality, crop
+            )
+            in_flight[future] = (relative_path, output, fingerprint)
+        for future in list(in_flight):
+            handle(future, *in_flight.pop(future))
+            progress.update(1)
+    manifest.close()
+
+    print(
+        f"Normalized {counts['done']} image(s); rejected {counts['rejected']}, failed {counts['failed']}, "
+        f"skipped {counts['skipped']} unchanged."
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate, resize and center-crop images into a training-ready dataset.")
+    parser.add_argument("input_folder", type=str, help="Path to the folder of downloaded images.")
+    parser.add_argument("output_folder", type=str, help="Path to the folder for normalized images and their manifest.")
+    parser.add_argument("--resolution", type=int, default=1024, help="Output side length in pixels.")
+    parser.add_argument("--min-size", type=int, default=512, help="Reject images whose shorter side is below this.")
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS), default="jpeg", help="Output image format.")
+    parser.add_argument("--quality", type=int, default=95, help="JPEG/WebP quality.")
+    parser.add_argument("--no-crop", action="store_true", help="Only downscale to fit the resolution instead of center-cropping to a square.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPU count).")
+    args = parser.parse_args()
+
+    main(
+        args.input_folder, args.output_folder, resolution=args.resolution, min_size=args.min_size,
+        image_format=args.format, quality=args.quality, crop=not args.no_crop, workers=args.workers
+    )
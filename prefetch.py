@@ -0,0 +1,108 @@
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_DONE = object()
+
+
+class QueueDepthStats:
+    """
+    Track how full the prefetch queue is each time the model asks for a batch.
+
+    A queue that is usually empty means the model is waiting on decode/preprocess
+    (decode-bound); a queue that is usually full means decode workers are waiting
+    on the model (inference-bound).
+    """
+
+    def __init__(self, max_queue_size):
+        self.max_queue_size = max_queue_size
+        self.samples = []
+        self.wait_time = 0.0
+
+    def record(self, depth, wait_time):
+        self.samples.append(depth)
+        self.wait_time += wait_time
+
+    @property
+    def average_depth(self):
+        return sum(self.samples) / len(self.samples) if self.samples else 0.0
+
+    @property
+    def bottleneck(self):
+        if not self.samples:
+            return "unknown"
+        if self.average_depth < 0.5:
+            return "decode"
+        if self.average_depth >= self.max_queue_size - 0.5:
+            return "inference"
+        return "balanced"
+
+    def summary(self):
+        return (
+            f"Prefetch queue depth avg {self.average_depth:.2f}/{self.max_queue_size} over {len(self.samples)} batch(es), "
+            f"model waited {self.wait_time:.2f}s for input; bottleneck: {self.bottleneck}."
+        )
+
+
+def prefetch_batches(batches, load_fn, num_workers=4, max_queue_size=4, stats=None):
+    """
+    Apply load_fn to every item of every batch on a worker pool and yield the loaded batches in order.
+
+    A producer thread submits items to a thread pool (PIL decode and the image
+    processor release the GIL for most of their work) and puts each loaded batch
+    on a bounded queue, so decode and preprocess of the next batches overlap with
+    inference on the current one. The queue depth seen by the consumer is recorded
+    in stats and logged at the end of the run.
+    """
+    stats = stats or QueueDepthStats(max_queue_size)
+    batch_queue = queue.Queue(maxsize=max_queue_size)
+    stop_event = threading.Event()
+
+    def put(entry):
+        while not stop_event.is_set():
+            try:
+                batch_queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                # Keep one batch in flight ahead of the one being resolved so workers never idle between batches
+                in_flight = deque()
+                for batch in batches:
+                    in_flight.append([executor.submit(load_fn, item) for item in batch])
+                    while len(in_flight) > 1:
+                        if not put([future.result() for future in in_flight.popleft()]):
+                            return
+                while in_flight:
+                    if not put([future.result() for future in in_flight.popleft()]):
+                        return
+        except Exception as e:
+            put(e)
+        finally:
+            put(_DONE)
+
+    producer_thread = threading.Thread(target=producer, name="prefetch-producer", daemon=True)
+    producer_thread.start()
+    try:
+        while True:
+            depth = batch_queue.qsize()
+            wait_start = time.perf_counter()
+            entry = batch_queue.get()
+            if entry is _DONE:
+                break
+            if isinstance(entry, Exception):
+                raise entry
+            stats.record(depth, time.perf_counter() - wait_start)
+            logging.info(f"Prefetch queue depth {depth}/{max_queue_size}.")
+            yield entry
+    finally:
+        stop_event.set()
+        producer_thread.join()
+        logging.info(stats.summary())
@@ -0,0 +1,298 @@
+import os
+import csv
+import sys
+import json
+import time
+import random
+import logging
+import resource
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def percentile(values, q):
+    """
+    Return the q-th percentile (0-100) of values with linear interpolation.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def current_rss_bytes():
+    """
+    Resident set size of this process, from /proc on Linux or the peak RSS elsewhere.
+    """
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def peak_cuda_bytes():
+    """
+    Peak CUDA memory allocated by torch in this process, or None without torch or a GPU.
+    """
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    return torch.cuda.max_memory_allocated()
+
+
+class PeakRSSSampler:
+    """
+    Sample the process RSS on a background thread and keep the peak seen while active.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.peak = max(self.peak, current_rss_bytes())
+            self.stop_event.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop_event.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss_bytes())
+
+
+class StageStats:
+    """
+    Count, total time and a uniform reservoir sample of durations for one stage.
+
+    The reservoir keeps percentiles accurate on runs of millions of calls with
+    bounded memory; count, items and total are exact.
+    """
+
+    def __init__(self, max_samples):
+        self.max_samples = max_samples
+        self.count = 0
+        self.items = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, seconds, items):
+        self.count += 1
+        self.items += items
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.samples) < self.max_samples:
+            self.samples.append(seconds)
+        else:
+            index = random.randrange(self.count)
+            if index < self.max_samples:
+                self.samples[index] = seconds
+
+
+class StageProfiler:
+    """
+    Per-stage timers, token counts and peak memory of a captioning run.
+
+    Wrap each stage in `with profiler.stage("generate", items=len(batch)):`;
+    durations use perf_counter and cost well under a microsecond, so the timers
+    stay on for every run. report() summarizes count, total seconds, items per
+    second and p50/p95/p99 latency per stage; write_report() saves it as JSON or
+    CSV and prometheus_text() renders it for a /metrics endpoint. Safe to use
+    from several threads.
+    """
+
+    def __init__(self, max_samples=50000, rss_interval=0.5):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.tokens = {}
+        self.counters = {}
+        self.start_time = time.time()
+        self.rss_sampler = PeakRSSSampler(interval=rss_interval)
+
+    def start(self):
+        """
+        Restart the wall clock and start sampling peak RSS.
+        """
+        self.start_time = time.time()
+        self.rss_sampler.__enter__()
+
+    def stop(self):
+        self.rss_sampler.__exit__(None, None, None)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def record(self, name, seconds, items=1):
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats(self.max_samples)
+            stats.add(seconds, items)
+
+    @contextlib.contextmanager
+    def stage(self, name, items=1):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start_time, items)
+
+    def add_tokens(self, name, prompt=0, completion=0):
+        with self.lock:
+            counts = self.tokens.setdefault(name, {"prompt": 0, "completion": 0})
+            counts["prompt"] += prompt
+            counts["completion"] += completion
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self):
+        with self.lock:
+            stages = {name: (stats.count, stats.items, stats.total, stats.max, list(stats.samples)) for name, stats in self.stages.items()}
+            tokens = {name: dict(counts) for name, counts in self.tokens.items()}
+            counters = dict(self.counters)
+        wall_time = time.time() - self.start_time
+        report = {
+            "wall_seconds": wall_time,
+            "peak_rss_bytes": max(self.rss_sampler.peak, current_rss_bytes()),
+            "peak_cuda_bytes": peak_cuda_bytes(),
+            "counters": counters,
+            "tokens": tokens,
+            "stages": {},
+        }
+        for name, (count, items, total, longest, samples) in sorted(stages.items()):
+            report["stages"][name] = {
+                "count": count,
+                "items": items,
+                "total_seconds": total,
+                "mean_seconds": total / count if count else 0.0,
+                "p50_seconds": percentile(samples, 50),
+                "p95_seconds": percentile(samples, 95),
+                "p99_seconds": percentile(samples, 99),
+                "max_seconds": longest,
+                # Items per second of time spent in this stage, i.e. its throughput if it ran alone
+                "items_per_second": items / total if total else 0.0,
+            }
+        if "images" in counters and wall_time:
+            report["images_per_second"] = counters["images"] / wall_time
+        return report
+
+    def write_report(self, path):
+        """
+        Write report() to path: JSON, or one row per stage if path ends in .csv.
+        """
+        report = self.report()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if path.endswith(".csv"):
+            fields = ["stage", "count", "items", "total_seconds", "mean_seconds", "p50_seconds", "p95_seconds",
+                      "p99_seconds", "max_seconds", "items_per_second", "prompt_tokens", "completion_tokens"]
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                for name, stats in report["stages"].items():
+                    tokens = report["tokens"].get(name, {})
+                    writer.writerow(dict(
+                        stats, stage=name, prompt_tokens=tokens.get("prompt", 0), completion_tokens=tokens.get("completion", 0)
+                    ))
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+        logging.info(f"Wrote profile report to {path}.")
+
+    def summary(self):
+        """
+        One line per stage for the end-of-run log.
+        """
+        report = self.report()
+        lines = [f"{'stage':<16} {'count':>8} {'total (s)':>10} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'items/s':>9}"]
+        for name, stats in sorted(report["stages"].items(), key=lambda item: -item[1]["total_seconds"]):
+            lines.append(
+                f"{name:<16} {stats['count']:>8} {stats['total_seconds']:>10.2f} {stats['p50_seconds'] * 1000:>9.1f} "
+                f"{stats['p95_seconds'] * 1000:>9.1f} {stats['p99_seconds'] * 1000:>9.1f} {stats['items_per_second']:>9.2f}"
+            )
+        lines.append(f"Peak RSS {report['peak_rss_bytes'] / (1024 * 1024):.0f} MB" + (
+            f", peak CUDA {report['peak_cuda_bytes'] / (1024 * 1024):.0f} MB" if report["peak_cuda_bytes"] is not None else ""
+        ) + ".")
+        return "\n".join(lines)
+
+    def prometheus_text(self, prefix="caption"):
+        """
+        Render the current report in the Prometheus text exposition format.
+        """
+        report = self.report()
+        lines = [f"# TYPE {prefix}_stage_seconds summary"]
+        for name, stats in report["stages"].items():
+            for quantile, key in (("0.5", "p50_seconds"), ("0.95", "p95_seconds"), ("0.99", "p99_seconds")):
+                lines.append(f'{prefix}_stage_seconds{{stage="{name}",quantile="{quantile}"}} {stats[key]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stats["total_seconds"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stats["count"]}')
+        lines.append(f"# TYPE {prefix}_stage_items_total counter")
+        for name, stats in report["stages"].items():
+            lines.append(f'{prefix}_stage_items_total{{stage="{name}"}} {stats["items"]}')
+        lines.append(f"# TYPE {prefix}_tokens_total counter")
+        for name, counts in report["tokens"].items():
+            for kind, value in counts.items():
+                lines.append(f'{prefix}_tokens_total{{stage="{name}",kind="{kind}"}} {value}')
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for name, value in report["counters"].items():
+            lines.append(f'{prefix}_events_total{{name="{name}"}} {value}')
+        lines.append(f"# TYPE {prefix}_peak_rss_bytes gauge")
+        lines.append(f"{prefix}_peak_rss_bytes {report['peak_rss_bytes']}")
+        if report["peak_cuda_bytes"] is not None:
+            lines.append(f"# TYPE {prefix}_peak_cuda_bytes gauge")
+            lines.append(f"{prefix}_peak_cuda_bytes {report['peak_cuda_bytes']}")
+        lines.append(f"# TYPE {prefix}_uptime_seconds gauge")
+        lines.append(f"{prefix}_uptime_seconds {report['wall_seconds']}")
+        return "\n".join(lines) + "\n"
+
+
+def timed(profiler, name, items=1):
+    """
+    profiler.stage(name, items), or a no-op context when profiler is None.
+    """
+    return profiler.stage(name, items) if profiler is not None else contextlib.nullcontext()
+
+
+def serve_metrics(profiler, port, host="0.0.0.0"):
+    """
+    Serve profiler.prometheus_text() at http://host:port/metrics from a daemon thread; returns the server.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = profiler.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logging.info(f"Serving metrics at http://{host}:{server.server_address[1]}/metrics.")
+    return server
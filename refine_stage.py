@@ -0,0 +1,199 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+import concurrent.futures
+import openai
+import profiling
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket refilled continuously at a per-minute rate.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.tokens = float(rate_per_minute)
+        self.fill_rate = rate_per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        """
+        Wait until amount tokens are available and take them.
+        """
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.fill_rate)
+
+    def adjust(self, amount):
+        """
+        Give back (positive) or charge (negative) tokens once the real cost of a request is known.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def estimate_tokens(messages, max_completion_tokens):
+    """
+    Rough token estimate for a chat request (about four characters per token) plus the completion budget.
+    """
+    return sum(len(message["content"]) for message in messages) // 4 + max_completion_tokens
+
+
+def is_retryable(error):
+    """
+    Return True for rate limits, server errors, timeouts and connection failures.
+    """
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code == 429 or (status_code is not None and status_code >= 500)
+
+
+class AsyncRefiner:
+    """
+    Concurrent GPT caption refinement stage running on its own asyncio event loop.
+
+    Captioning code calls submit() from any thread and keeps going; requests are
+    sent with bounded concurrency, throttled by requests/min and tokens/min token
+    buckets, and retried with jittered exponential backoff on 429/5xx. The client
+    is any openai.AsyncOpenAI-compatible object, so the stage can be pointed at a
+    local stub server through base_url or replaced entirely. With a
+    profiling.StageProfiler, every API call is timed as "gpt_request" and its
+    token usage recorded.
+    """
+
+    def __init__(self, client, model, concurrency=8, requests_per_minute=500, tokens_per_minute=30000,
+                 max_retries=5, max_completion_tokens=512, backoff_base=1.0, backoff_cap=60.0, profiler=None):
+        self.client = client
+        self.model = model
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.max_completion_tokens = max_completion_tokens
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.profiler = profiler
+        self.loop = None
+        self.thread = None
+        # Bound the number of queued requests so a fast captioner cannot grow memory without limit
+        self.pending = threading.BoundedSemaphore(concurrency * 4)
+        self.futures = set()
+        self.futures_lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def start(self):
+        """
+        Start the event loop thread and create the limiters on it.
+        """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="refine-stage", daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self.loop).result()
+
+    async def _setup(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.request_bucket = TokenBucket(self.requests_per_minute)
+        self.token_bucket = TokenBucket(self.tokens_per_minute)
+
+    def submit(self, messages):
+        """
+        Queue a chat request and return a concurrent.futures.Future resolving to the
+        refined caption ("" if every attempt failed). Blocks while the queue is full.
+        """
+        self.pending.acquire()
+        future = asyncio.run_coroutine_threadsafe(self._refine(messages), self.loop)
+        with self.futures_lock:
+            self.futures.add(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        with self.futures_lock:
+            self.futures.discard(future)
+        self.pending.release()
+
+    async def _refine(self, messages):
+        async with self.semaphore:
+            return await self._refine_with_retries(messages)
+
+    async def _refine_with_retries(self, messages):
+        estimate = estimate_tokens(messages, self.max_completion_tokens)
+        for attempt in range(self.max_retries + 1):
+            await self.request_bucket.acquire()
+            await self.token_bucket.acquire(estimate)
+            try:
+                with profiling.timed(self.profiler, "gpt_request"):
+                    completion = await self.client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        max_tokens=self.max_completion_tokens
+                    )
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    logging.error(f"Error refining caption: {e}")
+                    if self.profiler is not None:
+                        self.profiler.count("gpt_failures")
+                    return ""
+                delay = self._backoff_delay(e, attempt)
+                if self.profiler is not None:
+                    self.profiler.count("gpt_retries")
+                logging.warning(f"Refinement request failed ({e}); retrying in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+                continue
+
+            usage = getattr(completion, "usage", None)
+            if usage is not None and usage.total_tokens:
+                self.token_bucket.adjust(estimate - usage.total_tokens)
+                if self.profiler is not None:
+                    self.profiler.add_tokens("gpt_request", prompt=usage.prompt_tokens or 0, completion=usage.completion_tokens or 0)
+            return completion.choices[0].message.content.strip()
+        return ""
+
+    def _backoff_delay(self, error, attempt):
+        """
+        Full-jitter exponential backoff, honouring a Retry-After header when the server sends one.
+        """
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after) + random.uniform(0, self.backoff_base)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def close(self):
+        """
+        Wait for every queued refinement to finish and stop the event loop.
+        """
+        if self.loop is None:
+            return
+
+        with self.futures_lock:
+            futures = list(self.futures)
+        concurrent.futures.wait(futures)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
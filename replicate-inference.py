@@ -1,23 +1,66 @@
-import replicate
-
-prompt = "a silver metal WTHCTR"
-output = replicate.run(
-    "ch-ho00/cartier-model2-ft2:2a18f8c55504f8cecd9230142b1d2f2579d49c2018aeb65ad0426b0b266574f9",
-    input={
-        "prompt" : prompt,
-        "model": "dev",
-        "lora_scale": 1,
-        "num_outputs": 1,
-        "aspect_ratio": "1:1",
-        "output_format": "webp",
-        "guidance_scale": 3.5,
-        "output_quality": 90,
-        "prompt_strength": 0.8,
-        "extra_lora_scale": 1,
-        "num_inference_steps": 28
-    }
-)
-print(output)
-
-import pdb; pdb.set_trace()
-print()
\ No newline at end of file
+import os
+import argparse
+import logging
+from tqdm import tqdm
+import sweep_engine
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def main(grid_path, output_dir, client, model_version=sweep_engine.DEFAULT_MODEL_VERSION, concurrency=4, requests_per_minute=60, retries=3, dry_run=False):
+    """
+    Run every point of the sweep in grid_path and write a contact sheet of the results.
+
+    Returns the number of points that failed; rerunning retries them and skips the done ones.
+    """
+    base_input, points, varying = sweep_engine.load_grid(grid_path)
+    runner = sweep_engine.SweepRunner(
+        client, output_dir, model_version=model_version, concurrency=concurrency,
+        requests_per_minute=requests_per_minute, retries=retries
+    )
+    try:
+        if dry_run:
+            inputs = runner.prediction_inputs(base_input, points)
+            completed = runner.manifest.keys_with_status("done")
+            print(f"{len(inputs)} sweep point(s), {len(set(inputs) - completed)} still to run; varying {', '.join(varying) or 'nothing'}.")
+            return 0
+        try:
+            with tqdm(unit="point") as progress:
+                succeeded, failed, skipped = runner.run(base_input, points, progress=progress)
+        finally:
+            # Index whatever finished, also when interrupted
+            runner.write_index(base_input, points, varying)
+    finally:
+        runner.close()
+    print(f"{succeeded} point(s) generated, {skipped} already done, {failed} failed.")
+    if failed:
+        print("Rerun the same command to retry the failed points.")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a parameter sweep (prompts x lora_scale x guidance_scale x steps x seeds) against a Replicate LoRA model.")
+    parser.add_argument("grid", type=str, help="Sweep definition: a YAML/JSON file with base, grid and points sections, or a CSV file of explicit points.")
+    parser.add_argument("--output-dir", type=str, default=None, help="Folder for images, the manifest and the contact sheet (default: sweeps/<grid name>).")
+    parser.add_argument("--model", type=str, default=sweep_engine.DEFAULT_MODEL_VERSION, help="Replicate model version to run.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of predictions in flight.")
+    parser.add_argument("--rpm", type=int, default=60, help="Maximum predictions started per minute.")
+    parser.add_argument("--retries", type=int, default=3, help="Retries per point after a failed prediction or download.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report how many points the grid has and how many are still to run.")
+    parser.add_argument("--fake", action="store_true", help="Render placeholder images locally instead of calling Replicate.")
+    parser.add_argument("--fake-latency", type=float, default=0.5, help="Seconds each fake prediction takes.")
+    parser.add_argument("--fake-failure-rate", type=float, default=0.0, help="Fraction of fake predictions that fail.")
+    args = parser.parse_args()
+
+    if args.fake:
+        client = sweep_engine.FakeReplicateClient(latency=args.fake_latency, failure_rate=args.fake_failure_rate)
+    else:
+        import replicate
+        client = replicate.Client()
+
+    output_dir = args.output_dir or os.path.join("sweeps", os.path.splitext(os.path.basename(args.grid))[0])
+    failed = main(
+        args.grid, output_dir, client, model_version=args.model, concurrency=args.concurrency,
+        requests_per_minute=args.rpm, retries=args.retries, dry_run=args.dry_run
+    )
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,52 @@
+import os
+import json
+import time
+import threading
+
+
+class RunManifest:
+    """
+    Append-only JSONL record of which items of a long run finished or failed.
+
+    Each line is {"key": ..., "status": ..., ...}; the last line for a key wins.
+    Loading the manifest on restart tells the run which items to skip without
+    stat-ing their outputs. Safe to use from several threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Torn last line from a crash
+                    self.entries[entry["key"]] = entry
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def status(self, key):
+        entry = self.entries.get(key)
+        return entry["status"] if entry else None
+
+    def keys_with_status(self, status):
+        return {key for key, entry in self.entries.items() if entry["status"] == status}
+
+    def mark(self, key, status, **extra):
+        """
+        Record the status of an item and flush it to disk immediately.
+        """
+        entry = dict(extra, key=key, status=status, time=time.time())
+        with self.lock:
+            self.entries[key] = entry
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import random
+import shutil
+import socket
+import logging
+import threading
+from file_utils import atomic_write_text
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class ShardQueue:
+    """
+    Work queue of image shards coordinated through files, for workers on one or several machines.
+
+    Layout of shard_dir (which must be on a filesystem every worker sees):
+
+        shards/<id>.json     image paths of one shard, relative to the input folder
+        leases/<id>          held while a worker captions the shard; its mtime is the heartbeat
+        done/<id>            written when the shard finished
+        failed/<id>          written when the shard raised; delete the folder to retry them
+        plan.lock            held by the worker writing the plan
+        plan.done            touched whenever a worker finished (re)planning
+        once/<name>.lock     lease on a once-per-run step, see claim_once
+        once/<name>.done     written when that step succeeded
+
+    Leases are taken by exclusive file creation, so exactly one worker holds a
+    shard. Holders touch their leases every lease_timeout / 4 seconds; a lease
+    not touched for lease_timeout seconds belongs to a crashed worker and is
+    taken over by the next worker that wants the shard. Workers pull shards
+    until none are left, so fast workers simply take more of them. Rerunning
+    with more input images appends shards for them. Clocks of
+    the machines must agree to well within lease_timeout.
+    """
+
+    def __init__(self, shard_dir, lease_timeout=300, poll_interval=5):
+        self.shard_dir = shard_dir
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.owner = worker_name()
+        self.held = set()
+        self.held_once = set()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.heartbeat_thread = None
+        for name in ("leases", "done", "failed", "once"):
+            os.makedirs(os.path.join(shard_dir, name), exist_ok=True)
+
+    def _path(self, *parts):
+        return os.path.join(self.shard_dir, *parts)
+
+    def _create_exclusive(self, path):
+        """
+        Create path with this worker as owner; False if it already exists.
+        """
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({"owner": self.owner, "time": time.time()}, f)
+        return True
+
+    def _take_over_if_stale(self, path):
+        """
+        Remove path if its heartbeat is older than lease_timeout; True if it is gone.
+        """
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except FileNotFoundError:
+            return True
+        if age < self.lease_timeout:
+            return False
+        # Rename first so that of several workers noticing the stale lease only one removes it
+        stale_path = f"{path}.stale-{os.getpid()}-{random.getrandbits(32):08x}"
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return True
+        try:
+            with open(stale_path, 'r', encoding='utf-8') as f:
+                previous_owner = json.load(f).get("owner")
+        except (OSError, ValueError):
+            previous_owner = "unknown"
+        os.remove(stale_path)
+        logging.warning(f"Reclaimed {os.path.relpath(path, self.shard_dir)} from {previous_owner} after {age:.0f}s without a heartbeat.")
+        return True
+
+    def _lock(self, path):
+        """
+        Block until this worker holds the lock file at path, taking it over if its holder died.
+        """
+        while not self._create_exclusive(path):
+            if not self._take_over_if_stale(path):
+                time.sleep(self.poll_interval)
+
+    def plan(self, relative_paths, shard_size=64):
+        """
+        Split the relative_paths no shard covers yet into new shards.
+
+        The first plan is written into a private folder and renamed into place,
+        so a half-written plan is never visible; later runs over a grown input
+        append shards for the new paths, so rerunning after images arrive
+        captions just those. Workers plan one at a time under plan.lock, and a
+        worker that waited for another's plan does not scan again. If the
+        planner dies, its lock goes stale and the next worker plans instead.
+        """
+        shards_dir = self._path("shards")
+        lock_path = self._path("plan.lock")
+        planned_path = self._path("plan.done")
+        started = time.time()
+        self._lock(lock_path)
+        try:
+            if os.path.exists(planned_path) and os.stat(planned_path).st_mtime >= started:
+                return
+            covered = set()
+            next_id = 0
+            if os.path.isdir(shards_dir):
+                for shard_id in self.shard_ids():
+                    with open(self._path("shards", f"{shard_id}.json"), 'r', encoding='utf-8') as f:
+                        covered.update(json.load(f))
+                    next_id = max(next_id, int(shard_id) + 1)
+                target_dir = shards_dir
+            else:
+                target_dir = self._path(f"shards.tmp-{os.getpid()}")
+                shutil.rmtree(target_dir, ignore_errors=True)
+                os.makedirs(target_dir)
+            shard, count = [], 0
+            for relative_path in relative_paths:
+                if relative_path in covered:
+                    continue
+                shard.append(relative_path)
+                if len(shard) == shard_size:
+                    atomic_write_text(os.path.join(target_dir, f"{next_id + count:06d}.json"), json.dumps(shard))
+                    os.utime(lock_path)
+                    shard, count = [], count + 1
+            if shard:
+                atomic_write_text(os.path.join(target_dir, f"{next_id + count:06d}.json"), json.dumps(shard))
+                count += 1
+            if target_dir != shards_dir:
+                try:
+                    os.rename(target_dir, shards_dir)
+                except OSError:
+                    # A worker that took over our lock finished first; keep its plan
+                    shutil.rmtree(target_dir, ignore_errors=True)
+                    return
+            atomic_write_text(planned_path, json.dumps({"owner": self.owner, "time": time.time()}))
+            if covered:
+                logging.info(f"Added {count} shard(s) of up to {shard_size} new image(s) to the plan in {self.shard_dir}.")
+            else:
+                logging.info(f"Planned {count} shard(s) of up to {shard_size} image(s) in {self.shard_dir}.")
+        finally:
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+
+    def shard_ids(self):
+        return sorted(name[:-len(".json")] for name in os.listdir(self._path("shards")) if name.endswith(".json"))
+
+    def is_finished(self, shard_id):
+        return os.path.exists(self._path("done", shard_id)) or os.path.exists(self._path("failed", shard_id))
+
+    def progress(self):
+        """
+        Return (done, failed, total) shard counts.
+        """
+        return len(os.listdir(self._path("done"))), len(os.listdir(self._path("failed"))), len(self.shard_ids())
+
+    def _try_claim(self, shard_id):
+        lease_path = self._path("leases", shard_id)
+        for _ in range(2):
+            if self._create_exclusive(lease_path):
+                # The shard may have finished between the listing and the claim
+                if self.is_finished(shard_id):
+                    os.remove(lease_path)
+                    return False
+                with self.lock:
+                    self.held.add(shard_id)
+                return True
+            if not self._take_over_if_stale(lease_path):
+                return False
+        return False
+
+    def claim(self):
+        """
+        Lease the next unfinished shard and return (shard_id, relative_paths), or None when every shard is finished.
+
+        Blocks while the only unfinished shards are leased by live workers, since
+        one of them may still crash and need its shard taken over.
+        """
+        remaining = self.shard_ids()
+        # Visit shards in random order so workers do not all race for the same lease
+        random.shuffle(remaining)
+        while remaining:
+            remaining = [shard_id for shard_id in remaining if not self.is_finished(shard_id)]
+            for shard_id in remaining:
+                if self._try_claim(shard_id):
+                    with open(self._path("shards", f"{shard_id}.json"), 'r', encoding='utf-8') as f:
+                        return shard_id, json.load(f)
+            if remaining:
+                time.sleep(self.poll_interval)
+        return None
+
+    def _release(self, shard_id):
+        with self.lock:
+            self.held.discard(shard_id)
+        try:
+            os.remove(self._path("leases", shard_id))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, shard_id, **extra):
+        atomic_write_text(self._path("done", shard_id), json.dumps(dict(extra, owner=self.owner, time=time.time())))
+        self._release(shard_id)
+
+    def fail(self, shard_id, error):
+        atomic_write_text(self._path("failed", shard_id), json.dumps({"owner": self.owner, "time": time.time(), "error": error}))
+        self._release(shard_id)
+
+    def claim_once(self, name):
+        """
+        Lease a once-per-run step such as the final batch refinement; True if this worker should run it.
+
+        The lease is kept alive by the heartbeat like a shard lease, so it is
+        taken over if its holder dies. Call finish_once(name) when the step
+        succeeded, which makes every later claim return False, or
+        release_once(name) to let another worker retry it.
+        """
+        if os.path.exists(self._path("once", f"{name}.done")):
+            return False
+        lease_path = self._path("once", f"{name}.lock")
+        for _ in range(2):
+            if self._create_exclusive(lease_path):
+                if os.path.exists(self._path("once", f"{name}.done")):
+                    os.remove(lease_path)
+                    return False
+                with self.lock:
+                    self.held_once.add(name)
+                return True
+            if not self._take_over_if_stale(lease_path):
+                return False
+        return False
+
+    def finish_once(self, name):
+        atomic_write_text(self._path("once", f"{name}.done"), json.dumps({"owner": self.owner, "time": time.time()}))
+        self.release_once(name)
+
+    def release_once(self, name):
+        with self.lock:
+            self.held_once.discard(name)
+        try:
+            os.remove(self._path("once", f"{name}.lock"))
+        except FileNotFoundError:
+            pass
+
+    def _heartbeat(self):
+        while not self.stop_event.wait(self.lease_timeout / 4):
+            with self.lock:
+                held = list(self.held)
+                held_once = list(self.held_once)
+            for shard_id in held:
+                try:
+                    os.utime(self._path("leases", shard_id))
+                except FileNotFoundError:
+                    logging.warning(f"Lease on shard {shard_id} was taken over; another worker is redoing it.")
+            for name in held_once:
+                try:
+                    os.utime(self._path("once", f"{name}.lock"))
+                except FileNotFoundError:
+                    logging.warning(f"Lease on {name} was taken over by another worker.")
+
+    def __enter__(self):
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop_event.set()
+        self.heartbeat_thread.join()
+        # Hand back shards we were interrupted on instead of making others wait out the lease
+        with self.lock:
+            held = list(self.held)
+            held_once = list(self.held_once)
+        for shard_id in held:
+            self._release(shard_id)
+        for name in held_once:
+            self.release_once(name)
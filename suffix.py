@@ -1,29 +1,86 @@
 import os
+import sys
+import re
+import argparse
+import caption_transforms
+
 
 def append_to_txt_files(folder_path, fixed_string):
     """
     Append a fixed string to all .txt files in the specified folder.
 
+    Captions that already end with the string are left alone, so running this twice does not duplicate it.
+
     :param folder_path: Path to the folder containing .txt files.
     :param fixed_string: The string to append to each .txt file.
     """
     if not os.path.exists(folder_path):
         print(f"Folder {folder_path} does not exist.")
         return
+    run(folder_path, [caption_transforms.AffixRule(suffix=fixed_string)])
+
+
+def run(folder_path, rules, workers=None, dry_run=False, include_initial=False):
+    """
+    Apply rules to every caption under folder_path and print what happened to each file.
+    """
+    counts = {"changed": 0, "unchanged": 0, "skipped": 0, "failed": 0}
+    for relative_path, status, detail in caption_transforms.transform_tree(
+        folder_path, rules, workers=workers, dry_run=dry_run, include_initial=include_initial
+    ):
+        counts[status] += 1
+        if status == "failed":
+            print(f"Failed to transform {relative_path}: {detail}")
+        elif dry_run and detail:
+            sys.stdout.write(detail)
+    verb = "Would change" if dry_run else "Changed"
+    print(
+        f"{verb} {counts['changed']} caption(s); {counts['unchanged']} unchanged, "
+        f"{counts['skipped']} already transformed, {counts['failed']} failed."
+    )
+
+
+def parse_substitution(value):
+    term, separator, trigger = value.partition("=")
+    if not separator or not term.strip():
+        raise argparse.ArgumentTypeError(f"expected TERM=TRIGGER, got {value!r}")
+    return term.strip(), trigger.strip()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Transform every caption under a folder with a pipeline of rules. "
+                    "Rules run in this order: --rules file, --regex, --substitute, --dedupe, --prefix/--suffix."
+    )
+    parser.add_argument("folder_path", type=str, help="Folder of .txt captions (searched recursively).")
+    parser.add_argument("--rules", type=str, default=None, help="JSON list of rule specs, e.g. [{\"type\": \"regex\", \"pattern\": \"...\", \"replacement\": \"\"}].")
+    parser.add_argument("--regex", nargs=2, action="append", default=[], metavar=("PATTERN", "REPLACEMENT"), help="Regex replacement; may be repeated.")
+    parser.add_argument("--substitute", type=parse_substitution, action="append", default=[], metavar="TERM=TRIGGER", help="Whole-word substitution, e.g. 'watch=RYMDWTH'; may be repeated.")
+    parser.add_argument("--dedupe", action="store_true", help="Drop repeated sentences and collapse whitespace.")
+    parser.add_argument("--prefix", type=str, default="", help="Text every caption should start with.")
+    parser.add_argument("--suffix", type=str, default="", help="Text every caption should end with, e.g. 'The product(s) is/are placed in a studio of STRSTY.'")
+    parser.add_argument("--include-initial", action="store_true", help="Also transform *_initial.txt captions.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPU count).")
+    parser.add_argument("--dry-run", action="store_true", help="Print unified diffs instead of writing.")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder_path):
+        parser.error(f"Folder {args.folder_path} does not exist.")
 
-    # Iterate through all files in the specified folder
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".txt"):  # Target only .txt files
-            file_path = os.path.join(folder_path, filename)
-            try:
-                with open(file_path, "a") as file:  # Open in append mode
-                    file.write(fixed_string)
-                print(f"Appended to {filename}")
-            except Exception as e:
-                print(f"Failed to append to {filename}: {e}")
-
-# Example usage
-folder_path = "/root/style/STRSTY-style-cap"
-fixed_string = "The product(s) is/are placed in a studio of STRSTY."
-append_to_txt_files(folder_path, fixed_string)
+    rules = []
+    try:
+        if args.rules:
+            rules.extend(caption_transforms.load_rules(args.rules))
+        rules.extend(caption_transforms.RegexRule(pattern, replacement) for pattern, replacement in args.regex)
+    except (ValueError, TypeError, OSError, re.error) as e:
+        parser.error(str(e))
+    if args.substitute:
+        rules.append(caption_transforms.SubstituteRule(dict(args.substitute)))
+    if args.dedupe:
+        rules.append(caption_transforms.DedupeRule())
+    if args.prefix or args.suffix:
+        rules.append(caption_transforms.AffixRule(prefix=args.prefix, suffix=args.suffix))
+    if not rules:
+        parser.error("No rules given.")
 
+    run(args.folder_path, rules, workers=args.workers, dry_run=args.dry_run, include_initial=args.include_initial)
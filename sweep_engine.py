@@ -0,0 +1,362 @@
+import io
+import os
+import csv
+import html
+import json
+import time
+import uuid
+import random
+import shutil
+import hashlib
+import logging
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import requests
+import caption_cache
+from run_manifest import RunManifest
+
+# LoRA fine-tune evaluated by default
+DEFAULT_MODEL_VERSION = "ch-ho00/cartier-model2-ft2:2a18f8c55504f8cecd9230142b1d2f2579d49c2018aeb65ad0426b0b266574f9"
+
+# Inputs of every prediction; grid values override them
+BASE_INPUT = {
+    "model": "dev",
+    "lora_scale": 1,
+    "num_outputs": 1,
+    "aspect_ratio": "1:1",
+    "output_format": "webp",
+    "guidance_scale": 3.5,
+    "output_quality": 90,
+    "prompt_strength": 0.8,
+    "extra_lora_scale": 1,
+    "num_inference_steps": 28,
+}
+
+MANIFEST_NAME = "sweep_manifest.jsonl"
+
+
+def parse_value(text):
+    """
+    Parse a CSV cell as an int, float, bool or JSON value, falling back to the string.
+    """
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def load_grid(path):
+    """
+    Load a sweep definition and return (base_input, points, varying parameter names).
+
+    YAML and JSON files hold an optional "base" dict of fixed inputs, a "grid"
+    dict of parameter -> list of values whose cartesian product is swept, and an
+    optional "points" list of extra explicit input dicts:
+
+        base: {num_outputs: 1}
+        grid:
+          prompt: ["a silver metal WTHCTR", "a gold WTHCTR on a wrist"]
+          lora_scale: [0.8, 1.0, 1.2]
+          guidance_scale: [3.0, 3.5]
+          num_inference_steps: [28]
+          seed: [1, 2, 3]
+
+    A CSV file holds one explicit point per row, with one column per input.
+    """
+    if path.lower().endswith(".csv"):
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            points = [
+                {name: parse_value(value) for name, value in row.items() if value is not None and value.strip() != ""}
+                for row in csv.DictReader(f)
+            ]
+        spec = {"points": points}
+    elif path.lower().endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError as e:
+            raise ImportError("YAML sweep files need PyYAML: pip install pyyaml (or write the grid as JSON or CSV)") from e
+        with open(path, 'r', encoding='utf-8') as f:
+            spec = yaml.safe_load(f) or {}
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            spec = json.load(f)
+
+    base_input = dict(spec.get("base") or {})
+    grid = spec.get("grid") or {}
+    for name, values in grid.items():
+        if not isinstance(values, list):
+            grid[name] = [values]
+    names = list(grid)
+    points = [dict(zip(names, values)) for values in itertools.product(*grid.values())] if grid else []
+    points += [dict(point) for point in spec.get("points") or []]
+    if not points:
+        raise ValueError(f"{path} defines no sweep points.")
+    if not all(point.get("prompt") or base_input.get("prompt") for point in points):
+        raise ValueError(f"Every sweep point in {path} needs a prompt.")
+
+    # Parameters that differ between points label the contact sheet
+    varying = [
+        name for name in dict.fromkeys(itertools.chain.from_iterable(points))
+        if len({json.dumps(point.get(name), sort_keys=True) for point in points}) > 1
+    ]
+    return base_input, points, varying
+
+
+def point_key(model_version, prediction_input):
+    """
+    Key of a grid point: the model version and the full input sent to it.
+    """
+    return caption_cache.make_key("sweep", model_version, prediction_input)
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket allowing requests_per_minute calls, with bursts up to burst.
+    """
+
+    def __init__(self, requests_per_minute, burst=None):
+        self.capacity = float(burst or max(1, requests_per_minute // 6))
+        self.tokens = self.capacity
+        self.fill_rate = requests_per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request may be sent.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.fill_rate
+            time.sleep(delay)
+
+
+class FakeReplicateClient:
+    """
+    Stand-in for replicate.Client that renders solid-colour images locally.
+
+    The colour is derived from the prediction input, so the same point always
+    gives the same image. latency seconds are slept per call and failure_rate of
+    the calls raise, to exercise concurrency, retries and resume offline.
+    """
+
+    def __init__(self, latency=0.5, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def run(self, model_version, input):
+        from PIL import Image
+
+        with self.lock:
+            failed = self.random.random() < self.failure_rate
+        time.sleep(self.latency)
+        if failed:
+            raise RuntimeError("fake prediction failed")
+        width, height = 256, 256
+        outputs = []
+        for index in range(int(input.get("num_outputs", 1))):
+            digest = hashlib.sha256(json.dumps([model_version, input, index], sort_keys=True).encode('utf-8')).digest()
+            buffer = io.BytesIO()
+            image_format = str(input.get("output_format", "webp")).upper().replace("JPG", "JPEG")
+            Image.new("RGB", (width, height), tuple(digest[:3])).save(buffer, format=image_format)
+            buffer.seek(0)
+            outputs.append(buffer)
+        return outputs
+
+
+def save_output(item, path, session=None, timeout=(5, 120)):
+    """
+    Stream one prediction output to path through a temporary file and an atomic rename.
+
+    item is a URL (older replicate clients) or a file-like object (FileOutput of
+    newer clients, or the fake client). Returns the number of bytes written.
+    """
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            if hasattr(item, "read"):
+                shutil.copyfileobj(item, f, 64 * 1024)
+            else:
+                with (session or requests).get(str(item), stream=True, timeout=timeout) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+            size = f.tell()
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return size
+
+
+def output_extension(item, prediction_input):
+    if not hasattr(item, "read"):
+        extension = os.path.splitext(str(item).split("?")[0])[1]
+        if extension:
+            return extension
+    return "." + str(prediction_input.get("output_format", "webp")).lower()
+
+
+class SweepRunner:
+    """
+    Run every point of a parameter sweep against a Replicate model and stream its images to disk.
+
+    Points run on concurrency threads, each prediction waiting on a shared rate
+    limiter; failures are retried with jittered backoff. Images are written to
+    <output_dir>/images/<key>_<n><ext> as soon as a prediction returns, and each
+    finished point is appended to <output_dir>/sweep_manifest.jsonl with its
+    inputs and image paths. On restart, points whose key (model version and full
+    input) is already done are skipped, so a grid can be extended and rerun and
+    only the new points are paid for. client is anything with a
+    replicate-style run(model_version, input=...) method.
+    """
+
+    def __init__(self, client, output_dir, model_version=DEFAULT_MODEL_VERSION, concurrency=4, requests_per_minute=60, retries=3):
+        self.client = client
+        self.output_dir = output_dir
+        self.model_version = model_version
+        self.concurrency = concurrency
+        self.retries = retries
+        self.limiter = RateLimiter(requests_per_minute)
+        self.session = requests.Session()
+        os.makedirs(os.path.join(output_dir, "images"), exist_ok=True)
+        self.manifest = RunManifest(os.path.join(output_dir, MANIFEST_NAME))
+
+    def prediction_inputs(self, base_input, points):
+        """
+        Return {key: prediction input} for the points, in grid order and without duplicates.
+        """
+        inputs = {}
+        for point in points:
+            prediction_input = {**BASE_INPUT, **base_input, **point}
+            inputs.setdefault(point_key(self.model_version, prediction_input), prediction_input)
+        return inputs
+
+    def _predict(self, key, prediction_input):
+        for attempt in range(self.retries + 1):
+            try:
+                self.limiter.acquire()
+                start_time = time.perf_counter()
+                output = self.client.run(self.model_version, input=prediction_input)
+                if not isinstance(output, list):
+                    output = [output]
+                paths = []
+                for index, item in enumerate(output):
+                    relative_path = os.path.join("images", f"{key[:16]}_{index}{output_extension(item, prediction_input)}")
+                    save_output(item, os.path.join(self.output_dir, relative_path), session=self.session)
+                    paths.append(relative_path)
+                return paths, time.perf_counter() - start_time
+            except Exception as e:
+                error = e
+                if attempt < self.retries:
+                    delay = random.uniform(0, min(60, 2 ** (attempt + 1)))
+                    logging.warning(f"Prediction {key[:16]} failed ({e}); retrying in {delay:.1f}s.")
+                    time.sleep(delay)
+        raise error
+
+    def run(self, base_input, points, progress=None):
+        """
+        Run the points not yet done; returns (succeeded, failed, skipped) counts.
+        """
+        inputs = self.prediction_inputs(base_input, points)
+        completed = self.manifest.keys_with_status("done")
+        pending = [(key, prediction_input) for key, prediction_input in inputs.items() if key not in completed]
+        skipped = len(inputs) - len(pending)
+        logging.info(f"{len(inputs)} sweep point(s): {skipped} already done, {len(pending)} to run.")
+        if progress is not None:
+            progress.total = len(pending)
+
+        succeeded = failed = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            in_flight = {}
+
+            def handle(future):
+                nonlocal succeeded, failed
+                key, prediction_input = in_flight.pop(future)
+                try:
+                    paths, seconds = future.result()
+                except Exception as e:
+                    logging.error(f"Sweep point {key[:16]} failed: {e}")
+                    self.manifest.mark(key, "failed", input=prediction_input, error=str(e))
+                    failed += 1
+                else:
+                    self.manifest.mark(key, "done", input=prediction_input, outputs=paths, seconds=seconds)
+                    succeeded += 1
+                if progress is not None:
+                    progress.update(1)
+
+            for key, prediction_input in pending:
+                # Queue a little ahead of the workers without building a future per grid point
+                while len(in_flight) >= self.concurrency * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        handle(future)
+                in_flight[executor.submit(self._predict, key, prediction_input)] = (key, prediction_input)
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle(future)
+        return succeeded, failed, skipped
+
+    def write_index(self, base_input, points, varying):
+        """
+        Write index.csv and an index.html contact sheet of the points in the grid.
+
+        The contact sheet has one section per prompt with a card per point,
+        labelled with the parameters that vary across the grid.
+        """
+        inputs = self.prediction_inputs(base_input, points)
+        rows = []
+        for key, prediction_input in inputs.items():
+            entry = self.manifest.entries.get(key) or {"status": "pending"}
+            rows.append((key, prediction_input, entry))
+
+        labels = [name for name in varying if name != "prompt"]
+        with open(os.path.join(self.output_dir, "index.csv"), 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["key", "status", "prompt", *labels, "outputs", "seconds", "error"])
+            for key, prediction_input, entry in rows:
+                writer.writerow([
+                    key, entry["status"], prediction_input.get("prompt"), *(prediction_input.get(name) for name in labels),
+                    " ".join(entry.get("outputs") or []), entry.get("seconds", ""), entry.get("error", "")
+                ])
+
+        sections = {}
+        for key, prediction_input, entry in rows:
+            sections.setdefault(prediction_input.get("prompt", ""), []).append((key, prediction_input, entry))
+        parts = [
+            "<!DOCTYPE html><html><head><meta charset='utf-8'><title>Sweep contact sheet</title><style>",
+            "body{font-family:sans-serif;margin:16px}.grid{display:flex;flex-wrap:wrap;gap:8px}",
+            ".card{width:200px;font-size:12px}.card img{width:200px;height:200px;object-fit:cover;display:block}",
+            ".missing{width:200px;height:200px;background:#eee;display:flex;align-items:center;justify-content:center}",
+            "</style></head><body>",
+            f"<h1>{html.escape(self.model_version)}</h1>",
+        ]
+        for prompt, cards in sections.items():
+            parts.append(f"<h2>{html.escape(str(prompt))}</h2><div class='grid'>")
+            for key, prediction_input, entry in cards:
+                label = "<br>".join(f"{html.escape(name)}={html.escape(str(prediction_input.get(name)))}" for name in labels)
+                images = "".join(
+                    f"<a href='{html.escape(path)}'><img loading='lazy' src='{html.escape(path)}'></a>"
+                    for path in entry.get("outputs") or []
+                ) or f"<div class='missing'>{html.escape(entry['status'])}</div>"
+                parts.append(f"<div class='card' title='{key}'>{images}{label}</div>")
+            parts.append("</div>")
+        parts.append("</body></html>")
+        with open(os.path.join(self.output_dir, "index.html"), 'w', encoding='utf-8') as f:
+            f.write("\n".join(parts))
+        logging.info(f"Wrote the contact sheet to {os.path.join(self.output_dir, 'index.html')}.")
+
+    def close(self):
+        self.session.close()
+        self.manifest.close()
@@ -0,0 +1,35 @@
+import os
+import sqlite3
+from caption_store import CaptionStore
+
+
+def committed_captions(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT image_id, caption FROM captions").fetchall()
+    finally:
+        conn.close()
+
+
+def test_flush_commits_grouped_writes(tmp_path):
+    path = os.path.join(str(tmp_path), "captions.sqlite")
+    store = CaptionStore(path, commit_every=256)
+    try:
+        store.put("img_001", "CAPTION", "final", "A silver watch.")
+        assert committed_captions(path) == []
+        store.flush()
+        assert committed_captions(path) == [("img_001", "A silver watch.")]
+    finally:
+        store.close()
+
+
+def test_stores_committing_every_write_share_one_file(tmp_path):
+    path = os.path.join(str(tmp_path), "captions.sqlite")
+    first, second = CaptionStore(path, commit_every=1), CaptionStore(path, commit_every=1)
+    try:
+        first.put("img_001", "CAPTION", "final", "A silver watch.")
+        second.put("img_002", "CAPTION", "final", "A gold watch.")
+        assert sorted(committed_captions(path)) == [("img_001", "A silver watch."), ("img_002", "A gold watch.")]
+    finally:
+        first.close()
+        second.close()
@@ -0,0 +1,26 @@
+import os
+from dedupe_index import DuplicateIndex, CAPTION, caption_collection
+
+CAPTION_TEXT = "A silver WTHCTR watch with a blue dial lies on a wooden desk next to a leather notebook."
+
+
+def test_captions_only_cluster_within_their_collection(tmp_path):
+    index = DuplicateIndex(os.path.join(str(tmp_path), "dedupe.sqlite"))
+    try:
+        for key in ["CAPTION/a", "CAPTION/b", "DETAILED_CAPTION/a"]:
+            index.add_caption(key, CAPTION_TEXT, collection=caption_collection(key))
+        assert index.clusters(CAPTION) == [["CAPTION/a", "CAPTION/b"]]
+        assert index.duplicates()[0] == {"CAPTION/b"}
+        assert [key for key, score in index.query_caption(CAPTION_TEXT, collection="DETAILED_CAPTION")] == ["DETAILED_CAPTION/a"]
+    finally:
+        index.close()
+
+
+def test_unchanged_captions_are_not_reindexed(tmp_path):
+    index = DuplicateIndex(os.path.join(str(tmp_path), "dedupe.sqlite"))
+    try:
+        assert index.add_caption("CAPTION/a", CAPTION_TEXT, collection="CAPTION")
+        assert not index.add_caption("CAPTION/a", CAPTION_TEXT, collection="CAPTION")
+        assert index.add_caption("CAPTION/a", CAPTION_TEXT + " It is raining.", collection="CAPTION")
+    finally:
+        index.close()
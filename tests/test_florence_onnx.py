@@ -0,0 +1,153 @@
+import zlib
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+import florence_onnx
+
+# Florence-2's generation config: the decoder starts from EOS, BOS and EOS are forced
+START, BOS, EOS, PAD = 2, 0, 2, 1
+VOCAB = 16
+NO_REPEAT_NGRAM_SIZE = 3
+FEEDS = {
+    "input_ids", "encoder_hidden_states", "encoder_attention_mask",
+    "past.0.self.key", "past.0.self.value", "past.0.cross.key", "past.0.cross.value",
+}
+
+
+def logits_for(history):
+    """
+    Fixed logits per decoded prefix, so both searches see the same scores for the same hypothesis.
+    """
+    logits = np.empty((len(history), VOCAB), dtype=np.float32)
+    for row, tokens in enumerate(history):
+        rng = np.random.default_rng(zlib.crc32(np.asarray(tokens, dtype=np.int64).tobytes()))
+        logits[row] = rng.normal(scale=3.0, size=VOCAB)
+    logits[:, PAD] = -1e4
+    return logits
+
+
+class StubDecoder:
+    """
+    Stands in for the decoder graphs; the self-attention cache carries the decoded prefix.
+    """
+
+    def __init__(self, with_past):
+        self.with_past = with_past
+
+    def run(self, output_names, feeds):
+        history = feeds["input_ids"]
+        if self.with_past:
+            history = np.concatenate([feeds["past.0.self.key"], history], axis=1)
+        logits = logits_for(history)[:, None, :]
+        if self.with_past:
+            return [logits, history, history]
+        cross = np.zeros((len(history), 1), dtype=np.float32)
+        return [logits, history, history, cross, cross]
+
+
+def stub_model(length_penalty=1.0):
+    model = object.__new__(florence_onnx.OnnxFlorenceModel)
+    model.num_layers = 1
+    model.generation = {
+        "decoder_start_token_id": START,
+        "bos_token_id": BOS,
+        "eos_token_id": EOS,
+        "pad_token_id": PAD,
+        "forced_bos_token_id": BOS,
+        "forced_eos_token_id": EOS,
+        "no_repeat_ngram_size": NO_REPEAT_NGRAM_SIZE,
+        "length_penalty": length_penalty,
+    }
+    model.sessions = {"decoder_init": StubDecoder(with_past=False), "decoder_with_past": StubDecoder(with_past=True)}
+    model.input_names = {name: FEEDS for name in model.sessions}
+    return model
+
+
+def encoder_outputs(batch_size):
+    return np.zeros((batch_size, 4, 8), dtype=np.float32), np.ones((batch_size, 4), dtype=np.int64)
+
+
+def logits_processors(max_length):
+    return transformers.LogitsProcessorList([
+        transformers.NoRepeatNGramLogitsProcessor(NO_REPEAT_NGRAM_SIZE),
+        transformers.ForcedBOSTokenLogitsProcessor(BOS),
+        transformers.ForcedEOSTokenLogitsProcessor(max_length, EOS),
+    ])
+
+
+def reference_greedy(batch_size, max_length):
+    processors = logits_processors(max_length)
+    input_ids = torch.full((batch_size, 1), START, dtype=torch.long)
+    unfinished = torch.ones(batch_size, dtype=torch.bool)
+    while input_ids.shape[-1] < max_length:
+        scores = processors(input_ids, torch.from_numpy(logits_for(input_ids.numpy())))
+        next_tokens = torch.where(unfinished, scores.argmax(dim=-1), torch.full((batch_size,), PAD, dtype=torch.long))
+        input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+        unfinished &= next_tokens != EOS
+        if not unfinished.any():
+            break
+    return input_ids.tolist()
+
+
+def reference_beam_search(batch_size, max_length, num_beams, early_stopping, length_penalty):
+    if not hasattr(transformers, "BeamSearchScorer"):
+        pytest.skip("this transformers version has no BeamSearchScorer")
+    processors = logits_processors(max_length)
+    scorer = transformers.BeamSearchScorer(
+        batch_size=batch_size, num_beams=num_beams, device="cpu", length_penalty=length_penalty,
+        do_early_stopping=early_stopping, num_beam_hyps_to_keep=1, max_length=max_length
+    )
+    input_ids = torch.full((batch_size * num_beams, 1), START, dtype=torch.long)
+    beam_scores = torch.zeros((batch_size, num_beams))
+    beam_scores[:, 1:] = -1e9
+    beam_scores = beam_scores.view(-1)
+    while input_ids.shape[-1] < max_length:
+        scores = torch.log_softmax(torch.from_numpy(logits_for(input_ids.numpy())), dim=-1)
+        scores = processors(input_ids, scores)
+        next_scores = (scores + beam_scores[:, None]).view(batch_size, num_beams * VOCAB)
+        next_scores, next_tokens = torch.topk(next_scores, 2 * num_beams, dim=1, largest=True, sorted=True)
+        next_indices = next_tokens // VOCAB
+        next_tokens = next_tokens % VOCAB
+        outputs = scorer.process(input_ids, next_scores, next_tokens, next_indices, pad_token_id=PAD, eos_token_id=EOS)
+        beam_scores = outputs["next_beam_scores"]
+        input_ids = torch.cat([input_ids[outputs["next_beam_indices"]], outputs["next_beam_tokens"][:, None]], dim=-1)
+        if scorer.is_done:
+            break
+    sequences = scorer.finalize(
+        input_ids, beam_scores, next_tokens, next_indices, pad_token_id=PAD, eos_token_id=EOS, max_length=max_length
+    )["sequences"]
+    return [strip_padding(row) for row in sequences.tolist()]
+
+
+def strip_padding(tokens):
+    tokens = [int(token) for token in tokens]
+    while tokens and tokens[-1] == PAD:
+        tokens.pop()
+    return tokens
+
+
+def test_greedy_search_matches_transformers():
+    model = stub_model()
+    sequences = model._greedy_search(*encoder_outputs(4), max_length=12)
+    assert [[int(token) for token in row] for row in sequences] == reference_greedy(4, 12)
+
+
+@pytest.mark.parametrize("early_stopping", [True, False])
+@pytest.mark.parametrize("length_penalty", [1.0, 2.0])
+def test_beam_search_matches_transformers(early_stopping, length_penalty):
+    model = stub_model(length_penalty=length_penalty)
+    sequences = model._beam_search(*encoder_outputs(2), max_length=12, num_beams=3, early_stopping=early_stopping)
+    assert [strip_padding(row) for row in sequences] == reference_beam_search(2, 12, 3, early_stopping, length_penalty)
+
+
+def test_no_repeat_ngram_and_forced_tokens_match_transformers():
+    model = stub_model()
+    rng = np.random.default_rng(0)
+    input_ids = rng.integers(3, 6, size=(3, 7)).astype(np.int64)
+    for cur_len, max_length in [(7, 20), (1, 20), (7, 8)]:
+        prefix = input_ids[:, :cur_len]
+        scores = rng.normal(size=(3, VOCAB)).astype(np.float32)
+        expected = logits_processors(max_length)(torch.from_numpy(prefix), torch.from_numpy(scores.copy())).numpy()
+        assert np.array_equal(model._process_scores(prefix, scores, cur_len, max_length), expected)
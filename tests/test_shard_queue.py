@@ -0,0 +1,50 @@
+import os
+import time
+from shard_queue import ShardQueue
+
+
+def all_paths(queue):
+    paths = []
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            return paths
+        shard_id, relative_paths = claimed
+        paths += relative_paths
+        queue.complete(shard_id)
+
+
+def test_replanning_appends_shards_for_new_paths(tmp_path):
+    queue = ShardQueue(str(tmp_path), poll_interval=0.01)
+    queue.plan([f"img_{i}.jpg" for i in range(5)], shard_size=2)
+    assert queue.shard_ids() == ["000000", "000001", "000002"]
+    assert len(all_paths(queue)) == 5
+
+    queue.plan([f"img_{i}.jpg" for i in range(8)], shard_size=2)
+    assert queue.shard_ids() == ["000000", "000001", "000002", "000003", "000004"]
+    assert sorted(all_paths(queue)) == ["img_5.jpg", "img_6.jpg", "img_7.jpg"]
+
+
+def test_finished_once_step_is_not_rerun(tmp_path):
+    first = ShardQueue(str(tmp_path))
+    second = ShardQueue(str(tmp_path))
+    assert first.claim_once("batch_refine")
+    assert not second.claim_once("batch_refine")
+    first.finish_once("batch_refine")
+    assert not second.claim_once("batch_refine")
+
+
+def test_released_once_step_can_be_retried(tmp_path):
+    first = ShardQueue(str(tmp_path))
+    assert first.claim_once("batch_refine")
+    first.release_once("batch_refine")
+    assert ShardQueue(str(tmp_path)).claim_once("batch_refine")
+
+
+def test_stale_once_lease_is_taken_over(tmp_path):
+    crashed = ShardQueue(str(tmp_path), lease_timeout=60)
+    assert crashed.claim_once("batch_refine")
+    lease_path = os.path.join(str(tmp_path), "once", "batch_refine.lock")
+    stale = time.time() - 120
+    os.utime(lease_path, (stale, stale))
+    assert ShardQueue(str(tmp_path), lease_timeout=60).claim_once("batch_refine")
@@ -0,0 +1,39 @@
+import os
+import json
+import sweep_engine
+
+
+def write_grid(tmp_path, spec):
+    path = os.path.join(str(tmp_path), "grid.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(spec, f)
+    return path
+
+
+def test_grid_values_override_base_values(tmp_path):
+    base_input, points, varying = sweep_engine.load_grid(write_grid(tmp_path, {
+        "base": {"prompt": "a WTHCTR", "lora_scale": 1.0, "num_outputs": 1},
+        "grid": {"lora_scale": [0.8, 1.2]},
+    }))
+    runner = sweep_engine.SweepRunner(sweep_engine.FakeReplicateClient(latency=0), os.path.join(str(tmp_path), "out"))
+    try:
+        inputs = list(runner.prediction_inputs(base_input, points).values())
+    finally:
+        runner.close()
+    assert varying == ["lora_scale"]
+    assert [prediction_input["lora_scale"] for prediction_input in inputs] == [0.8, 1.2]
+    assert all(prediction_input["prompt"] == "a WTHCTR" for prediction_input in inputs)
+
+
+def test_rerun_skips_done_points(tmp_path):
+    base_input, points, varying = sweep_engine.load_grid(write_grid(tmp_path, {
+        "base": {"prompt": "a WTHCTR", "num_inference_steps": 4},
+        "grid": {"seed": [1, 2, 1]},
+    }))
+    output_dir = os.path.join(str(tmp_path), "out")
+    for expected in [(2, 0, 0), (0, 0, 2)]:
+        runner = sweep_engine.SweepRunner(sweep_engine.FakeReplicateClient(latency=0), output_dir, requests_per_minute=6000)
+        try:
+            assert runner.run(base_input, points) == expected
+        finally:
+            runner.close()
@@ -0,0 +1,52 @@
+import pytest
+from trigger_rewriter import CaptionRewriter
+
+
+@pytest.fixture
+def rewriter():
+    return CaptionRewriter()
+
+
+@pytest.mark.parametrize("caption", [
+    "The Possession of Overseas assets in Riviera.",
+    "A yacht off the Riviera near Portofino at sunset.",
+    "A Submersible drone and the Polaris star above Clifton Bridge.",
+    "King Arthur holds Excalibur, part of the national Patrimony.",
+])
+def test_ordinary_sentences_pass_through_unchanged(rewriter, caption):
+    text, flags = rewriter.rewrite(caption)
+    assert text == caption
+    assert "no_trigger" in flags
+
+
+def test_ambiguous_model_name_next_to_brand_is_replaced(rewriter):
+    text, flags = rewriter.rewrite("The image shows a Vacheron Constantin Overseas watch on a wrist.")
+    assert text == "A RYMDWTH on a wrist."
+    assert flags == []
+
+
+def test_ambiguous_model_name_needs_its_capitalization(rewriter):
+    text, _ = rewriter.rewrite("An overseas watch on a table.")
+    assert text == "An overseas RYMDWTH on a table."
+
+
+def test_brand_names_match_in_any_case(rewriter):
+    text, flags = rewriter.rewrite("A cartier tank watch with a leather strap.")
+    assert text == "A RYMDWTH with a leather strap."
+    assert flags == []
+
+
+def test_several_substitutions_are_flagged(rewriter):
+    _, flags = rewriter.rewrite("A Panerai Submersible next to a Cartier Santos.")
+    assert "multiple_substitutions" in flags
+
+
+@pytest.mark.parametrize("caption, expected", [
+    ("The watch's strap is brown.", "The RYMDWTH's strap is brown."),
+    ("The timepiece’s bezel is polished.", "The RYMDWTH’s bezel is polished."),
+    # A possessive inside one product mention still collapses into a single trigger word
+    ("A close-up of IWC's Portugieser dial.", "A close-up of RYMDWTH dial."),
+])
+def test_possessives_are_kept(rewriter, caption, expected):
+    text, _ = rewriter.substitute(caption)
+    assert text == expected
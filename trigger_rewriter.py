@@ -0,0 +1,223 @@
+import re
+
+DEFAULT_TRIGGER = "RYMDWTH"
+
+# Words for the product itself; always replaced by the trigger word
+GENERIC_TERMS = ("watch", "watches", "wristwatch", "wristwatches", "timepiece", "timepieces")
+
+# Richemont maisons, and model names no ordinary caption uses; replaced wherever they appear, in any case.
+# Longer names win over their prefixes
+BRAND_NAMES = (
+    "Jaeger-LeCoultre", "Jaeger LeCoultre", "Jaeger-LeCoultre Master Ultra Thin", "Jaeger-LeCoultre Reverso", "Reverso",
+    "Cartier", "Cartier Tank", "Tank Louis Cartier", "Cartier Santos", "Santos de Cartier",
+    "Ballon Bleu", "Ballon Bleu de Cartier", "Pasha de Cartier", "Panthère de Cartier",
+    "IWC", "IWC Schaffhausen", "Portugieser",
+    "Panerai", "Luminor", "Radiomir",
+    "Piaget", "Piaget Polo", "Altiplano",
+    "Vacheron Constantin", "Traditionnelle",
+    "A. Lange & Söhne", "Saxonia", "Zeitwerk",
+    "Baume & Mercier",
+    "Roger Dubuis",
+    "Montblanc", "Montblanc 1858", "Montblanc Star Legacy",
+)
+
+# Model names that are also ordinary words ("Overseas assets", "the Riviera"); replaced only when
+# capitalized as written here and within NEIGHBOUR_WORDS words of a brand name or generic term,
+# e.g. "Vacheron Constantin Overseas" or "an Overseas watch"
+DEFAULT_MODEL_NAMES = (
+    "Master Ultra Thin", "Polaris", "Tank Must", "Portofino", "Pilot's Watch", "Submersible",
+    "Possession", "Overseas", "Patrimony", "Lange 1", "Clifton", "Riviera", "Excalibur",
+)
+
+NEIGHBOUR_WORDS = 2
+
+# Sentence openers the GPT prompt asks to drop
+OPENER_PATTERN = re.compile(
+    r"^\s*(?:"
+    r"the (?:image|photo|photograph|picture) (?:shows|displays|features|depicts|captures|presents|is of)"
+    r"|(?:this|in this|in the) (?:image|photo|photograph|picture)(?: shows| displays| features| depicts)?,?"
+    r"|displayed (?:here )?is|shown (?:here )?is|pictured (?:here )?is"
+    r")\s+",
+    re.IGNORECASE
+)
+
+# Marketing filler; sentences containing any of these are dropped
+FILLER_PATTERN = re.compile(
+    r"glimpse into|elegance and sophistication|sophistication and elegance|timeless elegance|"
+    r"perfect for any occasion|a true testament|exudes (?:luxury|elegance|sophistication)|"
+    r"making it (?:a|an|the) (?:perfect|ideal|stylish)|a statement piece|sense of luxury",
+    re.IGNORECASE
+)
+
+WORD_PATTERN = re.compile(r"[\w'’.&-]+")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def _normalize_word(word):
+    word = word.lower().strip(".,;:!?").replace("’", "'")
+    # "IWC's Portugieser" should match like "IWC Portugieser"
+    return word[:-2] if word.endswith("'s") else word
+
+
+def split_words(text):
+    """
+    Return (start, end, normalized word, word) for each word of text.
+    """
+    return [(match.start(), match.end(), _normalize_word(match.group()), match.group()) for match in WORD_PATTERN.finditer(text)]
+
+
+class TermTrie:
+    """
+    Word-level trie over multi-word names for longest-match replacement in one left-to-right pass.
+
+    Matching walks the trie from every word start and keeps the longest name
+    that ends on a word boundary, so the cost is linear in the caption length
+    times the longest name, independent of how many names are in the dictionary.
+    """
+
+    def __init__(self, names=()):
+        self.root = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        node = self.root
+        for word in WORD_PATTERN.findall(name):
+            node = node.setdefault(_normalize_word(word), {})
+        node[None] = name
+
+    def find_all(self, text, accept=None):
+        """
+        Yield (start, end, name) of non-overlapping longest matches in text.
+        """
+        words = split_words(text)
+        for i, end_index, name in self.match_words(words, accept):
+            # Keep trailing sentence punctuation that the word pattern swallowed
+            end = words[end_index - 1][1]
+            while end > words[i][0] and text[end - 1] in ".,;:!?":
+                end -= 1
+            # Keep the possessive too: "the watch's strap" becomes "the RYMDWTH's strap"
+            if end - 2 > words[i][0] and text[end - 2:end].lower() in ("'s", "’s") and not name.lower().replace("’", "'").endswith("'s"):
+                end -= 2
+            yield words[i][0], end, name
+
+    def match_words(self, words, accept=None):
+        """
+        Yield (first word index, end word index, name) of non-overlapping longest matches in split_words() output.
+
+        accept(i, j, name) may reject a match, in which case the next shorter match at i is tried.
+        """
+        i = 0
+        while i < len(words):
+            node = self.root
+            matches = []
+            j = i
+            while j < len(words) and words[j][2] in node:
+                node = node[words[j][2]]
+                j += 1
+                if None in node:
+                    matches.append((j, node[None]))
+            for end_index, name in reversed(matches):
+                if accept is None or accept(i, end_index, name):
+                    yield i, end_index, name
+                    i = end_index
+                    break
+            else:
+                i += 1
+
+
+class CaptionRewriter:
+    """
+    Deterministic local version of the GPT trigger-word revision.
+
+    rewrite(caption) returns (text, flags): brand names, model names and
+    generic words for the product become the trigger word, "The image
+    shows"/"Displayed is" openers are dropped and sentences of marketing filler
+    are removed. Model names that are also ordinary words (model_names) are
+    only replaced when capitalized as listed and next to a brand name or
+    generic term, so "Overseas assets on the Riviera" is left alone. flags lists
+    reasons the result still needs an LLM pass: no product word was found to
+    replace, or more than one name was replaced and the rewrite should be
+    checked.
+    """
+
+    def __init__(self, trigger=DEFAULT_TRIGGER, model_names=DEFAULT_MODEL_NAMES, generic_terms=GENERIC_TERMS, brand_names=BRAND_NAMES):
+        self.trigger = trigger
+        self.generic_terms = {_normalize_word(term) for term in generic_terms}
+        self.ambiguous_names = set(model_names) - set(brand_names)
+        self.anchor_trie = TermTrie(list(brand_names) + list(generic_terms))
+        self.trie = TermTrie(list(brand_names) + list(model_names) + list(generic_terms))
+        self.repeated_trigger = re.compile(rf"\b{re.escape(trigger)}(?:(?:\s+|'s\s+){re.escape(trigger)}\b)+")
+
+    def substitute(self, text):
+        """
+        Return (text with names and generic terms replaced by the trigger word, one replaced name per product mention).
+        """
+        words = split_words(text)
+        anchors = [(i, j) for i, j, _ in self.anchor_trie.match_words(words)]
+
+        def accept(i, j, name):
+            if name not in self.ambiguous_names:
+                return True
+            # Written exactly as the model name, e.g. "Overseas" but not "overseas"
+            name_words = [word.strip(".,;:!?").replace("’", "'") for _, _, _, word in split_words(name)]
+            text_words = [word.strip(".,;:!?").replace("’", "'") for _, _, _, word in words[i:j]]
+            text_words[-1] = text_words[-1][:-2] if text_words[-1].endswith("'s") and not name_words[-1].endswith("'s") else text_words[-1]
+            if text_words != name_words:
+                return False
+            return any(
+                0 <= i - anchor_end <= NEIGHBOUR_WORDS or 0 <= anchor_start - j <= NEIGHBOUR_WORDS
+                for anchor_start, anchor_end in anchors
+            )
+
+        parts = []
+        names = []
+        last = 0
+        named_run = False
+        for start, end, name in self.trie.find_all(text, accept=accept):
+            if last == 0 or text[last:start].strip():
+                # Not directly after the previous match, so a new mention of the product starts
+                named_run = False
+            parts.append(text[last:start])
+            parts.append(self.trigger)
+            last = end
+            # "Vacheron Constantin Overseas" is one name, "a Cartier Santos and a Panerai" two
+            if _normalize_word(name) not in self.generic_terms and not named_run:
+                names.append(name)
+                named_run = True
+        parts.append(text[last:])
+        # "Cartier Tank watch" becomes "RYMDWTH RYMDWTH"; keep one
+        return self.repeated_trigger.sub(self.trigger, "".join(parts)), names
+
+    def clean_sentences(self, text):
+        sentences = []
+        for sentence in SENTENCE_END.split(" ".join(text.split())):
+            stripped = OPENER_PATTERN.sub("", sentence, count=1)
+            if stripped != sentence and stripped:
+                stripped = stripped[0].upper() + stripped[1:]
+            if FILLER_PATTERN.search(stripped):
+                continue
+            if stripped:
+                sentences.append(stripped)
+        return " ".join(sentences)
+
+    def rewrite(self, caption):
+        flags = []
+        substituted, names = self.substitute(caption)
+        text = self.clean_sentences(substituted)
+        if not text:
+            return caption.strip(), ["empty"]
+        if self.trigger not in text:
+            flags.append("no_trigger")
+        if len(names) > 1:
+            # Several names in one caption are often a misread or a comparison; let GPT check the rewrite
+            flags.append("multiple_substitutions")
+        return text, flags
+
+
+def load_model_names(path):
+    """
+    One model or brand name per line; blank lines and # comments are ignored.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
@@ -1,53 +1,282 @@
 import os
-import json
+import io
+import re
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import requests
-from pprint import pprint
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
+from PIL import Image
+import image_scanner
+from image_hashes import dhash, PerceptualIndex
+from run_manifest import RunManifest
 
-load_dotenv()
-subscription_key = os.getenv('BING_SEARCH_V7_SUBSCRIPTION_KEY')
-endpoint = os.getenv('BING_SEARCH_V7_ENDPOINT')
-
-if not subscription_key or not endpoint:
-    raise ValueError("Please make sure your BING_SEARCH_V7_SUBSCRIPTION_KEY and BING_SEARCH_V7_ENDPOINT are set in your environment variables or .env file")
-
-search_url = f"{endpoint}/v7.0/search"
-save_dir = "imgs"
-os.makedirs(save_dir, exist_ok=True)
-query = "Cartier Watch W2PA0008"
-mkt = 'en-US'
-params = {'q': query, 'mkt': mkt}
-headers = {'Ocp-Apim-Subscription-Key': subscription_key}
-
-try:
-    response = requests.get(search_url, headers=headers, params=params)
-    response.raise_for_status()
-
-    print("\nHeaders:\n")
-    pprint(response.headers)
-
-    search_results = response.json()
-    images_saved = 0
-    for i, result in enumerate(search_results['images']['value']):
-        image_url = result['contentUrl']
-        if image_url:
+# File extension for each format detected from the magic bytes
+FORMAT_EXTENSIONS = {"jpeg": ".jpg", "png": ".png", "gif": ".gif", "bmp": ".bmp", "tiff": ".tiff", "webp": ".webp"}
+
+
+def make_session(pool_size, retries=3):
+    """
+    requests.Session with a connection pool of pool_size and retries on connection errors, 429 and 5xx.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class BingImageSearch:
+    """
+    Bing Image Search v7 backend.
+
+    search(query, offset, count) returns (results, next_offset) where each result
+    is a dict with at least "url"; next_offset is None when there are no more
+    results. Any server that answers /v7.0/images/search in the same JSON shape,
+    such as a local mock, can be used by pointing endpoint at it.
+    """
+
+    def __init__(self, endpoint, subscription_key, session, mkt="en-US", timeout=20):
+        self.search_url = f"{endpoint.rstrip('/')}/v7.0/images/search"
+        self.headers = {'Ocp-Apim-Subscription-Key': subscription_key} if subscription_key else {}
+        self.session = session
+        self.mkt = mkt
+        self.timeout = timeout
+
+    def search(self, query, offset, count):
+        response = self.session.get(
+            self.search_url,
+            headers=self.headers,
+            params={'q': query, 'mkt': self.mkt, 'offset': offset, 'count': count},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        data = response.json()
+        results = [
+            {"url": item["contentUrl"], "name": item.get("name"), "source": item.get("hostPageUrl")}
+            for item in data.get("value", []) if item.get("contentUrl")
+        ]
+        next_offset = data.get("nextOffset")
+        total = data.get("totalEstimatedMatches")
+        if not results or next_offset is None or next_offset <= offset or (total is not None and next_offset >= total):
+            next_offset = None
+        return results, next_offset
+
+
+SEARCH_BACKENDS = {"bing": BingImageSearch}
+
+
+def read_queries(path):
+    """
+    One query per line; blank lines and lines starting with # are ignored.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def slugify(text):
+    return re.sub(r"[^A-Za-z0-9]+", "_", text).strip("_")[:60] or "query"
+
+
+def iter_search_results(backend, query, manifest, max_pages, per_page):
+    """
+    Yield the results of up to max_pages pages of a query.
+
+    Each fetched page is recorded in the manifest, so a resumed run replays it instead of searching again.
+    """
+    offset = 0
+    for _ in range(max_pages):
+        page_key = f"search:{query}:{offset}"
+        entry = manifest.entries.get(page_key)
+        if entry and entry["status"] == "done":
+            results, next_offset = entry["results"], entry["next_offset"]
+        else:
             try:
-              image_data = requests.get(image_url).content
-              image_extension = '.jpg'
-              image_filename = os.path.join(save_dir, f"{query.replace(' ', '_')}_{i}{image_extension}")
-              with open(image_filename, 'wb') as image_file:
-                  image_file.write(image_data)
-              print(f"Saved image {i+1}: {image_filename}")
-              images_saved += 1
+                results, next_offset = backend.search(query, offset, per_page)
             except Exception as e:
-                print(f"Failed to download image {i+1}: {e}")
+                print(f"Search failed for {query!r} at offset {offset}: {e}")
+                return
+            manifest.mark(page_key, "done", results=results, next_offset=next_offset)
+        yield from results
+        if next_offset is None:
+            return
+        offset = next_offset
+
+
+class Deduplicator:
+    """
+    Exact (sha256) and perceptual (dHash) duplicate check shared by the download threads.
+    """
+
+    def __init__(self, max_distance):
+        self.lock = threading.Lock()
+        self.digests = {}
+        self.perceptual = PerceptualIndex(max_distance=max_distance) if max_distance >= 0 else None
+
+    def add(self, path, digest, phash):
+        """
+        Register an image; return the path of the image it duplicates, or None if it is new.
+        """
+        with self.lock:
+            if digest in self.digests:
+                return self.digests[digest]
+            if self.perceptual is not None and phash is not None:
+                matches = self.perceptual.query(phash)
+                if matches:
+                    return matches[0][0]
+                self.perceptual.add(path, phash)
+            self.digests[digest] = path
+            return None
+
+
+def fetch_image(session, url, timeout, max_bytes):
+    """
+    Download url into memory, refusing bodies larger than max_bytes.
+    """
+    with session.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            size += len(chunk)
+            if size > max_bytes:
+                raise ValueError(f"larger than {max_bytes} bytes")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def harvest_image(session, result, query, save_dir, dedup, timeout, max_bytes):
+    """
+    Download one search result, detect its format and save it unless it duplicates a kept image.
+
+    Returns (status, extra) for the manifest.
+    """
+    start_time = time.perf_counter()
+    data = fetch_image(session, result["url"], timeout, max_bytes)
+    image_format = image_scanner.sniff_image_format(data[:16])
+    if image_format is None:
+        return "rejected", {"error": "not a supported image format"}
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.load()
+            phash = dhash(image)
+    except Exception as e:
+        return "rejected", {"error": f"cannot decode image: {e}"}
+
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(save_dir, f"{slugify(query)}_{digest[:16]}{FORMAT_EXTENSIONS[image_format]}")
+    duplicate_of = dedup.add(path, digest, phash)
+    if duplicate_of is not None:
+        return "duplicate", {"duplicate_of": duplicate_of, "sha256": digest}
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return "done", {
+        "path": path, "sha256": digest, "phash": f"{phash:016x}", "format": image_format,
+        "bytes": len(data), "seconds": round(time.perf_counter() - start_time, 3)
+    }
+
+
+def main(queries, backend, session, save_dir, max_pages=1, per_page=50, concurrency=8, timeout=20,
+         max_bytes=20 * 1024 * 1024, phash_distance=4):
+    """
+    Search every query, page through the results and download the images with a bounded thread pool.
+
+    Progress is kept in <save_dir>/harvest_manifest.jsonl: searched pages are
+    replayed instead of re-queried, finished URLs are skipped, and the hashes of
+    kept images seed the duplicate check, so an interrupted harvest resumes.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    manifest = RunManifest(os.path.join(save_dir, "harvest_manifest.jsonl"))
+    dedup = Deduplicator(phash_distance)
+    for key, entry in manifest.entries.items():
+        if key.startswith("url:") and entry["status"] == "done" and os.path.exists(entry["path"]):
+            dedup.add(entry["path"], entry["sha256"], int(entry["phash"], 16))
+    finished = {
+        key for key, entry in manifest.entries.items()
+        if key.startswith("url:") and entry["status"] in ("done", "duplicate", "rejected")
+    }
+    print(f"{len(finished)} URL(s) already handled according to the manifest.")
+
+    counts = {"done": 0, "duplicate": 0, "rejected": 0, "failed": 0}
+
+    def handle(future, key):
+        try:
+            status, extra = future.result()
+        except Exception as e:
+            status, extra = "failed", {"error": str(e)}
+        manifest.mark(key, status, **extra)
+        counts[status] += 1
+        if status == "done":
+            print(f"Saved {extra['path']} ({extra['format']}, {extra['bytes']} bytes, {extra['seconds']}s)")
+        elif status != "duplicate":
+            print(f"Skipped {key[len('url:'):]}: {extra.get('error')}")
+
+    seen = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = {}
+        for query in queries:
+            for result in iter_search_results(backend, query, manifest, max_pages, per_page):
+                key = f"url:{result['url']}"
+                if key in finished or key in seen:
+                    continue
+                seen.add(key)
+                # Keep the number of queued downloads bounded
+                while len(in_flight) >= concurrency * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        handle(future, in_flight.pop(future))
+                future = executor.submit(harvest_image, session, result, query, save_dir, dedup, timeout, max_bytes)
+                in_flight[future] = key
+        for future in list(in_flight):
+            handle(future, in_flight.pop(future))
+    manifest.close()
+
+    print(
+        f"Saved {counts['done']} image(s); dropped {counts['duplicate']} duplicate(s), "
+        f"{counts['rejected']} rejected and {counts['failed']} failed download(s)."
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Harvest images for many search queries with deduplication.")
+    parser.add_argument("queries_file", type=str, help="Text file with one search query per line.")
+    parser.add_argument("--output", type=str, default="imgs", help="Folder the images are saved to.")
+    parser.add_argument("--backend", choices=sorted(SEARCH_BACKENDS), default="bing", help="Search backend.")
+    parser.add_argument("--endpoint", type=str, default=None, help="Search endpoint; defaults to BING_SEARCH_V7_ENDPOINT (point it at a mock server for tests).")
+    parser.add_argument("--mkt", type=str, default="en-US", help="Search market.")
+    parser.add_argument("--pages", type=int, default=1, help="Result pages to fetch per query.")
+    parser.add_argument("--per-page", type=int, default=50, help="Results requested per page.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of downloads in flight.")
+    parser.add_argument("--timeout", type=float, default=20, help="Per-request timeout in seconds.")
+    parser.add_argument("--max-mb", type=float, default=20, help="Skip images larger than this.")
+    parser.add_argument("--phash-distance", type=int, default=4, help="Drop images within this many dHash bits of a kept one (-1 keeps near-duplicates).")
+    args = parser.parse_args()
 
-    if images_saved == 0:
-        print("No images found in the search results.")
-    else:
-        print(f"Total images saved: {images_saved}")
+    load_dotenv()
+    subscription_key = os.getenv('BING_SEARCH_V7_SUBSCRIPTION_KEY')
+    endpoint = args.endpoint or os.getenv('BING_SEARCH_V7_ENDPOINT')
+    if not endpoint or (not subscription_key and not args.endpoint):
+        parser.error("Please make sure your BING_SEARCH_V7_SUBSCRIPTION_KEY and BING_SEARCH_V7_ENDPOINT are set in your environment variables or .env file")
 
-except requests.exceptions.HTTPError as http_err:
-    print(f"HTTP error occurred: {http_err}")
-except Exception as ex:
-    print(f"An error occurred: {ex}")
+    session = make_session(pool_size=args.concurrency + 1)
+    backend = SEARCH_BACKENDS[args.backend](endpoint, subscription_key, session, mkt=args.mkt, timeout=args.timeout)
+    main(
+        read_queries(args.queries_file), backend, session, args.output, max_pages=args.pages, per_page=args.per_page,
+        concurrency=args.concurrency, timeout=args.timeout, max_bytes=int(args.max_mb * 1024 * 1024),
+        phash_distance=args.phash_distance
+    )